@@ -10,13 +10,17 @@ we then will update the households again (cross check with census and re-run it)
 We will add the loop here as well (the longest is the fisrt SAA which is seperately)
 """
 import pandas as pd
+import polars as pl
 from PopSynthesis.Methods.IPSF.const import HH_TAG
 from PopSynthesis.Methods.IPSF.CSP.operations.sample_from_pairs import (
     sample_matching_from_pairs,
     create_count_col,
 )
+from PopSynthesis.Methods.IPSF.CSP.operations.paired_pool_index import PairedPoolIndex
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import PoolHandle
 import numpy as np
-from typing import Literal, Dict, Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Literal, Dict, List, Tuple, Union
 
 ordered_pairs = [
     [("HH", "Main")],
@@ -34,103 +38,229 @@ HHID = "hhid"
 main_rela = "Main"
 
 
+def parse_age_lower(ages: pd.Series) -> pd.Series:
+    """Lower bound of the age groups as int ("20-29" -> 20, "85+" -> 85), once per group"""
+    uniques = ages.unique()
+    lower = {x: int(str(x).split("-")[0].replace("+", "")) for x in uniques}
+    return ages.map(lower)
+
+
 def selecting_key_pp_to_sample(
     pp: pd.DataFrame,
     hhid: str,
     age_col: str,
     strategy: Literal["oldest", "youngest", "random"],
+    rng: Union[None, np.random.Generator] = None,
 ) -> pd.DataFrame:
-    """Filter the pp so each hh only have 1 pp so it can be used for sampling later"""
-    pp = pp.copy(deep=True).reset_index(drop=True)
-    pp["ppid"] = pp.index
-    pp["converted_age"] = pp[age_col].apply(
-        lambda x: int(x.split("-")[0].replace("+", ""))
-    )
-    gb_hhid = pp.groupby(hhid)[["ppid", "converted_age"]].apply(
-        lambda x: list(x.to_numpy())
-    )
-    gb_hhid = gb_hhid.apply(lambda x: sorted(x, key=lambda x: x[1]))
-    if strategy == "oldest":
-        gb_hhid = gb_hhid.apply(lambda x: x[-1][0])
-    elif strategy == "youngest":
-        gb_hhid = gb_hhid.apply(lambda x: x[0][0])
-    elif strategy == "random":
-        gb_hhid = gb_hhid.apply(lambda x: x[np.random.randint(0, len(x))][0])
-    else:
+    """Filter the pp so each hh only have 1 pp so it can be used for sampling later
+
+    The ties in age are broken by the order in pp (the first for youngest, the last for
+    oldest), rng None uses the global numpy state for random
+    """
+    if strategy not in ["oldest", "youngest", "random"]:
         raise ValueError("Strategy not found")
-    return pp[pp["ppid"].isin(gb_hhid)].drop(columns=["ppid", "converted_age"])
+    pp = pp.reset_index(drop=True)
+    ppid = "ppid"
+    hh_codes, _ = pd.factorize(pp[hhid])
+    keys = pl.DataFrame({hhid: hh_codes, ppid: np.arange(len(pp))})
+    if strategy == "random":
+        n = len(pp)
+        keys = keys.with_columns(
+            pl.Series("order", np.random.random(n) if rng is None else rng.random(n))
+        )
+        chosen = keys.group_by(hhid).agg(pl.col(ppid).sort_by("order").first())
+    else:
+        # the age groups as names, not the state codes
+        keys = keys.with_columns(
+            pl.Series("converted_age", parse_age_lower(pp[age_col]).to_numpy())
+        )
+        sorted_keys = keys.sort(["converted_age", ppid])
+        pick = pl.first if strategy == "youngest" else pl.last
+        chosen = sorted_keys.group_by(hhid, maintain_order=True).agg(pick(ppid))
+    return pp[np.isin(np.arange(len(pp)), chosen[ppid].to_numpy())]
+
+
+def get_pool(
+    pools_pp: Dict[str, Union[pd.DataFrame, PairedPoolIndex, PoolHandle]],
+    pool_name: str,
+    keep_handle: bool = False,
+) -> Union[pd.DataFrame, PairedPoolIndex, PoolHandle]:
+    """The pools can also be indexed or handles to a SharedPoolStore (e.g. in a worker)
+
+    keep_handle to attach later (e.g. in the worker the handle is sent to)
+    """
+    pool = pools_pp[pool_name]
+    if isinstance(pool, PoolHandle) and not keep_handle:
+        return pool.attach_pandas()
+    return pool
+
+
+def pair_layers(pairs: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+    """Group the pairs by dependency: a pair is in the layer after the one sampling its root
+
+    The pairs of a layer only read results of the previous layers, they can run together
+    """
+    layer_of = {HH_TAG: -1}
+    layers = []
+    for root_rela, sample_rela in pairs:
+        # a root never sampled falls back to Main (see _sample_pair)
+        layer = layer_of.get(root_rela, layer_of.get(main_rela, -1)) + 1
+        layer_of[sample_rela] = layer
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append((root_rela, sample_rela))
+    return layers
+
+
+def _sample_pair(
+    root_syn: pd.DataFrame,
+    root_rela: str,
+    sample_rela: str,
+    pool: Union[None, pd.DataFrame, PairedPoolIndex, PoolHandle],
+    pp_atts: list,
+    hh_atts: list,
+    all_rela: list,
+    rng: Union[None, np.random.Generator] = None,
+) -> Union[None, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Sample the sample_rela of each root record, output (sampled, removed root syn)
+
+    None if there is no sample_rela to sample, root_syn is not modified
+    """
+    print(f"Processing {root_rela} - {sample_rela}")
+    sample_cols = [f"{x}_{sample_rela}" for x in pp_atts]
+    if root_rela == HH_TAG:
+        to_process_syn = root_syn
+        sample_cols = sample_cols + all_rela
+        evidence_cols = hh_atts
+    else:
+        n_rela = root_syn[sample_rela].astype(int)
+        to_process_syn = root_syn[n_rela > 0].assign(**{sample_rela: n_rela[n_rela > 0]})
+        if len(to_process_syn) == 0:
+            print(f"WARNING: No {sample_rela} to process")
+            return None
+        to_process_syn = create_count_col(to_process_syn, sample_rela)
+        evidence_cols = [f"{x}_{root_rela}" for x in pp_atts]
+    if pool is None:
+        raise KeyError(f"{root_rela}-{sample_rela}")
+    if isinstance(pool, PoolHandle):
+        pool = pool.attach_pandas()
+
+    # process to_process_syn if duplicated hhid
+    if to_process_syn[HHID].duplicated().any():
+        to_process_syn = selecting_key_pp_to_sample(
+            to_process_syn, HHID, f"age_{root_rela}", "random", rng=rng
+        )
+
+    rela_pp, removed_syn, _ = sample_matching_from_pairs(
+        given_syn=to_process_syn,
+        syn_id=HHID,
+        paired_pool=pool,
+        evidence_cols=evidence_cols,
+        sample_cols=sample_cols,
+        rng=rng,
+    )
+
+    # speical process for second layer
+    if sample_rela == "Parent":
+        map_dict = dict(zip(to_process_syn[HHID], to_process_syn["Grandparent"]))
+        rela_pp["Grandparent"] = rela_pp[HHID].map(map_dict)
+    elif sample_rela == "Child":
+        map_dict = dict(zip(to_process_syn[HHID], to_process_syn["Grandchild"]))
+        rela_pp["Grandchild"] = rela_pp[HHID].map(map_dict)
+
+    rela_pp["relationship"] = sample_rela
+    return rela_pp, removed_syn
 
 
 def CSP_run(
-    syn_hh: pd.DataFrame, pools_pp: dict, pp_atts: list, hh_atts: list, all_rela: list
+    syn_hh: pd.DataFrame,
+    pools_pp: dict,
+    pp_atts: list,
+    hh_atts: list,
+    all_rela: list,
+    rng: Union[None, np.random.Generator] = None,
+    n_workers: int = 1,
+    executor: Union[None, Executor] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, pd.DataFrame]]:
-    """Run the CSP for the given synthetic households and pools"""
+    """Run the CSP for the given synthetic households and pools (rng None is np.random)
+
+    The pairs are run by layer (see pair_layers), all the pairs of a layer read the
+    results of the previous layers then their removals are merged by root: the hh removed
+    by a pair are removed from its root and from all the pairs of the layer with the same
+    root, the other pairs are not affected. Unlike running these pairs one after the
+    other, the records sampled for a hh by an earlier pair are also removed when a later
+    pair fails it (no pp left without their root), the removed records are the same: a
+    hh is only in the removed records of the first pair failing it.
+    The pairs of a layer run in n_workers threads (or in executor, e.g. processes with
+    the pools as PoolHandle), each pair has its own generator spawned from rng in the
+    order of the pairs, so the results do not depend on n_workers.
+    """
     syn_results = {HH_TAG: syn_hh}
     removed_recs = {}
-
-    for layer in ordered_pairs:
-        for root_rela, sample_rela in layer:
-            print(f"Processing {root_rela} - {sample_rela}")
-
-            sample_cols = [f"{x}_{sample_rela}" for x in pp_atts]
-            if root_rela == HH_TAG:
-                to_process_syn = syn_hh
-                sample_cols = sample_cols + all_rela
-                evidence_cols = hh_atts
-            else:
+    own_executor = executor is None and n_workers > 1
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        for layer in pair_layers([pair for layer in ordered_pairs for pair in layer]):
+            tasks = []
+            for root_rela, sample_rela in layer:
                 if root_rela not in syn_results:
                     print(
                         f"WARNING: No {root_rela} to process, fall back to using Main"
                     )
                     root_rela = main_rela
-                to_process_syn = syn_results[root_rela]
-                to_process_syn.loc[:, sample_rela] = list(
-                    to_process_syn[sample_rela].astype(int)
+                tasks.append((root_rela, sample_rela))
+            pair_rngs = [None] * len(tasks) if rng is None else rng.spawn(len(tasks))
+            args = [
+                (
+                    syn_results[root_rela],
+                    root_rela,
+                    sample_rela,
+                    # only needed (and checked) if there is some sample_rela
+                    get_pool(pools_pp, f"{root_rela}-{sample_rela}", keep_handle=True)
+                    if f"{root_rela}-{sample_rela}" in pools_pp
+                    else None,
+                    pp_atts,
+                    hh_atts,
+                    all_rela,
+                    pair_rng,
                 )
-                to_process_syn = to_process_syn[to_process_syn[sample_rela] > 0]
-                if len(to_process_syn) == 0:
-                    print(f"WARNING: No {sample_rela} to process")
-                    continue
-                to_process_syn = create_count_col(to_process_syn, sample_rela)
-                evidence_cols = [f"{x}_{root_rela}" for x in pp_atts]
-            pool_name = f"{root_rela}-{sample_rela}"
-
-            # process to_process_syn if duplicated hhid
-            if to_process_syn[HHID].duplicated().any():
-                to_process_syn = selecting_key_pp_to_sample(
-                    to_process_syn, HHID, f"age_{root_rela}", "random"
-                )
-
-            rela_pp, removed_syn, _ = sample_matching_from_pairs(
-                given_syn=to_process_syn,
-                syn_id=HHID,
-                paired_pool=pools_pp[pool_name],
-                evidence_cols=evidence_cols,
-                sample_cols=sample_cols,
-            )
-
-            # Update removed syn
-            if root_rela in removed_recs:
-                removed_recs[root_rela].append(removed_syn)
+                for (root_rela, sample_rela), pair_rng in zip(tasks, pair_rngs)
+            ]
+            if executor is None:
+                results = [_sample_pair(*x) for x in args]
             else:
-                removed_recs[root_rela] = [removed_syn]
+                # map keeps the order of the pairs
+                results = list(executor.map(_sample_pair, *zip(*args)))
 
-            # speical process for second layer
-            if sample_rela == "Parent":
-                map_dict = dict(
-                    zip(to_process_syn[HHID], to_process_syn["Grandparent"])
-                )
-                rela_pp["Grandparent"] = rela_pp[HHID].map(map_dict)
-            elif sample_rela == "Child":
-                map_dict = dict(zip(to_process_syn[HHID], to_process_syn["Grandchild"]))
-                rela_pp["Grandchild"] = rela_pp[HHID].map(map_dict)
-
-            rela_pp["relationship"] = sample_rela
-            syn_results[sample_rela] = rela_pp
-            rm_hhid = list(removed_syn[HHID])
-            syn_results[root_rela] = syn_results[root_rela][
-                ~syn_results[root_rela][HHID].isin(rm_hhid)
-            ]
+            # merge the removals of the layer into each root (and the pairs of that root)
+            root_rm_hhid = {}
+            for (root_rela, sample_rela), result in zip(tasks, results):
+                if result is None:
+                    continue
+                rela_pp, removed_syn = result
+                rm_hhid = root_rm_hhid.setdefault(root_rela, set())
+                removed_hhid = removed_syn[HHID].astype(str)
+                # already removed from the root by an earlier pair of the layer
+                removed_syn = removed_syn[~removed_hhid.isin(rm_hhid)]
+                if root_rela in removed_recs:
+                    removed_recs[root_rela].append(removed_syn)
+                else:
+                    removed_recs[root_rela] = [removed_syn]
+                rm_hhid.update(removed_hhid)
+                syn_results[sample_rela] = rela_pp
+            for root_rela, rm_hhid in root_rm_hhid.items():
+                root_syn = syn_results[root_rela]
+                syn_results[root_rela] = root_syn[~root_syn[HHID].astype(str).isin(rm_hhid)]
+            for (root_rela, sample_rela), result in zip(tasks, results):
+                if result is not None:
+                    rela_pp = syn_results[sample_rela]
+                    syn_results[sample_rela] = rela_pp[
+                        ~rela_pp[HHID].astype(str).isin(root_rm_hhid[root_rela])
+                    ]
+    finally:
+        if own_executor:
+            executor.shutdown()
 
     print("Concatenating results and output")
     # We need to concat them
@@ -142,12 +272,14 @@ def CSP_run(
                 df.rename(columns=rename_rela).drop(columns=all_rela, errors="ignore")
             )
     final_pp = pd.concat(temp_pp, ignore_index=True)
+    # the ids are str as for the hh (the sampled states can be codes, not cast to str)
+    final_pp[HHID] = final_pp[HHID].astype(str)
 
     # return impossible combinations by values
     for rela, removed in removed_recs.items():
         removed_recs[rela] = pd.concat(removed, ignore_index=True)
     final_hh = syn_results[HH_TAG]
-    final_hh.loc[:, HHID] = list(final_hh[HHID].astype(str))
+    final_hh = final_hh.assign(**{HHID: final_hh[HHID].astype(str)})
     final_hh = final_hh[final_hh[HHID].isin(list(final_pp[HHID]))]
 
     return final_hh, final_pp, removed_recs
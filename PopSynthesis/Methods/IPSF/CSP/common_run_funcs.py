@@ -1,12 +1,16 @@
 # Contain all common functions used in the CSP run
-import pickle
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import polars as pl
 from PopSynthesis.Methods.IPSF.const import (
     data_dir,
     small_test_dir,
     processed_dir,
     output_dir,
     zone_field,
+    count_field,
     PP_ATTS,
     HH_TAG,
     HH_ATTS,
@@ -15,14 +19,30 @@ from PopSynthesis.Methods.IPSF.const import (
 from PopSynthesis.Methods.IPSF.CSP.operations.sample_from_pairs import (
     update_by_rm_for_pool,
 )
+from PopSynthesis.Methods.IPSF.CSP.operations.paired_pool_index import (
+    PairedPoolIndex,
+    build_paired_pool_indexes,
+)
 from PopSynthesis.Methods.IPSF.utils.synthetic_checked_census import (
     adjust_kept_rec_match_census,
-    get_diff_marg,
-    convert_full_to_marg_count,
 )
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    wide_to_long_marg,
+    long_to_wide_marg,
+)
+from PopSynthesis.Methods.IPSF.utils.marginal_tracker import MarginalTracker
+from PopSynthesis.Methods.IPSF.utils.storage import (
+    read_frame,
+    read_marginal,
+    read_paired_pools,
+    save_frame,
+)
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import SharedPoolStore
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
 from PopSynthesis.Methods.IPSF.CSP.CSP import CSP_run, HHID
 from PopSynthesis.Methods.IPSF.SAA.SAA import SAA
-from typing import Tuple, Dict, List, Union
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from typing import Tuple, Dict, List, Union, Any
 
 
 def get_cross_checked_test() -> Tuple[
@@ -30,19 +50,18 @@ def get_cross_checked_test() -> Tuple[
 ]:
     # Get stored data
     print("Loading cross-checked test data")
-    with open(
-        small_test_dir / "dict_pool_pairs_check_HH_main_test.pickle", "rb"
-    ) as handle:
-        pools_ref = pickle.load(handle)
+    pools_ref = read_paired_pools(
+        small_test_dir / "dict_pool_pairs_check_HH_main_test.pickle"
+    )
 
-    syn_hh = pd.read_csv(
+    syn_hh = read_frame(
         small_test_dir / "SAA_HH_small.csv",
         index_col=0,
         dtype={x: str for x in HH_ATTS},
     ).reset_index(drop=True)
     syn_hh[HHID] = syn_hh.index
 
-    hh_marg = pd.read_csv(small_test_dir / "hh_marginals_small.csv", header=[0, 1])
+    hh_marg = read_marginal(small_test_dir / "hh_marginals_small.csv").reset_index()
 
     hh_pool = pools_ref[HH_TAG]
 
@@ -58,18 +77,16 @@ def get_cross_checked_data() -> Tuple[
 ]:
     # Get stored data
     print("Loading cross-checked data")
-    with open(processed_dir / "dict_pool_pairs_check_HH_main.pickle", "rb") as handle:
-        pools_ref = pickle.load(handle)
+    pools_ref = read_paired_pools(
+        processed_dir / "dict_pool_pairs_check_HH_main.pickle"
+    )
 
-    syn_hh = pd.read_csv(
+    syn_hh = read_frame(
         output_dir / "SAA_HH_fixed_ad.csv", index_col=0, dtype={x: str for x in HH_ATTS}
     ).reset_index(drop=True)
     syn_hh[HHID] = syn_hh.index
 
-    hh_marg = pd.read_csv(data_dir / "hh_marginals_ipu.csv", header=[0, 1])
-    hh_marg = hh_marg.drop(
-        columns=hh_marg.columns[hh_marg.columns.get_level_values(0) == "sample_geog"][0]
-    )
+    hh_marg = read_marginal(data_dir / "hh_marginals_ipu.csv").reset_index()
 
     hh_pool = pools_ref[HH_TAG]
 
@@ -85,21 +102,20 @@ def get_test_data() -> Tuple[
 ]:
     # Get stored data
     print("Loading test data")
-    syn_hh = pd.read_csv(
+    syn_hh = read_frame(
         small_test_dir / "SAA_HH_small.csv",
         index_col=0,
         dtype={x: str for x in HH_ATTS},
     ).reset_index(drop=True)
     syn_hh[HHID] = syn_hh.index
 
-    hh_pool = pd.read_csv(small_test_dir / "HH_pool_small_test.csv")
+    hh_pool = read_frame(small_test_dir / "HH_pool_small_test.csv")
 
-    hh_marg = pd.read_csv(small_test_dir / "hh_marginals_small.csv", header=[0, 1])
+    hh_marg = read_marginal(small_test_dir / "hh_marginals_small.csv").reset_index()
 
-    with open(
-        small_test_dir / "dict_pool_pairs_by_layers_small.pickle", "rb"
-    ) as handle:
-        pools_ref = pickle.load(handle)
+    pools_ref = read_paired_pools(
+        small_test_dir / "dict_pool_pairs_by_layers_small.pickle"
+    )
 
     return syn_hh, hh_pool, hh_marg, pools_ref
 
@@ -109,20 +125,18 @@ def get_full_data() -> Tuple[
 ]:
     # Get stored data
     print("Loading full data")
-    syn_hh = pd.read_csv(
+    syn_hh = read_frame(
         output_dir / "SAA_HH_fixed_ad.csv", index_col=0, dtype={x: str for x in HH_ATTS}
     ).reset_index(drop=True)
     syn_hh[HHID] = syn_hh.index
 
-    hh_pool = pd.read_csv(processed_dir / "HH_pool.csv")
+    hh_pool = read_frame(processed_dir / "HH_pool.csv")
 
-    hh_marg = pd.read_csv(data_dir / "hh_marginals_ipu.csv", header=[0, 1])
-    hh_marg = hh_marg.drop(
-        columns=hh_marg.columns[hh_marg.columns.get_level_values(0) == "sample_geog"][0]
-    )
+    hh_marg = read_marginal(data_dir / "hh_marginals_ipu.csv").reset_index()
 
-    with open(processed_dir / "dict_pool_pairs_by_layers.pickle", "rb") as handle:
-        pools_ref = pickle.load(handle)
+    pools_ref = read_paired_pools(
+        processed_dir / "dict_pool_pairs_by_layers.pickle"
+    )
 
     return syn_hh, hh_pool, hh_marg, pools_ref
 
@@ -130,26 +144,26 @@ def get_full_data() -> Tuple[
 def get_remaining_hh_n_new_marg(
     hh_marg: pd.DataFrame, final_syn_pop: pd.DataFrame
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    # get the marg from the kept hh
-    marg_from_kept_hh = convert_full_to_marg_count(
-        final_syn_pop.drop(columns=[HHID], errors="ignore"), [zone_field]
-    )
-    # get the marg from the original marg
+    # long format for the checking, the wide diff only for the deletion and the next run
+    hh_atts = [x for x in final_syn_pop.columns if x not in [zone_field, HHID]]
     converted_hh_marg = hh_marg.set_index(
         hh_marg.columns[hh_marg.columns.get_level_values(0) == zone_field][0]
     )
+    census_long = wide_to_long_marg(converted_hh_marg)
+    # counted once, then only the deleted hh are removed from it
+    tracker = MarginalTracker.from_pop(final_syn_pop, hh_atts)
     # get the diff
-    diff_marg = get_diff_marg(converted_hh_marg, marg_from_kept_hh)
+    diff_long = tracker.diff_long(census_long)
     # adjust the kept hh
-    kept_hh = adjust_kept_rec_match_census(final_syn_pop, diff_marg)
-    # checking
-    kept_marg = convert_full_to_marg_count(
-        kept_hh.drop(columns=[HHID], errors="ignore"), [zone_field]
+    kept_hh, deleted_hh = adjust_kept_rec_match_census(
+        final_syn_pop, long_to_wide_marg(diff_long), return_deleted=True
     )
-    new_diff_marg = get_diff_marg(converted_hh_marg, kept_marg)
+    # checking
+    tracker.add_records(deleted_hh, sign=-1)
+    new_diff_long = tracker.diff_long(census_long)
     # check it is no neg indeed
-    checking_not_neg = new_diff_marg < 0
-    assert checking_not_neg.any(axis=None) == False
+    assert (new_diff_long[count_field] >= 0).all()
+    new_diff_marg = long_to_wide_marg(new_diff_long)
     # now get the new marg
     new_diff_marg.index = new_diff_marg.index.astype(int)
     new_diff_marg.index.name = zone_field
@@ -159,15 +173,32 @@ def get_remaining_hh_n_new_marg(
 def update_CSP_combined_syn_hhmarg_pools(
     syn_hh: pd.DataFrame,
     hh_marg: pd.DataFrame,
-    pools_ref: Dict[str, pd.DataFrame],
+    pools_ref: Dict[str, Union[pd.DataFrame, PairedPoolIndex]],
     pp_atts: List[str],
     hh_atts: List[str],
     all_rela: List[str],
-) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, Dict[str, pd.DataFrame]]:
-    syn_hh, syn_pp, error_recs = CSP_run(syn_hh, pools_ref, pp_atts, hh_atts, all_rela)
+    rng: Union[None, np.random.Generator] = None,
+    n_workers: int = 1,
+) -> Tuple[
+    pd.DataFrame,
+    pd.DataFrame,
+    pd.DataFrame,
+    Dict[str, Union[pd.DataFrame, PairedPoolIndex]],
+]:
+    """CSP then census check, the pools are updated by the recs that cannot be matched
+
+    All the pools are output, the ones not related to any error rec as they are (they
+    were dropped before, so the next run had no pool for them).
+    The indexed pools are updated in place (tombstones), the others are filtered.
+    rng and n_workers are for CSP_run (the pairs of a layer run in n_workers threads)
+    """
+    syn_hh, syn_pp, error_recs = CSP_run(
+        syn_hh, pools_ref, pp_atts, hh_atts, all_rela, rng=rng, n_workers=n_workers
+    )
     updated_hh, updated_hh_marg = get_remaining_hh_n_new_marg(hh_marg, syn_hh)
     updated_pp = syn_pp[syn_pp[HHID].isin(updated_hh[HHID])]
-    updated_pool_ref = {}
+    # the pools without error recs are kept as they are
+    updated_pool_ref = dict(pools_ref)
     # update pools by error recs
     print("Updating pools")
     for rela, error_rec in error_recs.items():
@@ -175,39 +206,113 @@ def update_CSP_combined_syn_hhmarg_pools(
         check_cols = hh_atts if rela == "HH" else [f"{x}_{rela}" for x in pp_atts]
         for pool_name in related_pools:
             print(f"Updating {pool_name} for {rela}")
-            updated_pool_ref[pool_name] = update_by_rm_for_pool(
-                error_rec, pools_ref[pool_name], check_cols
-            )
+            # from the already updated pool, a pool can be related to several relas
+            pool = updated_pool_ref[pool_name]
+            if isinstance(pool, PairedPoolIndex):
+                pool.remove(error_rec, check_cols)
+            else:
+                updated_pool_ref[pool_name] = update_by_rm_for_pool(
+                    error_rec, pool, check_cols
+                )
 
     return updated_hh, updated_pp, updated_hh_marg, updated_pool_ref
 
 
-def ipsf_full_loop(
-    order_adjustment: List[str],
+def _zone_col(hh_marg: pd.DataFrame) -> Tuple[str, str]:
+    return hh_marg.columns[hh_marg.columns.get_level_values(0) == zone_field][0]
+
+
+def n_hh_in_marg(hh_marg: pd.DataFrame, atts: List[str]) -> float:
+    """The n of hh in the census (zone as a col), each hh is counted once per att"""
+    # the zone ids are not counts
+    return hh_marg.drop(columns=[_zone_col(hh_marg)]).sum().sum() / len(atts)
+
+
+def encode_ipsf_inputs(
+    categories: CategoricalDictionary,
     syn_hh: pd.DataFrame,
     hh_pool: pd.DataFrame,
     hh_marg: pd.DataFrame,
     pools_ref: Dict[str, pd.DataFrame],
+) -> Tuple[
+    Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, Dict[str, pd.DataFrame]],
+    CategoricalDictionary,
+]:
+    """The inputs of the IPSF loop as state codes, also output the dictionary of the run
+
+    The dictionary of the run also has the pp atts of the paired pools (e.g. age_Main)
+    """
+    relas = sorted(set(x for name in pools_ref for x in name.split("-")) - {HH_TAG})
+    run_categories = categories.with_suffixes(relas)
+    encoded = (
+        run_categories.encode_pandas(syn_hh),
+        run_categories.encode_pandas(hh_pool),
+        run_categories.encode_marginal(hh_marg),
+        {name: run_categories.encode_pandas(pool) for name, pool in pools_ref.items()},
+    )
+    return encoded, run_categories
+
+
+def _decode(
+    categories: Union[None, CategoricalDictionary], df: Union[None, pd.DataFrame]
+) -> Union[None, pd.DataFrame]:
+    if categories is None or df is None:
+        return df
+    return categories.decode_pandas(df)
+
+
+def _ipsf_loop(
+    order_adjustment: List[str],
+    syn_hh: pd.DataFrame,
+    hh_pool: pd.DataFrame,
+    hh_marg: pd.DataFrame,
+    pools_ref: Dict[str, Union[pd.DataFrame, PairedPoolIndex]],
     max_run_time: int = 30,
     output_each_step: bool = False,
-) -> Tuple[pd.DataFrame, pd.DataFrame, List[int], Union[pd.DataFrame, None]]:
+    id_start: int = 0,
+    pool_store: Union[None, SharedPoolStore] = None,
+    rng: Union[None, np.random.Generator] = None,
+    n_csp_workers: int = 1,
+) -> Tuple[
+    pd.DataFrame,
+    pd.DataFrame,
+    List[int],
+    Union[pd.DataFrame, None],
+    pd.DataFrame,
+    Dict[str, PairedPoolIndex],
+    int,
+]:
+    """The IPSF loop, also output the remaining marg, the updated pools and the highest id
+
+    The pools are indexed (PairedPoolIndex) at the start if not yet, output as indexes
+
+    The new hh from SAA get ids above id_start and above the ids of syn_hh
+    With pool_store, the SAA workers attach to the hh pool published there (the paired
+    pools stay in memory, the CSP pairs run in threads on their indexes)
+    With rng, the CSP runs are reproducible for any n_csp_workers (see CSP_run)
+    """
     # get attributes
     pp_atts = list(set(PP_ATTS) - set(NOT_INCLUDED_IN_BN_LEARN))
     hh_atts = [x for x in syn_hh.columns if x not in [zone_field, HHID]]
     all_rela = list(set([x.split("-")[-1] for x in pools_ref.keys()]))
+    # SAA works on the condensed pool in polars
+    count_hh_pool = condense_df(hh_pool)
+    # indexed once, kept (and updated) for all the runs
+    pools_ref = build_paired_pool_indexes(pools_ref, pp_atts, hh_atts)
 
     # Run the CSP - first run
     updated_syn_hh, syn_pp, hh_marg, pools_ref = update_CSP_combined_syn_hhmarg_pools(
-        syn_hh, hh_marg, pools_ref, pp_atts, hh_atts, all_rela
+        syn_hh, hh_marg, pools_ref, pp_atts, hh_atts, all_rela,
+        rng=rng, n_workers=n_csp_workers,
     )
 
     # init with the total HH we want
     chosen_hhs = [updated_syn_hh]
     chosen_pp = [syn_pp]
-    highest_id = updated_syn_hh[HHID].astype(int).max()
+    highest_id = max([id_start - 1] + list(syn_hh[HHID].astype(int)))
     left_over_hh = None
 
-    n_removed_err = hh_marg.sum().sum() / len(order_adjustment)
+    n_removed_err = n_hh_in_marg(hh_marg, order_adjustment)
     n_run_time = 0
     err_rm_hh = [n_removed_err]
     while n_run_time < max_run_time and n_removed_err > 0:
@@ -215,11 +320,17 @@ def ipsf_full_loop(
         print(
             f"For run {n_run_time}, order is: {order_adjustment}, aim for {n_removed_err} HHs"
         )
-        saa = SAA(hh_marg, order_adjustment, order_adjustment, hh_pool)
+        saa = SAA(
+            hh_marg.set_index(_zone_col(hh_marg)),
+            order_adjustment,
+            order_adjustment,
+            count_hh_pool,
+            pool_store=pool_store,
+        )
         ###
         added_syn_hh = saa.run(
             output_each_step=output_each_step, extra_name=f"_IPSF_{n_run_time}"
-        )
+        ).to_pandas()
         added_syn_hh[HHID] = range(highest_id + 1, highest_id + len(added_syn_hh) + 1)
         ###
         # error check
@@ -229,14 +340,16 @@ def ipsf_full_loop(
             hh_marg,
             pools_ref,
         ) = update_CSP_combined_syn_hhmarg_pools(
-            added_syn_hh, hh_marg, pools_ref, pp_atts, hh_atts, all_rela
+            added_syn_hh, hh_marg, pools_ref, pp_atts, hh_atts, all_rela,
+            rng=rng, n_workers=n_csp_workers,
         )
 
         # added the adjusted ones
         chosen_hhs.append(new_syn_hh)
         chosen_pp.append(new_syn_pp)
 
-        highest_id = new_syn_hh[HHID].astype(int).max()
+        # the removed ids are not reused, the left over hh keep theirs
+        highest_id += len(added_syn_hh)
         n_run_time += 1
         n_removed_err = len(added_syn_hh) - len(new_syn_hh)
         err_rm_hh.append(n_removed_err)
@@ -251,7 +364,10 @@ def ipsf_full_loop(
     cannot_adjust_hh = None
     if left_over_hh is not None:  # meaning the there are some hh withour pp assigned
         # run the last CSP
-        syn_hh, syn_pp, _ = CSP_run(left_over_hh, pools_ref, pp_atts, hh_atts, all_rela)
+        syn_hh, syn_pp, _ = CSP_run(
+            left_over_hh, pools_ref, pp_atts, hh_atts, all_rela,
+            rng=rng, n_workers=n_csp_workers,
+        )
         chosen_hhs.append(syn_hh)
         chosen_pp.append(syn_pp)
         cannot_adjust_hh = left_over_hh[
@@ -266,4 +382,168 @@ def ipsf_full_loop(
 
     final_syn_hh = pd.concat(chosen_hhs)
     final_syn_pp = pd.concat(chosen_pp)
-    return final_syn_hh, final_syn_pp, err_rm_hh, cannot_adjust_hh
+    return (
+        final_syn_hh,
+        final_syn_pp,
+        err_rm_hh,
+        cannot_adjust_hh,
+        hh_marg,
+        pools_ref,
+        highest_id,
+    )
+
+
+def ipsf_full_loop(
+    order_adjustment: List[str],
+    syn_hh: pd.DataFrame,
+    hh_pool: pd.DataFrame,
+    hh_marg: pd.DataFrame,
+    pools_ref: Dict[str, pd.DataFrame],
+    max_run_time: int = 30,
+    output_each_step: bool = False,
+    pool_store: Union[None, SharedPoolStore] = None,
+    rng: Union[None, np.random.Generator] = None,
+    n_csp_workers: int = 1,
+    categories: Union[None, CategoricalDictionary] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, List[int], Union[pd.DataFrame, None]]:
+    """The IPSF loop on the whole syn hh, see _ipsf_loop
+
+    With categories (hh and pp state names), the whole loop runs on the state codes
+    (see encode_ipsf_inputs) and the outputs are decoded back to the state names
+    """
+    run_categories = None
+    if categories is not None:
+        (syn_hh, hh_pool, hh_marg, pools_ref), run_categories = encode_ipsf_inputs(
+            categories, syn_hh, hh_pool, hh_marg, pools_ref
+        )
+    final_syn_hh, final_syn_pp, err_rm_hh, cannot_adjust_hh, _, _, _ = _ipsf_loop(
+        order_adjustment,
+        syn_hh,
+        hh_pool,
+        hh_marg,
+        pools_ref,
+        max_run_time=max_run_time,
+        output_each_step=output_each_step,
+        pool_store=pool_store,
+        rng=rng,
+        n_csp_workers=n_csp_workers,
+    )
+    return (
+        _decode(run_categories, final_syn_hh),
+        _decode(run_categories, final_syn_pp),
+        err_rm_hh,
+        _decode(run_categories, cannot_adjust_hh),
+    )
+
+
+def segment_zones(zones: List[Any], chunk_size: int) -> List[List[Any]]:
+    """Chunks of chunk_size zones, in order of the zone ids (nearby ids are nearby areas)"""
+    assert chunk_size > 0
+    zones = sorted(set(zones))
+    return [zones[i : i + chunk_size] for i in range(0, len(zones), chunk_size)]
+
+
+def _write_chunk(df: Union[None, pd.DataFrame], out_dir: Path, name: str, i: int) -> None:
+    # hive style partitions, read back all the chunks with read_chunked_output
+    if df is None or len(df) == 0:
+        return
+    save_frame(df, out_dir / name / f"chunk={i}" / "part-0.parquet")
+
+
+def _long_remaining_marg(
+    marg: pd.DataFrame,
+    zone_col: Tuple[str, str],
+    categories: Union[None, CategoricalDictionary] = None,
+) -> pd.DataFrame:
+    if categories is not None:
+        marg = categories.decode_marginal(marg)
+    return wide_to_long_marg(marg.set_index(zone_col)).to_pandas()
+
+
+def read_chunked_output(out_dir: Path, name: str) -> pl.LazyFrame:
+    """Lazy scan of all the chunks of an output of ipsf_chunked_loop (HH, PP, ...)"""
+    return pl.scan_parquet(out_dir / name / "**" / "*.parquet", hive_partitioning=True)
+
+
+def ipsf_chunked_loop(
+    order_adjustment: List[str],
+    syn_hh: pd.DataFrame,
+    hh_pool: pd.DataFrame,
+    hh_marg: pd.DataFrame,
+    pools_ref: Dict[str, pd.DataFrame],
+    out_dir: Path,
+    chunk_size: int = 100,
+    zone_chunks: Union[None, List[List[Any]]] = None,
+    max_run_time: int = 30,
+    pool_store: Union[None, SharedPoolStore] = None,
+    rng: Union[None, np.random.Generator] = None,
+    n_csp_workers: int = 1,
+    categories: Union[None, CategoricalDictionary] = None,
+) -> Tuple[List[int], Dict[str, pd.DataFrame]]:
+    """Run ipsf_full_loop on chunks of zones, the results are written to out_dir by chunk
+
+    Only the pools (updated by each chunk) and the ids go from a chunk to the next, the syn
+    hh/pp of a chunk are written to out_dir/{HH, PP, cannot_assign_HH, remaining_marg}
+    then dropped, so the memory depends on the chunk size, not on the whole population.
+    zone_chunks (e.g. by region) default to chunk_size zones in order of the ids.
+    Output the err of each run of each chunk and the final pools
+    With categories, the chunks run on the state codes (encoded once, see ipsf_full_loop),
+    what is written and output is decoded
+    """
+    run_categories = None
+    if categories is not None:
+        (syn_hh, hh_pool, hh_marg, pools_ref), run_categories = encode_ipsf_inputs(
+            categories, syn_hh, hh_pool, hh_marg, pools_ref
+        )
+    zone_col = _zone_col(hh_marg)
+    if zone_chunks is None:
+        zone_chunks = segment_zones(list(hh_marg[zone_col]), chunk_size)
+    syn_hh_by_zone = dict(list(syn_hh.groupby(zone_field)))
+    next_id = syn_hh[HHID].astype(int).max() + 1
+    ls_err_rm = []
+    for i, zones in enumerate(zone_chunks):
+        print(f"CHUNK {i + 1}/{len(zone_chunks)}: {len(zones)} zones")
+        chunk_marg = hh_marg[hh_marg[zone_col].isin(zones)]
+        ls_chunk_syn_hh = [syn_hh_by_zone[zid] for zid in zones if zid in syn_hh_by_zone]
+        if len(ls_chunk_syn_hh) == 0:
+            # e.g. zones without hh in the census, nothing to adjust from
+            print(f"WARNING: no syn hh in chunk {i + 1}, skipped")
+            ls_err_rm.append([n_hh_in_marg(chunk_marg, order_adjustment)])
+            remaining_long = _long_remaining_marg(chunk_marg, zone_col, run_categories)
+            _write_chunk(remaining_long, out_dir, "remaining_marg", i)
+            continue
+        chunk_syn_hh = pd.concat(ls_chunk_syn_hh)
+        (
+            final_syn_hh,
+            final_syn_pp,
+            err_rm_hh,
+            cannot_adjust_hh,
+            remaining_marg,
+            pools_ref,
+            highest_id,
+        ) = _ipsf_loop(
+            order_adjustment,
+            chunk_syn_hh,
+            hh_pool,
+            chunk_marg,
+            pools_ref,
+            max_run_time=max_run_time,
+            id_start=next_id,
+            pool_store=pool_store,
+            rng=rng,
+            n_csp_workers=n_csp_workers,
+        )
+        next_id = highest_id + 1
+        ls_err_rm.append(err_rm_hh)
+
+        _write_chunk(_decode(run_categories, final_syn_hh), out_dir, "HH", i)
+        _write_chunk(_decode(run_categories, final_syn_pp), out_dir, "PP", i)
+        _write_chunk(
+            _decode(run_categories, cannot_adjust_hh), out_dir, "cannot_assign_HH", i
+        )
+        remaining_long = _long_remaining_marg(remaining_marg, zone_col, run_categories)
+        _write_chunk(remaining_long, out_dir, "remaining_marg", i)
+        del final_syn_hh, final_syn_pp, cannot_adjust_hh, remaining_marg
+    return ls_err_rm, {
+        name: _decode(run_categories, pool.to_frame()) for name, pool in pools_ref.items()
+    }
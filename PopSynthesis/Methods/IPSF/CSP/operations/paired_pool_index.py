@@ -0,0 +1,158 @@
+"""
+Index of a paired pool by its evidence cols, built once and kept for all the CSP rounds
+
+The pool rows are sorted by evidence comb so each comb is a contiguous range of rows,
+a dict gives the range of a comb in O(1) and the cumulative weights (1 per row if no
+weight col) are used to draw rows within a range.
+Removing recs (the recs that cannot be matched, see update_CSP_combined_syn_hhmarg_pools)
+does not rebuild anything: the removed rows get a weight of 0 (tombstone) and only the
+cumulative weights are updated. A comb with no weight left is as if not in the pool.
+If all the evidence cols of the pool are integers (e.g. the state codes of
+CategoricalDictionary) the combs are compared as int64, else as str (1 and "1" the same).
+"""
+
+import numpy as np
+import pandas as pd
+
+from PopSynthesis.Methods.IPSF.const import HH_TAG
+from typing import Dict, List, Tuple, Union
+
+CODE_COL = "_comb_code"
+
+
+def _all_int(df: pd.DataFrame, cols: List[str]) -> bool:
+    return all(pd.api.types.is_integer_dtype(df[x]) for x in cols)
+
+
+class PairedPoolIndex:
+    def __init__(
+        self,
+        pool: pd.DataFrame,
+        evidence_cols: List[str],
+        weight_col: Union[None, str] = None,
+    ) -> None:
+        assert set(evidence_cols) <= set(pool.columns)
+        self.evidence_cols = list(evidence_cols)
+        self.weight_col = weight_col
+        self.int_keys = _all_int(pool, self.evidence_cols)
+        evidence = self.evidence_keys(pool)
+        codes = evidence.groupby(self.evidence_cols, sort=True, dropna=False).ngroup()
+        order = np.argsort(codes.to_numpy(), kind="stable")
+        self.pool = pool.iloc[order].reset_index(drop=True)
+        # one row per comb, in the order of the codes
+        self.combs = (
+            evidence.iloc[order]
+            .drop_duplicates()
+            .reset_index(drop=True)
+            .assign(**{CODE_COL: lambda x: np.arange(len(x))})
+        )
+        self.comb_index: Dict[Tuple, int] = {
+            comb: i
+            for i, comb in enumerate(
+                self.combs[self.evidence_cols].itertuples(index=False, name=None)
+            )
+        }
+        self.lengths = np.bincount(codes.to_numpy(), minlength=len(self.combs))
+        self.offsets = (np.cumsum(self.lengths) - self.lengths).astype(np.int64)
+        if weight_col is None:
+            self.weights = np.ones(len(self.pool))
+        else:
+            self.weights = self.pool[weight_col].to_numpy().astype(float)
+        self._update_cum_weights()
+
+    def evidence_keys(
+        self, df: pd.DataFrame, cols: Union[None, List[str]] = None
+    ) -> pd.DataFrame:
+        """The cols (default the evidence cols) of df as compared with the pool, int64 if
+        these cols of the pool are all integers else str"""
+        as_int = self.int_keys if cols is None else _all_int(self.pool, cols)
+        cols = self.evidence_cols if cols is None else cols
+        return df[cols].astype(np.int64 if as_int else str).reset_index(drop=True)
+
+    def _update_cum_weights(self) -> None:
+        self.cum_weights = np.cumsum(self.weights)
+        cum_before = np.concatenate([[0.0], self.cum_weights])
+        self.comb_cum_start = cum_before[self.offsets]
+        self.comb_weights = cum_before[self.offsets + self.lengths] - self.comb_cum_start
+
+    def lookup(self, comb: Tuple) -> Union[None, Tuple[int, int]]:
+        """(offset, length) of the rows of comb, None if not in the pool (or removed)"""
+        key_type = int if self.int_keys else str
+        code = self.comb_index.get(tuple(key_type(x) for x in comb))
+        if code is None or self.comb_weights[code] <= 0:
+            return None
+        return int(self.offsets[code]), int(self.lengths[code])
+
+    def codes_for(self, df: pd.DataFrame) -> np.ndarray:
+        """Code of the comb of each row of df, -1 if not in the pool (or removed)"""
+        evidence = self.evidence_keys(df)
+        codes = evidence.merge(self.combs, on=self.evidence_cols, how="left")[CODE_COL]
+        codes = codes.fillna(-1).to_numpy().astype(np.int64)
+        codes[codes >= 0] = np.where(
+            self.comb_weights[codes[codes >= 0]] > 0, codes[codes >= 0], -1
+        )
+        return codes
+
+    def sample(
+        self, codes: np.ndarray, rng: Union[None, np.random.Generator] = None
+    ) -> np.ndarray:
+        """One row (position in self.pool) drawn by weight for each code (all >= 0)"""
+        assert (codes >= 0).all()
+        uniforms = np.random.random(len(codes)) if rng is None else rng.random(len(codes))
+        targets = self.comb_cum_start[codes] + uniforms * self.comb_weights[codes]
+        rows = np.searchsorted(self.cum_weights, targets, side="right")
+        # float rounding at the end of a range
+        return np.minimum(rows, self.offsets[codes] + self.lengths[codes] - 1)
+
+    def remove(self, rm_df: pd.DataFrame, check_cols: List[str]) -> int:
+        """Tombstone the rows having a comb of check_cols in rm_df, output the n removed"""
+        assert set(check_cols) <= set(rm_df.columns)
+        assert set(check_cols) <= set(self.pool.columns)
+        rm_combs = self.evidence_keys(rm_df, check_cols).drop_duplicates()
+        matched = (
+            self.evidence_keys(self.pool, check_cols)
+            .merge(rm_combs, on=check_cols, how="left", indicator=True)["_merge"]
+            == "both"
+        ).to_numpy()
+        to_remove = matched & (self.weights > 0)
+        if to_remove.any():
+            self.weights[to_remove] = 0
+            self._update_cum_weights()
+        return int(to_remove.sum())
+
+    def to_frame(self) -> pd.DataFrame:
+        """The rows not removed, sorted by comb"""
+        return self.pool[self.weights > 0].reset_index(drop=True)
+
+    def __len__(self) -> int:
+        return int((self.weights > 0).sum())
+
+    def __repr__(self) -> str:
+        return (
+            f"PairedPoolIndex({len(self)} rows, {int((self.comb_weights > 0).sum())} "
+            f"combs of {self.evidence_cols})"
+        )
+
+
+def pool_evidence_cols(
+    pool_name: str, pp_atts: List[str], hh_atts: List[str]
+) -> List[str]:
+    """The evidence cols of a pool from its name (root-rela), as in CSP_run"""
+    root_rela = pool_name.split("-")[0]
+    if root_rela == HH_TAG:
+        return list(hh_atts)
+    return [f"{x}_{root_rela}" for x in pp_atts]
+
+
+def build_paired_pool_indexes(
+    pools: Dict[str, Union[pd.DataFrame, PairedPoolIndex]],
+    pp_atts: List[str],
+    hh_atts: List[str],
+) -> Dict[str, PairedPoolIndex]:
+    """Index the pools not indexed yet (the indexes given are kept as they are)"""
+    return {
+        name: pool
+        if isinstance(pool, PairedPoolIndex)
+        else PairedPoolIndex(pool, pool_evidence_cols(name, pp_atts, hh_atts))
+        for name, pool in pools.items()
+    }
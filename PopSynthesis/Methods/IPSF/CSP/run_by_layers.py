@@ -1,13 +1,18 @@
 """Run the CSP from a given syn HH (also SAA to adjust again)"""
 
 
-from PopSynthesis.Methods.IPSF.const import output_dir
+from PopSynthesis.Methods.IPSF.const import output_dir, processed_dir
 from PopSynthesis.Methods.IPSF.CSP.common_run_funcs import (
     ipsf_full_loop,
+    ipsf_chunked_loop,
     get_cross_checked_data,
 )
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame
 import time
 
+import numpy as np
+
 
 # For SAA
 order_adjustment = [
@@ -17,6 +22,16 @@ order_adjustment = [
     "dwelltype",
     "owndwell",
 ]  # these must exist in both marg and syn
+# For CSP, the pairs of a layer run concurrently, same results for any n of workers
+seed = 42
+n_csp_workers = 4
+
+
+def get_categories() -> CategoricalDictionary:
+    # the whole loop runs on the state codes, decoded at output
+    return CategoricalDictionary.from_pickles(
+        processed_dir / "dict_hh_states.pickle", processed_dir / "dict_pp_states.pickle"
+    )
 
 
 def main():
@@ -32,6 +47,9 @@ def main():
         hh_marg=hh_marg,
         pools_ref=pools_ref,
         max_run_time=2,
+        rng=np.random.default_rng(seed),
+        n_csp_workers=n_csp_workers,
+        categories=get_categories(),
     )
     ##
 
@@ -44,13 +62,38 @@ def main():
     print(f"Error hh rm are: {err_rm}")
 
     # output
-    final_syn_hh.to_csv(output_dir / "IPSF_HH_2rrun.csv", index=False)
-    final_syn_pp.to_csv(output_dir / "IPSF_PP_2rrun.csv", index=False)
+    save_frame(final_syn_hh, output_dir / "IPSF_HH_2rrun.parquet")
+    save_frame(final_syn_pp, output_dir / "IPSF_PP_2rrun.parquet")
     if cannot_assign_hh is not None:
-        cannot_assign_hh.to_csv(
-            output_dir / "IPSF_cannot_assign_hh_2rrun.csv", index=False
+        save_frame(
+            cannot_assign_hh, output_dir / "IPSF_cannot_assign_hh_2rrun.parquet"
         )
 
 
+def main_chunked(chunk_size: int = 200):
+    """Same as main by chunks of zones, the results are written by chunk as parquet"""
+    syn_hh, hh_pool, hh_marg, pools_ref = get_cross_checked_data()
+
+    start_time = time.time()
+    err_rm, _ = ipsf_chunked_loop(
+        order_adjustment=order_adjustment,
+        syn_hh=syn_hh,
+        hh_pool=hh_pool,
+        hh_marg=hh_marg,
+        pools_ref=pools_ref,
+        out_dir=output_dir / "IPSF_chunked",
+        chunk_size=chunk_size,
+        max_run_time=2,
+        rng=np.random.default_rng(seed),
+        n_csp_workers=n_csp_workers,
+        categories=get_categories(),
+    )
+    elapsed_time = time.time() - start_time
+    hours, rem = divmod(elapsed_time, 3600)
+    minutes, seconds = divmod(rem, 60)
+    print(f"IPSF took {int(hours)}h-{int(minutes)}m-{seconds:.2f}s")
+    print(f"Error hh rm by chunk are: {err_rm}")
+
+
 if __name__ == "__main__":
     main()
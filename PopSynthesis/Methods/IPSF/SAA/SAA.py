@@ -8,12 +8,19 @@ Will thinking of doing in Polars
 import pandas as pd
 import polars as pl
 
-from PopSynthesis.Methods.IPSF.const import output_dir
+from PopSynthesis.Methods.IPSF.const import output_dir, count_field
 from PopSynthesis.Methods.IPSF.SAA.operations.general import (
     process_raw_ipu_marg,
     adjust_atts_state_match_census,
 )
-from typing import List
+from PopSynthesis.Methods.IPSF.SAA.operations.zone_scheduler import (
+    create_zone_executor,
+    run_seed,
+)
+from PopSynthesis.Methods.IPSF.utils.marginal_tracker import MarginalTracker
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import SharedPoolStore
+from typing import List, Union, Dict, Any
 
 
 class SAA:
@@ -23,10 +30,30 @@ class SAA:
         considered_atts: List[str],
         ordered_to_adjust_atts: List[str],
         count_pool: pl.DataFrame,
+        n_workers: int = 1,
+        chunk_size: int = 50,
+        seed: Union[None, int] = None,
+        ILP_options: Union[None, Dict[str, Any]] = None,
+        track_marginals: bool = True,
+        debug_marginals: bool = False,
+        pool_store: Union[None, SharedPoolStore] = None,
     ) -> None:
         self.ordered_atts_to_adjust = ordered_to_adjust_atts
         self.considered_atts = considered_atts
         self.pool = count_pool
+        # zone parallel settings, n_workers=1 is the serial run
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.seed = seed
+        # passed to update_count_tables, e.g. {"engine": "flow"}
+        self.ILP_options = ILP_options
+        # keep the marginals of the syn pop updated by deltas instead of regrouping
+        # after each att, debug_marginals checks them against a recount each time
+        self.track_marginals = track_marginals
+        self.debug_marginals = debug_marginals
+        self.tracker = None
+        # the workers attach to the pool in the store, a temporary one per run if None
+        self.pool_store = pool_store
         self.init_required_inputs(marginal_raw)
 
     def init_required_inputs(self, marginal_raw: pd.DataFrame):
@@ -37,17 +64,53 @@ class SAA:
 
     def run(self, output_each_step: bool = False, extra_name: str = "") -> pl.DataFrame:
         # Output the synthetic population, the main point
+        # kept partitioned by zone between the atts, only combined at the end
         curr_syn_pop = None
         adjusted_atts = []
-        for att in self.ordered_atts_to_adjust:
-            sub_census = self.segmented_marg[att].reset_index()
-            sub_census = pl.from_pandas(sub_census)
-            curr_syn_pop = adjust_atts_state_match_census(
-                att, curr_syn_pop, sub_census, adjusted_atts, self.pool
-            )
-            adjusted_atts.append(att)
-            if output_each_step:
-                curr_syn_pop.to_csv(
-                    output_dir / f"syn_pop_adjusted_{att}{extra_name}.csv"
+        self.tracker = None
+        # one seed for the whole run, drawn here if not given so the workers do not use their own
+        seed = run_seed(self.seed)
+        if self.seed is None:
+            print(f"SAA run seed: {seed}")
+        # the workers (holding the pool) are shared by all the atts
+        executor = None
+        run_store = None
+        if self.n_workers > 1:
+            run_store = self.pool_store if self.pool_store is not None else SharedPoolStore()
+            executor = create_zone_executor(self.pool, self.n_workers, run_store)
+        try:
+            for att in self.ordered_atts_to_adjust:
+                sub_census = self.segmented_marg[att].reset_index()
+                sub_census = pl.from_pandas(sub_census)
+                curr_syn_pop = adjust_atts_state_match_census(
+                    att,
+                    curr_syn_pop,
+                    sub_census,
+                    adjusted_atts,
+                    self.pool,
+                    n_workers=self.n_workers,
+                    chunk_size=self.chunk_size,
+                    seed=seed,
+                    executor=executor,
+                    ILP_options=self.ILP_options,
+                    tracker=self.tracker,
                 )
-        return curr_syn_pop
+                if self.track_marginals and self.tracker is None:
+                    # after the init, the pop has all the atts of the pool
+                    self.tracker = MarginalTracker.from_pop(
+                        curr_syn_pop,
+                        [x for x in self.pool.columns if x != count_field],
+                        debug=self.debug_marginals,
+                    )
+                adjusted_atts.append(att)
+                if output_each_step:
+                    save_frame(
+                        curr_syn_pop.to_frame(),
+                        output_dir / f"syn_pop_adjusted_{att}{extra_name}.parquet",
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if run_store is not None and run_store is not self.pool_store:
+                run_store.close()
+        return curr_syn_pop.to_frame()
@@ -6,12 +6,21 @@ Should we include the check here as well (check whether we can del that values o
 
 import polars as pl
 from PopSynthesis.Methods.IPSF.const import zone_field, count_field
+from PopSynthesis.Methods.IPSF.utils.zone_partition import ZonePartitionedPop
+from typing import Union
 
 
 def calculate_states_diff(
-    att: str, syn_pop: pl.DataFrame, sub_census: pl.DataFrame
+    att: str,
+    syn_pop: Union[pl.DataFrame, ZonePartitionedPop],
+    sub_census: pl.DataFrame,
 ) -> pl.DataFrame:
     """ This calculate the differences between current syn_pop and the census at a specific geo_lev """
+    if isinstance(syn_pop, ZonePartitionedPop):
+        # only need the 2 cols, no need to copy the partitions into one frame
+        syn_pop = pl.concat(
+            [df.select(zone_field, att) for _, df in syn_pop.items()], rechunk=False
+        )
     sub_syn_pop_count = syn_pop.group_by([zone_field, att]).len(name=count_field)
     tranformed_sub_syn_count = sub_syn_pop_count.pivot(
         index=zone_field, columns=att, values=count_field
@@ -45,4 +54,6 @@ def calculate_states_diff(
     results = sub_census - tranformed_sub_syn_count
     # no nan values
     assert not results.isna().any().any()
+    # alignment can sort the rows/cols, keep the census order so the outputs are deterministic
+    results = results.loc[sub_census.index, sub_census.columns]
     return pl.from_pandas(results.reset_index())
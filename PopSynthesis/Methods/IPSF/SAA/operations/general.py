@@ -4,12 +4,17 @@ import polars as pl
 import pandas as pd
 import numpy as np
 
-from typing import List, Union, Tuple, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Union, Tuple, Dict, Any
 from PopSynthesis.Methods.IPSF.const import count_field, zone_field
 from PopSynthesis.Methods.IPSF.SAA.operations.compare_census import calculate_states_diff
-from PopSynthesis.Methods.IPSF.SAA.operations.ILP_zone_ad import ILP_zone_adjustment
-from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
-import sys
+from PopSynthesis.Methods.IPSF.SAA.operations.zone_scheduler import adjust_zones
+from PopSynthesis.Methods.IPSF.utils.zone_partition import ZonePartitionedPop
+from PopSynthesis.Methods.IPSF.utils.marginal_tracker import MarginalTracker
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import (
+    get_ILP_path_counts,
+    get_ILP_model_sizes,
+)
 
 
 def process_raw_ipu_marg(
@@ -39,80 +44,137 @@ def process_raw_ipu_init(
 
 
 def sample_from_pl(
-    df: pl.DataFrame, n: int, count_field: str = count_field, with_replacement=True
+    df: pl.DataFrame,
+    n: int,
+    count_field: str = count_field,
+    with_replacement=True,
+    rng: Union[None, np.random.Generator] = None,
 ) -> pl.DataFrame:
     # Normalize weights to sum to 1
     weights = df[count_field].to_numpy()
     weights = weights / weights.sum()
-    sample_indices = np.random.choice(
-        df.height, size=n, replace=with_replacement, p=weights
-    )
+    choice = np.random.choice if rng is None else rng.choice
+    sample_indices = choice(df.height, size=n, replace=with_replacement, p=weights)
     return df[sample_indices.tolist()]
 
 
 def init_syn_pop_saa(
-    att: str, marginal_data: pl.DataFrame, pool: pl.DataFrame
-) -> pl.DataFrame:
+    att: str,
+    marginal_data: pl.DataFrame,
+    pool: pl.DataFrame,
+    rng: Union[None, np.random.Generator] = None,
+) -> ZonePartitionedPop:
+    """Sample the first att for all zones x states in one batched draw"""
     assert zone_field in marginal_data
-    states = list(pool[att].unique())
-    assert set(states + [zone_field]) == set(marginal_data.columns)
+    states = list(pool[att].unique(maintain_order=True))
+    # census cols are str, the states can be codes (see CategoricalDictionary)
+    state_cols = [str(s) for s in states]
+    assert set(state_cols + [zone_field]) == set(marginal_data.columns)
 
     if count_field not in pool.columns:
         pool = pool.with_columns([pl.lit(1).alias(count_field)])
 
-    sub_pops = []
-    for state in states:
-        sub_pool = pool.filter(pl.col(att) == state)
-        if len(sub_pool) == 0:
-            print(f"WARNING: cannot see {att}_{state} in the pool, sample by the rest")
-            sub_pool = pool  # if there are none, we take all
-        for zone in marginal_data[zone_field]:
-            condition = marginal_data.filter(pl.col(zone_field) == zone)
-            census_val = condition.select(state).to_numpy()[0, 0]
-
-            sub_syn_pop = sample_from_pl(sub_pool, census_val)
-
-            sub_syn_pop = sub_syn_pop.with_columns([pl.lit(zone).alias(zone_field)])
-            sub_syn_pop = sub_syn_pop.drop(count_field)
+    weights = pool[count_field].to_numpy().astype(float)
+    pool_states = pool[att].to_numpy()
+    # zones x states, the number to sample for each
+    census_vals = (
+        marginal_data.select(state_cols).fill_null(0).fill_nan(0).to_numpy().astype(int)
+    )
+    zone_pos = np.arange(len(marginal_data))
+    uniform = np.random.random if rng is None else rng.random
+
+    ls_pool_idx, ls_zone_pos = [], []
+    for i, state in enumerate(states):
+        # cumulative weights of the state once, then searchsorted for all the zones
+        sub_pool_idx = np.flatnonzero(pool_states == state)
+        cum_weights = np.cumsum(weights[sub_pool_idx])
+        n_draws = census_vals[:, i].sum()
+        draws = np.searchsorted(
+            cum_weights, uniform(n_draws) * cum_weights[-1], side="right"
+        )
+        draws = np.minimum(draws, len(sub_pool_idx) - 1)  # float edge case
+        ls_pool_idx.append(sub_pool_idx[draws])
+        ls_zone_pos.append(np.repeat(zone_pos, census_vals[:, i]))
+    pool_idx = np.concatenate(ls_pool_idx)
+    zone_idx = np.concatenate(ls_zone_pos)
 
-            sub_pops.append(sub_syn_pop)
-    return pl.concat(sub_pops)
+    # group by zone (stable, so states stay in order in each zone) then 1 gather
+    order = np.argsort(zone_idx, kind="stable")
+    syn_pop = pool.drop(count_field)[pool_idx[order]]
+    syn_pop = syn_pop.with_columns(marginal_data[zone_field].gather(zone_idx[order]))
+    return ZonePartitionedPop.from_frame(syn_pop)
 
 
 def adjust_atts_state_match_census(
     att: str,
-    curr_syn_pop: Union[None, pl.DataFrame],
+    curr_syn_pop: Union[None, pl.DataFrame, ZonePartitionedPop],
     census_data_by_att: pl.DataFrame,
     adjusted_atts: List[str],
     pool_count: pl.DataFrame,
-) -> pd.DataFrame:
+    n_workers: int = 1,
+    chunk_size: int = 50,
+    seed: Union[None, int] = None,
+    executor: Union[None, ProcessPoolExecutor] = None,
+    ILP_options: Union[None, Dict[str, Any]] = None,
+    tracker: Union[None, MarginalTracker] = None,
+) -> ZonePartitionedPop:
+    """Adjust the syn pop so att matches the census, zone by zone
+
+    If a tracker of curr_syn_pop is given, the states diff is read from it (no regrouping
+    of the whole pop) and it is updated with the replaced zones
+    """
     print(f"ADJUSTING FOR {att}")
     if curr_syn_pop is None:
-        updated_syn_pop = init_syn_pop_saa(att, census_data_by_att, pool_count)
-    else:
-        states_diff_census = calculate_states_diff(
-            att, curr_syn_pop, census_data_by_att
+        init_rng = None if seed is None else np.random.default_rng(seed)
+        updated_syn_pop = init_syn_pop_saa(
+            att, census_data_by_att, pool_count, rng=init_rng
         )
+    else:
+        if isinstance(curr_syn_pop, pl.DataFrame):
+            curr_syn_pop = ZonePartitionedPop.from_frame(curr_syn_pop)
+        if tracker is None:
+            states_diff_census = calculate_states_diff(
+                att, curr_syn_pop, census_data_by_att
+            )
+        else:
+            states_diff_census = tracker.states_diff(att, census_data_by_att)
         assert (states_diff_census.select(pl.exclude([zone_field])).sum_horizontal()==0).all()
-        # With state diff we can now do adjustment for each zone, can parallel it?
-        pop_syn_across_zones = []
-        records_err = {}
+        # With state diff we can now do adjustment for each zone, each zone is independent
+        zone_tasks = []
         for zone_marg in states_diff_census.iter_rows(named=True):
             zid = zone_marg.pop(zone_field)
-            sys.stdout.write(f"\rDOING zone {zid}")
-            sys.stdout.flush()
-            sub_syn_pop = curr_syn_pop.filter(pl.col(zone_field) == zid)
-            if not sub_syn_pop.is_empty():
-                condensed_syn = condense_df(sub_syn_pop)
-                zone_adjusted_syn_pop, err_remain = ILP_zone_adjustment(
-                    att, condensed_syn, zone_marg, pool_count, adjusted_atts
-                )
-                records_err[zid] = err_remain
-                if zone_adjusted_syn_pop is not None:
-                    assert len(zone_adjusted_syn_pop) == len(sub_syn_pop)
-                    pop_syn_across_zones.append(zone_adjusted_syn_pop)
-        print()
-        updated_syn_pop = pl.concat(pop_syn_across_zones)
+            sub_syn_pop = curr_syn_pop.get(zid)
+            if sub_syn_pop is not None:
+                zone_tasks.append((zid, sub_syn_pop, zone_marg))
+        path_counts_before = get_ILP_path_counts()
+        model_sizes_before = get_ILP_model_sizes()
+        adjusted_zones, records_err = adjust_zones(
+            att,
+            zone_tasks,
+            pool_count,
+            adjusted_atts,
+            n_workers=n_workers,
+            chunk_size=chunk_size,
+            seed=seed,
+            executor=executor,
+            ILP_options=ILP_options,
+        )
+        print(f"Remaining err for {att}: {sum(records_err.values())}")
+        print(f"Zones by path for {att}: {dict(get_ILP_path_counts() - path_counts_before)}")
+        model_sizes = get_ILP_model_sizes() - model_sizes_before
+        if model_sizes["models"] > 0:
+            print(
+                f"ILP size per zone for {att}: "
+                f"{model_sizes['variables'] / model_sizes['models']:.1f} variables, "
+                f"{model_sizes['constraints'] / model_sizes['models']:.1f} constraints"
+            )
+        updated_syn_pop = ZonePartitionedPop(adjusted_zones)
         assert len(updated_syn_pop) == len(curr_syn_pop)
+        if tracker is not None:
+            tracker.replace_zones(
+                {zid: sub_syn_pop for zid, sub_syn_pop, _ in zone_tasks}, adjusted_zones
+            )
+            if tracker.debug:
+                tracker.check(updated_syn_pop)
 
     return updated_syn_pop
@@ -7,58 +7,75 @@ from PopSynthesis.Methods.IPSF.const import (
     small_test_dir,
     processed_dir,
     zone_field,
+    count_field,
 )
 from PopSynthesis.Methods.IPSF.utils.synthetic_checked_census import (
     adjust_kept_rec_match_census,
-    get_diff_marg,
-    convert_full_to_marg_count,
 )
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    wide_to_long_marg,
+    long_to_wide_marg,
+)
+from PopSynthesis.Methods.IPSF.utils.marginal_tracker import MarginalTracker
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.storage import read_frame, read_marginal
 from PopSynthesis.Methods.IPSF.SAA.SAA import SAA
 import polars as pl
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Dict, Any
 import random
 
 
 def get_test_hh() -> Tuple[pd.DataFrame, pd.DataFrame]:
-    hh_marg = pd.read_csv(small_test_dir / "hh_marginals_small.csv", header=[0, 1])
-    hh_marg = hh_marg.set_index(
-        hh_marg.columns[hh_marg.columns.get_level_values(0) == zone_field][0]
-    )
-    pool = pd.read_csv(small_test_dir / "HH_pool_small_test.csv")
+    hh_marg = read_marginal(small_test_dir / "hh_marginals_small.csv")
+    pool = read_frame(small_test_dir / "HH_pool_small_test.csv")
     return hh_marg, pool
 
 
 def get_hh_data() -> Tuple[pd.DataFrame, pd.DataFrame]:
-    hh_marg = pd.read_csv(data_dir / "hh_marginals_ipu.csv", header=[0, 1])
-    hh_marg = hh_marg.drop(
-        columns=hh_marg.columns[hh_marg.columns.get_level_values(0) == "sample_geog"][0]
-    ).set_index(hh_marg.columns[hh_marg.columns.get_level_values(0) == zone_field][0])
-    pool = pd.read_csv(processed_dir / "HH_pool.csv")
+    hh_marg = read_marginal(data_dir / "hh_marginals_ipu.csv")
+    pool = read_frame(processed_dir / "HH_pool.csv")
     return hh_marg, pool
 
 
 def err_check_against_marg(
-    syn_pop: pd.DataFrame, marg: pd.DataFrame, extra_rm_frac: float = 0
+    syn_pop: pd.DataFrame,
+    marg: pd.DataFrame,
+    extra_rm_frac: float = 0,
+    tracker: Union[None, MarginalTracker] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Delete the records above the census, output the kept and the remaining census
+
+    tracker holds the marginals of syn_pop (e.g. from the SAA run), it is updated with the
+    removed records instead of counting the kept ones again
+    """
     # rm extra first
     assert extra_rm_frac <= 1 and extra_rm_frac >= 0
     remain_syn = syn_pop
     remain_syn = remain_syn.sample(frac=1-extra_rm_frac)
     print(f"removed first {len(syn_pop) - len(remain_syn)} hh")
 
-    marg_from_created = convert_full_to_marg_count(remain_syn, [zone_field])
-    converted_marg = marg
-    diff_marg = get_diff_marg(converted_marg, marg_from_created)
+    # long format for the checking, the wide diff only for the deletion and the next run
+    atts = [x for x in remain_syn.columns if x != zone_field]
+    if tracker is None:
+        tracker = MarginalTracker.from_pop(remain_syn, atts)
+    else:
+        tracker.add_records(syn_pop.drop(index=remain_syn.index), sign=-1)
+    census_long = wide_to_long_marg(marg)
+    diff_long = tracker.diff_long(census_long)
 
-    kept_syn = adjust_kept_rec_match_census(remain_syn, diff_marg)
+    kept_syn, deleted_syn = adjust_kept_rec_match_census(
+        remain_syn, long_to_wide_marg(diff_long), return_deleted=True
+    )
 
     # checking
-    kept_marg = convert_full_to_marg_count(kept_syn, [zone_field])
-    new_diff_marg = get_diff_marg(converted_marg, kept_marg)
+    tracker.add_records(deleted_syn, sign=-1)
+    if tracker.debug:
+        tracker.check(kept_syn)
+    new_diff_long = tracker.diff_long(census_long)
     # check it is no neg indeed
-    checking_not_neg = new_diff_marg < 0
-    assert checking_not_neg.any(axis=None) == False
+    assert (new_diff_long[count_field] >= 0).all()
     # now get the new marg
+    new_diff_marg = long_to_wide_marg(new_diff_long)
     new_diff_marg.index = new_diff_marg.index.astype(int)
     new_diff_marg.index.name = zone_field
     return kept_syn, new_diff_marg
@@ -90,8 +107,22 @@ def saa_run(
     max_run_time: int = 30,
     extra_rm_frac: float = 0,
     output_each_step: bool = False,
+    n_workers: int = 1,
+    chunk_size: int = 50,
+    seed: Union[None, int] = None,
+    ILP_options: Union[None, Dict[str, Any]] = None,
+    categories: Union[None, CategoricalDictionary] = None,
+    debug_marginals: bool = False,
 ) -> Tuple[pd.DataFrame, List[int]]:
+    """Run SAA until the census is matched (or max_run_time)
+
+    If categories is given, the pool and the census are encoded to the state codes for the
+    whole run and the final syn pop is decoded back to the state names
+    """
     assert set(ordered_to_adjust_atts) <= set(considered_atts)
+    if categories is not None:
+        count_pool = categories.encode(count_pool)
+        targeted_marg = categories.encode_marginal(targeted_marg)
     atts_in_marg = set(targeted_marg.columns.get_level_values(0)) - {zone_field}
     assert set(ordered_to_adjust_atts) <= atts_in_marg
     assert zone_field in targeted_marg.index.name
@@ -110,13 +141,25 @@ def saa_run(
         print(
             f"For run {n_run_time}, order is: {ordered_to_adjust_atts}, aim for {n_removed_err} HHs"
         )
-        saa = SAA(targeted_marg, considered_atts, ordered_to_adjust_atts, count_pool)
+        saa = SAA(
+            targeted_marg,
+            considered_atts,
+            ordered_to_adjust_atts,
+            count_pool,
+            n_workers=n_workers,
+            chunk_size=chunk_size,
+            seed=seed,
+            ILP_options=ILP_options,
+            debug_marginals=debug_marginals,
+        )
         ### Actual running to get the synthetic pop
         final_syn_pop = saa.run(extra_name=f"_{n_run_time}", output_each_step=output_each_step)
         assert len(final_syn_pop) == n_removed_err
         ###
         to_check_syn = final_syn_pop.to_pandas()
-        kept_syn, new_marg = err_check_against_marg(to_check_syn, targeted_marg, extra_rm_frac)
+        kept_syn, new_marg = err_check_against_marg(
+            to_check_syn, targeted_marg, extra_rm_frac, tracker=saa.tracker
+        )
 
         n_run_time += 1
         # append to the chosen
@@ -128,6 +171,8 @@ def saa_run(
             # continue with adjusting for missing
             chosen = pl.from_pandas(kept_syn)
             chosen = chosen.with_columns(pl.col(zone_field).cast(pl.String))
+            # back to the (polars) types of the syn pop
+            chosen = chosen.cast({att: final_syn_pop.schema[att] for att in considered_atts})
             chosen_syn.append(chosen)
 
         # Update for next run
@@ -135,4 +180,6 @@ def saa_run(
         targeted_marg = new_marg
 
     final_syn_hh = pl.concat([df.select(considered_atts+[zone_field]) for df in chosen_syn])
+    if categories is not None:
+        final_syn_hh = categories.decode(final_syn_hh)
     return final_syn_hh, err_rm
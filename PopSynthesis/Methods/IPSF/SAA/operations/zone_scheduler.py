@@ -0,0 +1,263 @@
+"""
+Scheduling the per zone adjustment of SAA, serially or across a process pool
+
+Each zone is adjusted independently (the ILP only sees the zone syn and the pool),
+so we can split the zones into chunks and send them to workers.
+The pool is sent once to each worker via the initializer, not with every chunk,
+the same executor can be reused for all the atts of a SAA run. With a SharedPoolStore only
+the handle is sent, the workers attach to the memory mapped pool (no copy per worker).
+The pool indexes of an att (feasibility, sampling) are built once per att, in each worker.
+Each zone gets its own generator derived from (seed, att, zone), so the results do not
+depend on the number of workers or the chunking. Without a seed, one is drawn in the main
+process (run_seed) and sent to the workers, not left to their own global numpy states.
+The counts of the ILP paths and model sizes in the workers are merged back into the main process.
+If the ILP cache is set up in the main process, each worker sets up its own with the
+same settings (a disk folder is then shared by all workers).
+"""
+
+import sys
+import zlib
+import multiprocessing as mp
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.SAA.operations.ILP_zone_ad import (
+    ILP_zone_adjustment,
+    build_feasibility_index,
+)
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from PopSynthesis.Methods.IPSF.utils.pool_sampling import PoolSamplingIndex
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import SharedPoolStore, PoolHandle
+from PopSynthesis.Methods.IPSF.utils.ILP_cache import configure_ILP_cache, get_ILP_cache
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import (
+    get_ILP_path_counts,
+    add_ILP_path_counts,
+    get_ILP_model_sizes,
+    add_ILP_model_sizes,
+)
+from typing import List, Dict, Tuple, Union, Any
+
+# (zone id, syn pop of that zone, states diff of that zone)
+ZoneTask = Tuple[Any, pl.DataFrame, Dict[str, int]]
+ZoneResult = Tuple[Any, Union[None, pl.DataFrame], float]
+# (feasibility index, sampling index) of the pool for an att
+AttPoolIndexes = Tuple[pl.DataFrame, PoolSamplingIndex]
+
+# Hold the shared inputs inside each worker process
+_WORKER_INPUTS = {}
+
+
+def run_seed(seed: Union[None, int]) -> int:
+    """The seed of the run, a fresh one from the OS entropy if None (call in the main process)"""
+    return np.random.SeedSequence().entropy if seed is None else seed
+
+
+def zone_rng(
+    seed: Union[None, int], att: str, zid: Any
+) -> Union[None, np.random.Generator]:
+    """Deterministic generator for a zone, from the run seed and the att and zone
+
+    adjust_zones always gives the run seed (drawn in the main process by run_seed if
+    none is given), None is only left by direct calls of adjust_one_zone (global state)
+    """
+    if seed is None:
+        return None
+    # crc32 is stable across processes, unlike hash() of str
+    entropy = [seed, zlib.crc32(att.encode()), zlib.crc32(str(zid).encode())]
+    return np.random.default_rng(np.random.SeedSequence(entropy))
+
+
+def build_att_indexes(
+    pool_count: pl.DataFrame, att: str, adjusted_atts: List[str]
+) -> AttPoolIndexes:
+    """The pool indexes used by all the zones when adjusting att"""
+    return (
+        build_feasibility_index(pool_count, att, adjusted_atts),
+        PoolSamplingIndex(pool_count, adjusted_atts + [att]),
+    )
+
+
+def adjust_one_zone(
+    att: str,
+    task: ZoneTask,
+    pool_count: pl.DataFrame,
+    adjusted_atts: List[str],
+    seed: Union[None, int] = None,
+    ILP_options: Union[None, Dict[str, Any]] = None,
+    att_indexes: Union[None, AttPoolIndexes] = None,
+) -> ZoneResult:
+    zid, sub_syn_pop, zone_marg = task
+    feasibility, sampling_index = None, None
+    if att_indexes is not None:
+        feasibility, sampling_index = att_indexes
+    condensed_syn = condense_df(sub_syn_pop)
+    zone_adjusted_syn_pop, err_remain = ILP_zone_adjustment(
+        att,
+        condensed_syn,
+        zone_marg,
+        pool_count,
+        adjusted_atts,
+        rng=zone_rng(seed, att, zid),
+        ILP_options=ILP_options,
+        feasibility=feasibility,
+        sampling_index=sampling_index,
+    )
+    if zone_adjusted_syn_pop is not None:
+        assert len(zone_adjusted_syn_pop) == len(sub_syn_pop)
+    return zid, zone_adjusted_syn_pop, err_remain
+
+
+def _init_zone_worker(
+    pool_count: Union[pl.DataFrame, PoolHandle],
+    cache_config: Union[None, Dict[str, Any]] = None,
+) -> None:
+    if isinstance(pool_count, PoolHandle):
+        pool_count = pool_count.attach()
+    _WORKER_INPUTS["pool_count"] = pool_count
+    if cache_config is not None:
+        configure_ILP_cache(**cache_config)
+
+
+def _worker_att_indexes(att: str, adjusted_atts: List[str]) -> AttPoolIndexes:
+    # atts are adjusted one after the other, only keep the indexes of the current one
+    key = (att, tuple(adjusted_atts))
+    if _WORKER_INPUTS.get("att_indexes_key") != key:
+        _WORKER_INPUTS["att_indexes"] = build_att_indexes(
+            _WORKER_INPUTS["pool_count"], att, adjusted_atts
+        )
+        _WORKER_INPUTS["att_indexes_key"] = key
+    return _WORKER_INPUTS["att_indexes"]
+
+
+def _adjust_zone_chunk(
+    att: str,
+    adjusted_atts: List[str],
+    seed: Union[None, int],
+    ILP_options: Union[None, Dict[str, Any]],
+    chunk: List[ZoneTask],
+) -> Tuple[List[ZoneResult], Counter, Counter]:
+    pool_count = _WORKER_INPUTS["pool_count"]
+    att_indexes = _worker_att_indexes(att, adjusted_atts)
+    counts_before = get_ILP_path_counts()
+    sizes_before = get_ILP_model_sizes()
+    results = [
+        adjust_one_zone(
+            att, task, pool_count, adjusted_atts, seed, ILP_options, att_indexes
+        )
+        for task in chunk
+    ]
+    return (
+        results,
+        get_ILP_path_counts() - counts_before,
+        get_ILP_model_sizes() - sizes_before,
+    )
+
+
+def create_zone_executor(
+    pool_count: pl.DataFrame,
+    n_workers: int,
+    pool_store: Union[None, SharedPoolStore] = None,
+) -> ProcessPoolExecutor:
+    """Process pool holding the pool in each worker, can be reused across atts
+
+    With pool_store, the pool is published there and the workers attach to it
+    """
+    # spawn so the workers do not inherit the polars thread pool
+    cache = get_ILP_cache()
+    cache_config = None if cache is None else cache.config()
+    worker_pool = pool_count
+    if pool_store is not None:
+        worker_pool = pool_store.publish("SAA_pool", pool_count)
+        # the workers of the previous runs are done with the older versions
+        pool_store.release("SAA_pool", keep_last=1)
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_zone_worker,
+        initargs=(worker_pool, cache_config),
+    )
+
+
+def segment_tasks(tasks: List[ZoneTask], chunk_size: int) -> List[List[ZoneTask]]:
+    assert chunk_size > 0
+    return [tasks[i : i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+
+def adjust_zones(
+    att: str,
+    tasks: List[ZoneTask],
+    pool_count: pl.DataFrame,
+    adjusted_atts: List[str],
+    n_workers: int = 1,
+    chunk_size: int = 50,
+    seed: Union[None, int] = None,
+    executor: Union[None, ProcessPoolExecutor] = None,
+    ILP_options: Union[None, Dict[str, Any]] = None,
+) -> Tuple[Dict[Any, pl.DataFrame], Dict[Any, float]]:
+    """Run the ILP adjustment for all zones, output (by zone) in the same order as tasks
+
+    The executor must be created with the same pool (see create_zone_executor),
+    if not given a temporary one is created when n_workers > 1.
+    seed None draws one here for all the zones (see run_seed)
+    """
+    assert n_workers >= 1
+    seed = run_seed(seed)
+    results = []
+    if n_workers == 1:
+        # the same for all zones, only depends on the pool
+        att_indexes = build_att_indexes(pool_count, att, adjusted_atts)
+        for task in tasks:
+            sys.stdout.write(f"\rDOING zone {task[0]}")
+            sys.stdout.flush()
+            results.append(
+                adjust_one_zone(
+                    att,
+                    task,
+                    pool_count,
+                    adjusted_atts,
+                    seed,
+                    ILP_options,
+                    att_indexes,
+                )
+            )
+    else:
+        chunks = segment_tasks(tasks, chunk_size)
+        own_executor = executor is None
+        if own_executor:
+            executor = create_zone_executor(pool_count, n_workers)
+        try:
+            # map keeps the order of the chunks
+            chunks_results = executor.map(
+                partial(
+                    _adjust_zone_chunk,
+                    att,
+                    adjusted_atts,
+                    seed,
+                    ILP_options,
+                ),
+                chunks,
+            )
+            for i, (chunk_results, path_counts, model_sizes) in enumerate(
+                chunks_results
+            ):
+                sys.stdout.write(f"\rDONE chunk {i + 1}/{len(chunks)}")
+                sys.stdout.flush()
+                results.extend(chunk_results)
+                add_ILP_path_counts(path_counts)
+                add_ILP_model_sizes(model_sizes)
+        finally:
+            if own_executor:
+                executor.shutdown()
+    print()
+
+    adjusted_zones = {}
+    records_err = {}
+    for zid, zone_adjusted_syn_pop, err_remain in results:
+        records_err[zid] = err_remain
+        if zone_adjusted_syn_pop is not None:
+            adjusted_zones[zid] = zone_adjusted_syn_pop
+    return adjusted_zones, records_err
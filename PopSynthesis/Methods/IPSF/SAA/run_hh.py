@@ -2,6 +2,7 @@
 
 from PopSynthesis.Methods.IPSF.const import (
     output_dir,
+    processed_dir,
     SAA_ODERED_ATTS_HH,
     CONSIDERED_ATTS_HH,
 )
@@ -10,12 +11,18 @@ from PopSynthesis.Methods.IPSF.SAA.operations.wrapper_saa_run import (
     get_hh_data,
 )
 from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame
 import time
 
 
 def run_main() -> None:
     hh_marg, hh_pool = get_hh_data()
     condensed_hh_pool = condense_df(hh_pool)
+    # run on the state codes, decoded at output
+    hh_categories = CategoricalDictionary.from_pickles(
+        processed_dir / "dict_hh_states.pickle"
+    )
 
     start_time = time.time()
     # saa run
@@ -26,6 +33,7 @@ def run_main() -> None:
         ordered_to_adjust_atts=SAA_ODERED_ATTS_HH,
         max_run_time=15,
         shuffle_order=True,
+        categories=hh_categories,
     )
 
     # record time
@@ -36,7 +44,8 @@ def run_main() -> None:
     print(f"Processing took {int(hours)}h-{int(minutes)}m-{seconds:.2f}s")
     print(f"Error hh rm are: {err_rm}")
     # output
-    final_syn_hh.write_csv(output_dir / "SAA_HH_IPL_abs_no_order_no_penal.csv")
+    # CSV only if needed, with storage.export_csv
+    save_frame(final_syn_hh, output_dir / "SAA_HH_IPL_abs_no_order_no_penal.parquet")
 
 
 if __name__ == "__main__":
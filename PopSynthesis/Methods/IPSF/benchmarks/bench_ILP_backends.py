@@ -0,0 +1,45 @@
+"""Compare the ILP backends (HiGHS sparse matrix vs PuLP/CBC) on the large count table"""
+
+from pathlib import Path
+import time
+
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import (
+    update_count_tables,
+    ILP_BACKENDS,
+)
+
+data_folder = (
+    Path(__file__).parent.parent.parent.parent.resolve() / "tests" / "test_data" / "IPL"
+)
+
+
+def run_main(n_repeat: int = 3) -> None:
+    count_table = pl.read_csv(data_folder / "large_count_table.csv").with_row_index(
+        name="row_id"
+    )
+    states_diff = pl.read_csv(data_folder / "large_states_diff.csv").row(0, named=True)
+    print(f"Count table of {count_table.shape}, diff: {states_diff}")
+
+    for deviation_type in ["absolute", "relative"]:
+        for backend in ILP_BACKENDS:
+            ls_time = []
+            for _ in range(n_repeat):
+                start_time = time.time()
+                _, err_score = update_count_tables(
+                    count_table,
+                    states_diff,
+                    "row_id",
+                    deviation_type=deviation_type,
+                    backend=backend,
+                )
+                ls_time.append(time.time() - start_time)
+            print(
+                f"{backend} ({deviation_type}): best {min(ls_time):.3f}s, "
+                f"mean {sum(ls_time) / n_repeat:.3f}s, remaining err {err_score:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    run_main()
@@ -0,0 +1,61 @@
+"""Compare the flow engine against the ILP (runtime and remaining error) on random count tables"""
+
+import time
+
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import update_count_tables
+from typing import Dict, Tuple
+
+
+def random_count_table(
+    n_rows: int, n_cols: int, seed: int, null_frac: float = 0.3
+) -> Tuple[pl.DataFrame, Dict[str, int]]:
+    """Count table with some impossible cells and a states_diff summing to 0"""
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 20, size=(n_rows, n_cols)).astype(float)
+    values[rng.random((n_rows, n_cols)) < null_frac] = np.nan
+    columns = [f"s{j}" for j in range(n_cols)]
+    count_table = pl.DataFrame(
+        {
+            col: pl.Series(values[:, j]).fill_nan(None).cast(pl.Int32)
+            for j, col in enumerate(columns)
+        }
+    ).with_row_index(name="row_id")
+    # cannot remove more than the column total
+    diffs = rng.integers(-3 * n_rows // 10, 3 * n_rows // 10 + 1, size=n_cols)
+    diffs = np.maximum(diffs, -np.nansum(values, axis=0).astype(int))
+    diffs[-1] = -diffs[:-1].sum()
+    return count_table, dict(zip(columns, diffs.tolist()))
+
+
+def run_main(n_repeat: int = 3) -> None:
+    # the sparse one cannot always be fully matched
+    for n_rows, n_cols, null_frac in [(20, 5, 0.3), (30, 8, 0.8), (200, 17, 0.3), (1000, 20, 0.3)]:
+        for deviation_type in ["absolute", "relative"]:
+            for engine in ["ILP", "flow"]:
+                ls_time, ls_err = [], []
+                for seed in range(n_repeat):
+                    count_table, states_diff = random_count_table(
+                        n_rows, n_cols, seed, null_frac
+                    )
+                    start_time = time.time()
+                    _, err_score = update_count_tables(
+                        count_table,
+                        states_diff,
+                        "row_id",
+                        deviation_type=deviation_type,
+                        engine=engine,
+                    )
+                    ls_time.append(time.time() - start_time)
+                    ls_err.append(err_score)
+                print(
+                    f"{n_rows}x{n_cols} ({null_frac} null) {engine} ({deviation_type}): "
+                    f"mean {sum(ls_time) / n_repeat:.3f}s, "
+                    f"mean remaining err {sum(ls_err) / n_repeat:.3f}"
+                )
+
+
+if __name__ == "__main__":
+    run_main()
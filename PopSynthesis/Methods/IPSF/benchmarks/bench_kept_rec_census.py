@@ -0,0 +1,78 @@
+"""Runtime of adjust_kept_rec_match_census vs the former version (iterrows on the MultiIndex)
+
+Uses the full HH marginals: a syn pop is sampled from the pool for each zone (the census
+totals, hhsize only), the other atts are then off the census as after a SAA round.
+The former version is the reference kept in its test.
+"""
+
+import importlib.util
+import io
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from PopSynthesis.Methods.IPSF.const import zone_field, CONSIDERED_ATTS_HH
+from PopSynthesis.Methods.IPSF.SAA.operations.wrapper_saa_run import get_hh_data
+from PopSynthesis.Methods.IPSF.utils.synthetic_checked_census import (
+    adjust_kept_rec_match_census,
+    convert_full_to_marg_count,
+    get_diff_marg,
+)
+from typing import Callable, Tuple, Union
+
+test_file = (
+    Path(__file__).parent.parent.parent.parent.resolve()
+    / "tests"
+    / "IPSF"
+    / "SAA"
+    / "test_kept_rec_census.py"
+)
+
+
+def get_legacy_func() -> Callable[[pd.DataFrame, pd.DataFrame], pd.DataFrame]:
+    spec = importlib.util.spec_from_file_location("test_kept_rec_census", test_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.legacy_adjust_kept_rec_match_census
+
+
+def syn_pop_from_pool(
+    hh_marg: pd.DataFrame, pool: pd.DataFrame, seed: int
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Syn pop with the census number of hh in each zone and its diff with the census"""
+    rng = np.random.default_rng(seed)
+    n_hh = hh_marg[hh_marg.columns[hh_marg.columns.get_level_values(0) == "hhsize"]]
+    n_hh = n_hh.sum(axis=1).astype(int)
+    pool = pool[CONSIDERED_ATTS_HH]
+    syn_pop = pool.iloc[rng.integers(0, len(pool), size=n_hh.sum())].reset_index(drop=True)
+    syn_pop[zone_field] = np.repeat(n_hh.index.values, n_hh.values)
+    marg_from_syn = convert_full_to_marg_count(syn_pop.copy(), [zone_field])
+    diff_marg = get_diff_marg(hh_marg.copy(), marg_from_syn)
+    return syn_pop, diff_marg
+
+
+def run_main(n_zones: Union[None, int] = None, seed: int = 0) -> None:
+    """n_zones None is all the zones of the marginals"""
+    hh_marg, pool = get_hh_data()
+    if n_zones is not None:
+        hh_marg = hh_marg.iloc[:n_zones]
+    syn_pop, diff_marg = syn_pop_from_pool(hh_marg, pool, seed)
+    print(f"{len(diff_marg)} zones, {len(syn_pop)} hh")
+
+    results = {}
+    for name, func in [
+        ("current", adjust_kept_rec_match_census),
+        ("former", get_legacy_func()),
+    ]:
+        start_time = time.time()
+        with redirect_stdout(io.StringIO()):
+            results[name] = func(syn_pop.copy(), diff_marg.copy())
+        print(f"{name}: {time.time() - start_time:.2f}s, kept {len(results[name])} hh")
+    assert results["current"].astype(str).equals(results["former"])
+
+
+if __name__ == "__main__":
+    run_main()
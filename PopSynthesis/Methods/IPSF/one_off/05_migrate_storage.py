@@ -0,0 +1,9 @@
+"""Convert the CSV/pickle inputs to parquet (see utils/storage), the runs then load these"""
+
+from PopSynthesis.Methods.IPSF.const import data_dir, processed_dir, small_test_dir
+from PopSynthesis.Methods.IPSF.utils.storage import migrate_data_dirs
+
+
+if __name__ == "__main__":
+    for path in migrate_data_dirs([data_dir, processed_dir, small_test_dir]):
+        print(f"Stored {path}")
@@ -0,0 +1,213 @@
+"""
+Sparse matrix form of the matrix adjustment ILP, solved with HiGHS via scipy
+
+This is the same model as the PuLP one in ILP_matrix_ad, but the constraint matrix
+is built directly from the cells with numpy/scipy.sparse (no Python object per term)
+and there is no LP file written for each solve.
+
+Variables are stacked as [adjustments, deviations, (activations), slack_pos, slack_neg],
+the cell blocks have one entry per non-null cell, the slacks one per column.
+The activations (and their big-M rows) are only there if spread_penalty > 0.
+"""
+
+import numpy as np
+import polars as pl
+from scipy import sparse
+from typing import Dict, List, Tuple, Union
+
+try:
+    from scipy.optimize import milp, LinearConstraint, Bounds
+except ImportError:  # scipy < 1.9
+    milp = None
+
+EPSILON = 1e-6  # Solve division by zeros
+LARGE_M = 1e6  # Large M value for binary activation variables
+
+
+class ILPMatrices:
+    """Holding the ILP in matrix form, cells are (row position, column position)"""
+
+    def __init__(
+        self,
+        c: np.ndarray,
+        A: sparse.csr_matrix,
+        cons_lb: np.ndarray,
+        cons_ub: np.ndarray,
+        var_lb: np.ndarray,
+        var_ub: np.ndarray,
+        integrality: np.ndarray,
+        cells: np.ndarray,
+    ) -> None:
+        self.c = c
+        self.A = A
+        self.cons_lb = cons_lb
+        self.cons_ub = cons_ub
+        self.var_lb = var_lb
+        self.var_ub = var_ub
+        self.integrality = integrality
+        self.cells = cells
+
+    @property
+    def n_vars(self) -> int:
+        return len(self.c)
+
+    @property
+    def n_cons(self) -> int:
+        return self.A.shape[0]
+
+
+def build_ILP_matrices(
+    values: np.ndarray,
+    columns: List[str],
+    states_diff: Dict[str, int],
+    zero_val_states: List[str],
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+) -> ILPMatrices:
+    """Build the ILP from the (rows x columns) values, NaN means not possible cell"""
+    n_rows, n_cols = values.shape
+    cells = np.argwhere(~np.isnan(values))
+    n_cells = len(cells)
+    cell_rows, cell_cols = cells[:, 0], cells[:, 1]
+    ori_vals = values[cell_rows, cell_cols]
+
+    # index of each block of variables
+    use_activations = spread_penalty > 0
+    n_cell_blocks = 3 if use_activations else 2
+    adj_idx = np.arange(n_cells)
+    dev_idx = adj_idx + n_cells
+    act_idx = adj_idx + 2 * n_cells if use_activations else np.arange(0)
+    slack_pos_idx = np.arange(n_cols) + n_cell_blocks * n_cells
+    slack_neg_idx = slack_pos_idx + n_cols
+    n_vars = n_cell_blocks * n_cells + 2 * n_cols
+
+    # Objective, same weights as summing every cell term with every column term
+    c = np.zeros(n_vars)
+    c[dev_idx] = n_cols
+    c[act_idx] = n_cols * spread_penalty
+    c[slack_pos_idx] = n_cells
+    c[slack_neg_idx] = n_cells
+
+    ls_rows, ls_cols, ls_vals, ls_lb, ls_ub = [], [], [], [], []
+    n_cons = 0
+
+    def add_block(r, v, coefs, n_block, lb, ub):
+        # r is the constraint number (from 0 in this block), v the variable index
+        nonlocal n_cons
+        ls_rows.append(np.asarray(r, dtype=int) + n_cons)
+        ls_cols.append(np.asarray(v, dtype=int))
+        ls_vals.append(np.asarray(coefs, dtype=float))
+        ls_lb.append(np.broadcast_to(np.asarray(lb, dtype=float), n_block))
+        ls_ub.append(np.broadcast_to(np.asarray(ub, dtype=float), n_block))
+        n_cons += n_block
+
+    # Row constraints: the sum of adjustments in each row is zero
+    add_block(cell_rows, adj_idx, np.ones(n_cells), n_rows, 0, 0)
+
+    # Column constraints with positive and negative slack for deviations
+    col_pos = {col: j for j, col in enumerate(columns)}
+    check_cols = np.array(
+        [col_pos[j] for j in states_diff if j not in zero_val_states], dtype=int
+    )
+    targets = np.array([states_diff[columns[j]] for j in check_cols], dtype=float)
+    cons_of_col = np.full(n_cols, -1)
+    cons_of_col[check_cols] = np.arange(len(check_cols))
+    in_check = cons_of_col[cell_cols] >= 0
+    r_slack = np.arange(len(check_cols))
+    add_block(
+        np.concatenate([cons_of_col[cell_cols][in_check], r_slack, r_slack]),
+        np.concatenate(
+            [adj_idx[in_check], slack_pos_idx[check_cols], slack_neg_idx[check_cols]]
+        ),
+        np.concatenate(
+            [np.ones(in_check.sum()), -np.ones(len(r_slack)), np.ones(len(r_slack))]
+        ),
+        len(check_cols),
+        targets,
+        targets,
+    )
+
+    # Deviation constraints, dev * scale >= adj and dev * scale >= -adj
+    if deviation_type == "relative":
+        scale = np.where(ori_vals != 0, ori_vals, EPSILON)
+    elif deviation_type == "absolute":
+        scale = np.ones(n_cells)
+    else:
+        raise ValueError(f"Unknown deviation type: {deviation_type}")
+    r_cells = np.arange(n_cells)
+    for sign in [-1, 1]:
+        add_block(
+            np.concatenate([r_cells, r_cells]),
+            np.concatenate([dev_idx, adj_idx]),
+            np.concatenate([scale, sign * np.ones(n_cells)]),
+            n_cells,
+            0,
+            np.inf,
+        )
+
+    # Link the activation variable to the deviation: activate if deviation > 0
+    if use_activations:
+        add_block(
+            np.concatenate([r_cells, r_cells]),
+            np.concatenate([dev_idx, act_idx]),
+            np.concatenate([np.ones(n_cells), -LARGE_M * np.ones(n_cells)]),
+            n_cells,
+            -np.inf,
+            0,
+        )
+
+    A = sparse.csr_matrix(
+        (np.concatenate(ls_vals), (np.concatenate(ls_rows), np.concatenate(ls_cols))),
+        shape=(n_cons, n_vars),
+    )
+
+    var_lb = np.zeros(n_vars)
+    var_lb[adj_idx] = -ori_vals  # Ensures X_ij + A_ij >= 0
+    var_ub = np.full(n_vars, np.inf)
+    var_ub[act_idx] = 1
+    integrality = np.zeros(n_vars)
+    integrality[adj_idx] = 1
+    integrality[act_idx] = 1
+
+    return ILPMatrices(
+        c,
+        A,
+        np.concatenate(ls_lb),
+        np.concatenate(ls_ub),
+        var_lb,
+        var_ub,
+        integrality,
+        cells,
+    )
+
+
+def solve_ILP_highs(
+    count_table: pl.DataFrame,
+    states_diff: Dict[str, int],
+    id_col: str,
+    zero_val_states: List[str],
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+) -> Tuple[Union[None, np.ndarray], Tuple[int, int]]:
+    """Solve with HiGHS, output the (rows x columns) adjustments (None if not optimal)
+    and the (number of variables, constraints)"""
+    if milp is None:
+        return None, (0, 0)
+    columns = [col for col in count_table.columns if col != id_col]
+    values = count_table.select(columns).cast(pl.Float64).fill_null(np.nan).to_numpy()
+    model = build_ILP_matrices(
+        values, columns, states_diff, zero_val_states, deviation_type, spread_penalty
+    )
+    result = milp(
+        model.c,
+        constraints=LinearConstraint(model.A, model.cons_lb, model.cons_ub),
+        integrality=model.integrality,
+        bounds=Bounds(model.var_lb, model.var_ub),
+    )
+    model_size = (model.n_vars, model.n_cons)
+    if result.status != 0:
+        return None, model_size
+    adjustments = np.zeros(values.shape, dtype=np.int64)
+    cell_rows, cell_cols = model.cells[:, 0], model.cells[:, 1]
+    adjustments[cell_rows, cell_cols] = np.rint(result.x[: len(model.cells)])
+    return adjustments, model_size
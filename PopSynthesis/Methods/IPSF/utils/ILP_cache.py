@@ -0,0 +1,124 @@
+"""
+Cache of the ILP solutions, keyed on the content of the (filtered) count table and states_diff
+
+Across SAA iterations and IPSF rounds many zones give the same table and diff again,
+we can then skip the solve. The key is the exact problem: values, nulls, row ids, columns,
+states_diff and the solve settings (backend etc.). There is no warm start, the HiGHS
+backend (scipy milp) cannot take an initial solution.
+
+Memory is LRU, an optional folder is used as a second tier (shared between processes).
+The cache is process level, set it up once with configure_ILP_cache.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from typing import Dict, Union, Any
+
+_ILP_CACHE = None
+
+
+class ILPSolutionCache:
+    def __init__(
+        self, max_size: int = 10000, disk_dir: Union[None, str, Path] = None
+    ) -> None:
+        assert max_size > 0
+        self.max_size = max_size
+        self.disk_dir = None if disk_dir is None else Path(disk_dir)
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+        self.solutions = OrderedDict()  # key -> solution
+        self.n_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+
+    @staticmethod
+    def make_key(
+        count_table: pl.DataFrame,
+        states_diff: Dict[str, int],
+        id_col: str,
+        **settings: Any,
+    ) -> str:
+        """The key of the problem, hash of the table, the diff and the settings"""
+        columns = [col for col in count_table.columns if col != id_col]
+        values = count_table.select(columns).cast(pl.Float64).fill_null(np.nan).to_numpy()
+        key = hashlib.blake2b(digest_size=16)
+        key.update(repr(columns).encode())
+        key.update(repr(count_table[id_col].to_list()).encode())
+        key.update(np.isnan(values).tobytes())
+        key.update(np.ascontiguousarray(values).tobytes())
+        key.update(repr(sorted(states_diff.items())).encode())
+        key.update(repr(sorted(settings.items())).encode())
+        return key.hexdigest()
+
+    def _remember(self, key: str, solution: np.ndarray) -> None:
+        self.solutions[key] = solution
+        self.solutions.move_to_end(key)
+        while len(self.solutions) > self.max_size:
+            self.solutions.popitem(last=False)
+
+    def get(self, key: str) -> Union[None, np.ndarray]:
+        if key in self.solutions:
+            self.solutions.move_to_end(key)
+            self.n_hits += 1
+            return self.solutions[key]
+        if self.disk_dir is not None:
+            disk_file = self.disk_dir / f"{key}.npy"
+            solution = None
+            if disk_file.exists():
+                try:
+                    solution = np.load(disk_file)
+                except (OSError, ValueError, EOFError):
+                    # e.g. removed or corrupted meanwhile, solve again
+                    solution = None
+            if solution is not None:
+                self._remember(key, solution)
+                self.n_disk_hits += 1
+                return solution
+        self.n_misses += 1
+        return None
+
+    def put(self, key: str, solution: np.ndarray) -> None:
+        self._remember(key, solution)
+        if self.disk_dir is not None:
+            # write then rename, another worker never loads a partial file
+            tmp_path = self.disk_dir / f".{key}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as handle:
+                np.save(handle, solution)
+            os.replace(tmp_path, self.disk_dir / f"{key}.npy")
+
+    def config(self) -> Dict[str, Any]:
+        return {"max_size": self.max_size, "disk_dir": self.disk_dir}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.n_hits,
+            "disk_hits": self.n_disk_hits,
+            "misses": self.n_misses,
+            "size": len(self.solutions),
+        }
+
+    def __repr__(self) -> str:
+        return f"ILPSolutionCache({self.stats()})"
+
+
+def configure_ILP_cache(
+    max_size: int = 10000, disk_dir: Union[None, str, Path] = None
+) -> ILPSolutionCache:
+    """Set up (or replace) the cache used by update_count_tables in this process"""
+    global _ILP_CACHE
+    _ILP_CACHE = ILPSolutionCache(max_size=max_size, disk_dir=disk_dir)
+    return _ILP_CACHE
+
+
+def get_ILP_cache() -> Union[None, ILPSolutionCache]:
+    return _ILP_CACHE
+
+
+def disable_ILP_cache() -> None:
+    global _ILP_CACHE
+    _ILP_CACHE = None
@@ -0,0 +1,75 @@
+"""
+Closed-form solutions of the simple matrix adjustment problems, tried before the ILP
+
+With absolute deviation and no spread penalty the ILP objective is linear in the moved units:
+moving 1 unit from a negative state to a positive state in a row costs 2 * n_cols (deviations)
+and removes 2 units of slack (worth 2 * n_cells), wherever it is moved.
+So when n_cells > n_cols, any solution moving the most units is optimal, and we have:
+- single pair: only 1 negative and 1 positive state, greedily move from the largest cells
+- single row: 1 row has all the states and enough counts to take the whole diff
+Other cases (or other settings) output None and go to the ILP.
+"""
+
+import numpy as np
+import polars as pl
+from typing import Dict, List, Tuple, Union
+
+
+def solve_single_pair(
+    values: np.ndarray, neg_pos: int, pos_pos: int, to_move: int
+) -> np.ndarray:
+    """Move to_move units from column neg_pos to pos_pos, taking the largest cells first"""
+    rows = np.flatnonzero(~np.isnan(values[:, neg_pos]) & ~np.isnan(values[:, pos_pos]))
+    available = values[rows, neg_pos].astype(np.int64)
+    order = np.argsort(-available, kind="stable")
+    before = np.cumsum(available[order]) - available[order]
+    moved = np.clip(to_move - before, 0, available[order])
+    adjustments = np.zeros(values.shape, dtype=np.int64)
+    adjustments[rows[order], neg_pos] = -moved
+    adjustments[rows[order], pos_pos] = moved
+    return adjustments
+
+
+def solve_single_row(values: np.ndarray, diffs: np.ndarray) -> Union[None, np.ndarray]:
+    """Put the whole diff on the first row that can take it, None if there is none"""
+    can_absorb = (~np.isnan(values)).all(axis=1) & (
+        np.nan_to_num(values) + diffs >= 0
+    ).all(axis=1)
+    if not can_absorb.any():
+        return None
+    adjustments = np.zeros(values.shape, dtype=np.int64)
+    adjustments[np.argmax(can_absorb)] = diffs
+    return adjustments
+
+
+def solve_closed_form(
+    count_table: pl.DataFrame,
+    states_diff: Dict[str, int],
+    id_col: str,
+    zero_val_states: List[str],
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+) -> Tuple[Union[None, np.ndarray], str]:
+    """Output ((rows x columns) adjustments, name of the case), None if no closed form"""
+    if deviation_type != "absolute" or spread_penalty != 0:
+        return None, "ILP"
+    columns = [col for col in count_table.columns if col != id_col]
+    if any(j in zero_val_states for j in columns):
+        return None, "ILP"
+    values = count_table.select(columns).cast(pl.Float64).fill_null(np.nan).to_numpy()
+    n_cells = (~np.isnan(values)).sum()
+    if n_cells <= len(columns):
+        # moving is not worth it (or a tie) in the ILP objective, leave it to the ILP
+        return None, "ILP"
+    diffs = np.array([states_diff[j] for j in columns], dtype=np.int64)
+
+    neg_pos, pos_pos = np.flatnonzero(diffs < 0), np.flatnonzero(diffs > 0)
+    if len(neg_pos) == 1 and len(pos_pos) == 1:
+        solution = solve_single_pair(
+            values, neg_pos[0], pos_pos[0], diffs[pos_pos[0]]
+        )
+        return solution, "single_pair"
+    solution = solve_single_row(values, diffs)
+    if solution is not None:
+        return solution, "single_row"
+    return None, "ILP"
@@ -1,12 +1,62 @@
+import numpy as np
 import polars as pl
-from pulp import LpProblem, LpVariable, lpSum, LpStatus, LpMinimize, PULP_CBC_CMD
-from typing import Tuple, Dict, List
+from pulp import (
+    LpProblem,
+    LpVariable,
+    LpAffineExpression,
+    lpSum,
+    LpStatus,
+    LpMinimize,
+    PULP_CBC_CMD,
+)
+from typing import Tuple, Dict, List, Literal, Union
 from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.utils.ILP_backends import (
+    solve_ILP_highs,
+    EPSILON,
+    LARGE_M,
+)
+from PopSynthesis.Methods.IPSF.utils.ILP_cache import get_ILP_cache
+from PopSynthesis.Methods.IPSF.utils.ILP_fast_path import solve_closed_form
+from PopSynthesis.Methods.IPSF.utils.flow_matrix_ad import solve_flow
+from collections import Counter
 from math import sqrt
 
-# Define a small epsilon value
-EPSILON = 1e-6  # Solve division by zeros
-LARGE_M = 1e6  # Large M value for binary activation variables
+ILP_BACKENDS = ["highs", "pulp"]
+ENGINES = ["ILP", "flow"]
+
+# How many problems took each path (closed form, cache, solvers) in this process
+ILP_PATH_COUNTS = Counter()
+
+
+def get_ILP_path_counts() -> Counter:
+    return Counter(ILP_PATH_COUNTS)
+
+
+def add_ILP_path_counts(counts: Counter) -> None:
+    # to merge the counts from other processes
+    ILP_PATH_COUNTS.update(counts)
+
+
+def reset_ILP_path_counts() -> None:
+    ILP_PATH_COUNTS.clear()
+
+
+# Total size of the ILP models built in this process: models, variables, constraints
+ILP_MODEL_SIZES = Counter()
+
+
+def get_ILP_model_sizes() -> Counter:
+    return Counter(ILP_MODEL_SIZES)
+
+
+def add_ILP_model_sizes(sizes: Counter) -> None:
+    ILP_MODEL_SIZES.update(sizes)
+
+
+def _record_model_size(model_size: Tuple[int, int]) -> None:
+    n_vars, n_cons = model_size
+    ILP_MODEL_SIZES.update(models=1, variables=n_vars, constraints=n_cons)
 
 
 def convert_to_required_ILP_format(
@@ -15,7 +65,7 @@ def convert_to_required_ILP_format(
     """Convert the disagg data to the required format for ILP"""
     # group by and pivot the syn to have adjusted_atts as index and states in att as columns
     assert count_field in syn_count.columns
-    gb_syn = syn_count.group_by(pl.col(adjusted_atts + [att])).agg(
+    gb_syn = syn_count.group_by(pl.col(adjusted_atts + [att]), maintain_order=True).agg(
         pl.sum(count_field).alias(count_field)
     )
     ILP_formatted_syn = gb_syn.pivot(att, index=adjusted_atts, values=count_field)
@@ -37,140 +87,206 @@ def convert_back_to_syn_count(
     return unpivoted_df
 
 
-def _ILP_solving_adjustment(
-    count_df: pl.DataFrame,
+def _solve_ILP_pulp(
+    count_table: pl.DataFrame,
     states_diff: Dict[str, int],
-    id_col=str,
-    basic_filter: bool = True,
+    id_col: str,
+    zero_val_states: List[str],
     deviation_type: str = "relative",
     spread_penalty: float = 0,
-) -> Tuple[pl.DataFrame, Dict[str, int]]:
-    # Clone count_table to prevent changes to the original
-    ori_count_table = count_df.clone()
-    count_table = count_df.clone()
+) -> Tuple[Union[None, np.ndarray], Tuple[int, int]]:
+    """Build the model with PuLP and solve with CBC
 
-    assert not count_table.select(pl.col(id_col)).is_duplicated().any()
-
-    # Filter out not needed rows and columns
-    zero_val_states = []
-    if basic_filter:
-        zero_val_states = [x for x in states_diff.keys() if states_diff[x] == 0]
-        count_table = count_table.drop(zero_val_states)
-        pos_states = [x for x in states_diff.keys() if states_diff[x] > 0]
-        neg_states = [x for x in states_diff.keys() if states_diff[x] < 0]
-        count_table = count_table.filter(
-            ~pl.all_horizontal(pl.col(pos_states).is_null())
-        )
-        count_table = count_table.filter(
-            ~pl.all_horizontal(pl.col(neg_states).is_null())
-        )
-
-    # Ensure each row has a unique identifier so we can reference rows without using an index
-    rows = count_table[id_col].to_list()
-    r_idx = {row: i for i, row in enumerate(rows)}  # NOTE: order must match
+    Output the (rows x columns) adjustments and the (number of variables, constraints)
+    """
     columns = [col for col in count_table.columns if col != id_col]
+    values = count_table.select(columns).cast(pl.Float64).fill_null(np.nan).to_numpy()
+    cells = [tuple(cell) for cell in np.argwhere(~np.isnan(values)).tolist()]
+    use_activations = spread_penalty > 0
 
     # Initialize the ILP problem
     problem = LpProblem("MatrixAdjustment", LpMinimize)
 
-    # Initialize adjustment variables for each cell with a non-null value
+    # Adjustment variables for each cell with a non-null value, X_ij + A_ij >= 0
     adjustments = {
-        (i, j): LpVariable(
-            f"A_{i}_{j}", lowBound=-count_table[r_idx[i], j], cat="Integer"
-        )
-        for i in rows
-        for j in columns
-        if count_table[r_idx[i], j] is not None
+        (r, c): LpVariable(f"A_{r}_{c}", lowBound=-values[r, c], cat="Integer")
+        for (r, c) in cells
     }
-
-    # Initialize slack variables for each column to allow deviations from target adjustments
+    # Slack variables for each column to allow deviations from target adjustments
     slack_pos = {
-        j: LpVariable(f"slack_pos_{j}", lowBound=0, cat="Continuous") for j in columns
+        c: LpVariable(f"slack_pos_{c}", lowBound=0, cat="Continuous")
+        for c in range(len(columns))
     }
     slack_neg = {
-        j: LpVariable(f"slack_neg_{j}", lowBound=0, cat="Continuous") for j in columns
+        c: LpVariable(f"slack_neg_{c}", lowBound=0, cat="Continuous")
+        for c in range(len(columns))
     }
-
-    # Initialize deviation variables and activation indicators for each cell with a non-null value
     deviations = {
-        (i, j): LpVariable(f"rel_dev_{i}_{j}", lowBound=0, cat="Continuous")
-        for (i, j) in adjustments
-    }
-    # Binary activation variables to encourage spreading adjustments
-    activations = {
-        (i, j): LpVariable(f"act_{i}_{j}", cat="Binary") for (i, j) in adjustments
+        cell: LpVariable(f"dev_{cell[0]}_{cell[1]}", lowBound=0, cat="Continuous")
+        for cell in cells
     }
+    # Binary activation variables to encourage spreading adjustments, only if penalised
+    activations = {}
+    if use_activations:
+        activations = {
+            cell: LpVariable(f"act_{cell[0]}_{cell[1]}", cat="Binary") for cell in cells
+        }
 
-    # Objective: Minimize the sum of deviations, slack, and activation penalties
-    problem += lpSum(
-        deviations[key] + slack_pos[j] + slack_neg[j] + spread_penalty * activations[key]
-        for key in deviations
-        for j in columns
+    # Objective: same weights as summing every cell term with every column term,
+    # but with 1 term per variable
+    n_cols, n_cells = len(columns), len(cells)
+    problem += LpAffineExpression(
+        [(var, n_cols) for var in deviations.values()]
+        + [(var, n_cells) for var in slack_pos.values()]
+        + [(var, n_cells) for var in slack_neg.values()]
+        + [(var, n_cols * spread_penalty) for var in activations.values()]
     )
 
     # Row constraints: Ensure the sum of adjustments in each row is zero
-    for i in rows:
-        row_adjustments = [
-            adjustments[(i, j)] for j in columns if (i, j) in adjustments
-        ]
-        problem += lpSum(row_adjustments) == 0
+    row_adjustments = {r: [] for r in range(len(values))}
+    col_adjustments = {c: [] for c in range(n_cols)}
+    for (r, c), var in adjustments.items():
+        row_adjustments[r].append(var)
+        col_adjustments[c].append(var)
+    for r, ls_var in row_adjustments.items():
+        problem += lpSum(ls_var) == 0
 
     # Column constraints with positive and negative slack for deviations
+    col_pos = {col: c for c, col in enumerate(columns)}
     for j, target_diff in states_diff.items():
         if j not in zero_val_states:
-            col_adjustments = [
-                adjustments[(i, j)] for i in rows if (i, j) in adjustments
-            ]
+            c = col_pos[j]
             problem += (
-                lpSum(col_adjustments) == target_diff + slack_pos[j] - slack_neg[j]
+                lpSum(col_adjustments[c]) == target_diff + slack_pos[c] - slack_neg[c]
             )
 
     # Deviation and activation constraints
-    for (i, j), var in adjustments.items():
-        original_value = count_table[r_idx[i], j]
-        # Non-negativity constraints
-        problem += var >= -original_value  # Ensures X_ij + A_ij >= 0
-
-        check_dev = None
+    for (r, c), var in adjustments.items():
         if deviation_type == "relative":
             # Handle zero values by assigning epsilon
-            adjusted_value = original_value if original_value != 0 else EPSILON
-            check_dev = deviations[(i, j)] * adjusted_value
+            scale = values[r, c] if values[r, c] != 0 else EPSILON
         elif deviation_type == "absolute":
-            check_dev = deviations[(i, j)]
-            problem += check_dev >= original_value - (
-                original_value + var
-            )  # maintain closeness to original values
+            scale = 1
         else:
             raise ValueError(f"Unknown deviation type: {deviation_type}")
-
-        # Deviation constraints
+        check_dev = deviations[(r, c)] * scale
         problem += check_dev >= var  # dev >= adj
         problem += check_dev >= -var  # dev >= -adj
-
-        # Link the activation variable to the deviation: activate if deviation > 0
-        problem += deviations[(i, j)] <= activations[(i, j)] * LARGE_M  # Large M constraint
+        if use_activations:
+            # activate if deviation > 0, large M constraint
+            problem += deviations[(r, c)] <= activations[(r, c)] * LARGE_M
 
     # Solve the ILP
     problem.solve(PULP_CBC_CMD(msg=False))
+    model_size = (problem.numVariables(), problem.numConstraints())
 
-    adjustment_remaining = {}
     # Check the solution status
-    if LpStatus[problem.status] == "Optimal":
-        # Apply adjustments to count_table based on the solution
-        for (i, j), var in adjustments.items():
-            ori_count_table = ori_count_table.with_columns(
-                pl.when(pl.col(id_col) == i)
-                .then(ori_count_table[j] + var.value())
-                .otherwise(ori_count_table[j])
-                .alias(j)
-            )
+    if LpStatus[problem.status] != "Optimal":
+        return None, model_size
+    adjustment_matrix = np.zeros(values.shape, dtype=np.int64)
+    for (r, c), var in adjustments.items():
+        adjustment_matrix[r, c] = round(var.value())
+    return adjustment_matrix, model_size
 
-        # Calculate the resulting actual column adjustments and print the achieved diff
-        actual_diff = {
-            j: sum(adjustments[(i, j)].value() for i in rows if (i, j) in adjustments)
-            for j in columns
-        }
+
+def _ILP_solving_adjustment(
+    count_df: pl.DataFrame,
+    states_diff: Dict[str, int],
+    id_col=str,
+    basic_filter: bool = True,
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+    backend: Literal["highs", "pulp"] = "highs",
+    fast_path: bool = True,
+    engine: Literal["ILP", "flow"] = "ILP",
+) -> Tuple[pl.DataFrame, Dict[str, int]]:
+    assert backend in ILP_BACKENDS
+    assert engine in ENGINES
+    # Clone count_table to prevent changes to the original
+    ori_count_table = count_df.clone()
+    count_table = count_df.clone()
+
+    assert not count_table.select(pl.col(id_col)).is_duplicated().any()
+
+    # Filter out not needed rows and columns
+    zero_val_states = []
+    if basic_filter:
+        zero_val_states = [x for x in states_diff.keys() if states_diff[x] == 0]
+        count_table = count_table.drop(zero_val_states)
+        pos_states = [x for x in states_diff.keys() if states_diff[x] > 0]
+        neg_states = [x for x in states_diff.keys() if states_diff[x] < 0]
+        count_table = count_table.filter(
+            ~pl.all_horizontal(pl.col(pos_states).is_null())
+        )
+        count_table = count_table.filter(
+            ~pl.all_horizontal(pl.col(neg_states).is_null())
+        )
+
+    columns = [col for col in count_table.columns if col != id_col]
+    solve_args = (
+        count_table,
+        states_diff,
+        id_col,
+        zero_val_states,
+        deviation_type,
+        spread_penalty,
+    )
+    solution, path = None, "ILP"
+    cache = get_ILP_cache()
+    if len(columns) == 0 or len(count_table) == 0:
+        # nothing to adjust (e.g. zone already matching), no need to solve
+        solution = np.zeros((len(count_table), len(columns)), dtype=np.int64)
+        path = "empty"
+    elif engine == "flow":
+        solution, path = solve_flow(*solve_args), "flow"
+    elif fast_path:
+        solution, path = solve_closed_form(*solve_args)
+    if solution is None and cache is not None:
+        cache_key = cache.make_key(
+            count_table,
+            states_diff,
+            id_col,
+            deviation_type=deviation_type,
+            spread_penalty=spread_penalty,
+            backend=backend,
+        )
+        solution = cache.get(cache_key)
+        path = "cache"
+    if solution is None:
+        path = backend
+        if backend == "highs":
+            solution, model_size = solve_ILP_highs(*solve_args)
+            _record_model_size(model_size)
+            if solution is None:
+                print("WARNING: HiGHS did not find the optimal, fall back to PuLP/CBC")
+                path = "pulp"
+        if solution is None:
+            solution, model_size = _solve_ILP_pulp(*solve_args)
+            _record_model_size(model_size)
+        if solution is not None and cache is not None:
+            cache.put(cache_key, solution)
+    ILP_PATH_COUNTS[path] += 1
+
+    adjustment_remaining = {}
+    if solution is not None:
+        # filter keeps the order, so the solved rows are these positions of the original
+        kept_pos = np.flatnonzero(
+            ori_count_table[id_col].is_in(count_table[id_col]).to_numpy()
+        )
+        adjustment_matrix = np.zeros((len(ori_count_table), len(columns)), dtype=np.int64)
+        adjustment_matrix[kept_pos] = solution
+        # Apply all adjustments at once, keeping the dtypes of the table
+        ori_count_table = ori_count_table.with_columns(
+            [
+                (pl.col(j) + pl.Series(adjustment_matrix[:, k])).cast(
+                    ori_count_table.schema[j]
+                )
+                for k, j in enumerate(columns)
+            ]
+        )
+
+        # Calculate the resulting actual column adjustments
+        actual_diff = dict(zip(columns, adjustment_matrix.sum(axis=0).tolist()))
         adjustment_remaining = {
             j: int(states_diff[j] - actual_diff[j]) for j in columns
         } | {j: 0 for j in zero_val_states}
@@ -181,9 +297,19 @@ def _ILP_solving_adjustment(
 
 
 def update_count_tables(
-    count_table: pl.DataFrame, states_diff: Dict[str, int], id_col: str, deviation_type: str = "relative", spread_penalty: float = 0
+    count_table: pl.DataFrame,
+    states_diff: Dict[str, int],
+    id_col: str,
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+    backend: Literal["highs", "pulp"] = "highs",
+    fast_path: bool = True,
+    engine: Literal["ILP", "flow"] = "ILP",
 ) -> Tuple[pl.DataFrame, int]:
-    """Update count table with adjustments, ensuring row and column sums meet expected values."""
+    """Update count table with adjustments, ensuring row and column sums meet expected values.
+
+    engine="flow" solves it as a min-cost flow (see flow_matrix_ad) instead of the ILP
+    """
     assert sum(states_diff.values()) == 0
 
     expected_sum_row = count_table.select(
@@ -198,7 +324,14 @@ def update_count_tables(
     )
 
     count_table, adjustment_remaining = _ILP_solving_adjustment(
-        count_table, states_diff, id_col, deviation_type=deviation_type, spread_penalty=spread_penalty
+        count_table,
+        states_diff,
+        id_col,
+        deviation_type=deviation_type,
+        spread_penalty=spread_penalty,
+        backend=backend,
+        fast_path=fast_path,
+        engine=engine,
     )
     # Resulting adjusted DataFrame
     result_sum_row = count_table.select(
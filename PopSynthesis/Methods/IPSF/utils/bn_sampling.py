@@ -0,0 +1,285 @@
+"""
+Forward (ancestral) sampling of a discrete BN on compiled CPDs, for creating the big pools
+
+The CPDs (e.g. of a learnt pgmpy model) are compiled once: each one becomes a table of
+cumulative probs with one row per parent configuration, the configuration of a record is
+the mixed radix code of its parents' states (the first parent the most significant,
+as the columns of pgmpy's CPD values). The tables of a node are flattened with the row
+number added to each row, so all the records of a chunk are sampled with a single
+np.searchsorted (target = config + uniform).
+The records are generated by chunks as integer codes (the codes of the states are their
+order in the state names, see CategoricalDictionary), decoded only if asked, and
+iter_chunks/sample_to_dir stream them without holding the whole pool.
+The states the pool must have (e.g. all the states of the census) are added with top_up,
+only the missing ones are sampled given the state (likelihood weighting) from the same BN.
+"""
+
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.marginals import wide_to_long_marg, att_col, state_col
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+
+class CompiledBN:
+    def __init__(
+        self,
+        parents: Dict[str, List[str]],
+        states: Dict[str, List[Any]],
+        cpd_values: Dict[str, np.ndarray],
+    ) -> None:
+        """cpd_values[node] has shape (n states, n parent configs) as pgmpy's get_values"""
+        graph = nx.DiGraph()
+        graph.add_nodes_from(parents)
+        graph.add_edges_from((p, node) for node, ps in parents.items() for p in ps)
+        self.nodes: List[str] = list(nx.topological_sort(graph))
+        self.parents = {node: list(parents[node]) for node in self.nodes}
+        self.states = {node: list(states[node]) for node in self.nodes}
+        self.categories = CategoricalDictionary(self.states)
+        self.strides: Dict[str, np.ndarray] = {}
+        self.flat_cum: Dict[str, np.ndarray] = {}
+        for node in self.nodes:
+            parent_cards = [len(self.states[p]) for p in self.parents[node]]
+            # the last parent varies the fastest
+            strides = np.ones(len(parent_cards), dtype=np.int64)
+            for i in range(len(parent_cards) - 2, -1, -1):
+                strides[i] = strides[i + 1] * parent_cards[i + 1]
+            self.strides[node] = strides
+            values = np.asarray(cpd_values[node], dtype=np.float64)
+            n_configs = int(np.prod(parent_cards)) if len(parent_cards) > 0 else 1
+            assert values.shape == (len(self.states[node]), n_configs), node
+            cum = np.cumsum(values.T, axis=1)
+            cum = cum / cum[:, -1:]
+            # exact 1 at the end so the last state always catches the rounding
+            cum[:, -1] = 1.0
+            self.flat_cum[node] = (cum + np.arange(n_configs)[:, None]).ravel()
+
+    @classmethod
+    def from_pgmpy(cls, model: Any) -> "CompiledBN":
+        """From a fitted pgmpy model (only its TabularCPDs are used)"""
+        parents, states, cpd_values = {}, {}, {}
+        for cpd in model.get_cpds():
+            node = cpd.variables[0]
+            parents[node] = list(cpd.variables[1:])
+            states[node] = list(cpd.state_names[node])
+            cpd_values[node] = cpd.get_values()
+        return cls(parents, states, cpd_values)
+
+    def state_code(self, node: str, state: Any) -> int:
+        str_states = self.categories.states[node]
+        if str(state) not in str_states:
+            raise KeyError(f"State {state} of {node} is not in the BN")
+        return str_states.index(str(state))
+
+    def _forward(
+        self, n: int, rng: np.random.Generator, evidence_codes: Dict[str, int]
+    ) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+        """Codes and likelihood weights, the evidence nodes are clamped (P(evidence | parents))"""
+        codes, weights = {}, np.ones(n)
+        for node in self.nodes:
+            card = len(self.states[node])
+            config = np.zeros(n, dtype=np.int64)
+            for parent, stride in zip(self.parents[node], self.strides[node]):
+                config += codes[parent].astype(np.int64) * stride
+            if node in evidence_codes:
+                code = evidence_codes[node]
+                flat_cum = self.flat_cum[node]
+                upper = flat_cum[config * card + code]
+                lower = flat_cum[config * card + code - 1] if code > 0 else config
+                weights *= np.maximum(upper - lower, 0)
+                codes[node] = np.full(n, code, dtype=np.int64)
+            else:
+                pos = np.searchsorted(
+                    self.flat_cum[node], config + rng.random(n), side="right"
+                )
+                codes[node] = np.minimum(pos - config * card, card - 1)
+        return codes, weights
+
+    def sample_codes(
+        self, n: int, rng: Union[None, np.random.Generator] = None
+    ) -> Dict[str, np.ndarray]:
+        """n records as the codes of the states of each node"""
+        rng = np.random.default_rng() if rng is None else rng
+        return self._forward(n, rng, {})[0]
+
+    def _no_codes(self) -> Dict[str, np.ndarray]:
+        return {node: np.zeros(0, dtype=np.int64) for node in self.nodes}
+
+    def sample_given(
+        self,
+        evidence: Dict[str, Any],
+        n: int,
+        rng: Union[None, np.random.Generator] = None,
+        batch_size: int = 100_000,
+        max_draws: int = 10_000_000,
+    ) -> Tuple[Dict[str, np.ndarray], int]:
+        """n records having the evidence states, with the n of records drawn for them
+
+        Likelihood weighting: the evidence nodes are clamped and the records drawn by batches
+        are weighted by P(evidence | parents), then n are resampled by weight. Nothing (0
+        records) if no record with a weight > 0 in max_draws (the evidence is impossible)
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        evidence_codes = {node: self.state_code(node, s) for node, s in evidence.items()}
+        ls_codes, ls_weights, n_drawn, n_kept = [], [], 0, 0
+        while n_kept < n and n_drawn < max_draws:
+            codes, weights = self._forward(batch_size, rng, evidence_codes)
+            n_drawn += batch_size
+            kept = weights > 0
+            ls_codes.append({node: x[kept] for node, x in codes.items()})
+            ls_weights.append(weights[kept])
+            n_kept += int(kept.sum())
+        if n_kept == 0:
+            return self._no_codes(), n_drawn
+        weights = np.concatenate(ls_weights)
+        chosen = rng.choice(len(weights), size=n, p=weights / weights.sum())
+        return {
+            node: np.concatenate([x[node] for x in ls_codes])[chosen]
+            for node in self.nodes
+        }, n_drawn
+
+    def iter_chunks(
+        self,
+        n: int,
+        chunk_size: int = 1_000_000,
+        rng: Union[None, np.random.Generator] = None,
+        decode: bool = False,
+    ) -> Iterator[pl.DataFrame]:
+        """The n records by chunks of chunk_size (the last can be smaller)"""
+        rng = np.random.default_rng() if rng is None else rng
+        for start in range(0, n, chunk_size):
+            codes = self.sample_codes(min(chunk_size, n - start), rng)
+            chunk = pl.DataFrame(
+                [
+                    pl.Series(node, codes[node], dtype=self.categories.code_dtype(node))
+                    for node in self.nodes
+                ]
+            )
+            yield self.categories.decode(chunk) if decode else chunk
+
+    def sample(
+        self,
+        n: int,
+        rng: Union[None, np.random.Generator] = None,
+        chunk_size: int = 1_000_000,
+        decode: bool = True,
+    ) -> pl.DataFrame:
+        """n records, with the state names if decode else the codes"""
+        chunks = list(self.iter_chunks(n, chunk_size, rng, decode=False))
+        if len(chunks) == 0:
+            return pl.DataFrame(
+                [
+                    pl.Series(node, [], dtype=self.categories.code_dtype(node))
+                    for node in self.nodes
+                ]
+            )
+        pool = pl.concat(chunks)
+        return self.categories.decode(pool) if decode else pool
+
+    def sample_pandas(
+        self, n: int, rng: Union[None, np.random.Generator] = None
+    ) -> pd.DataFrame:
+        """n records with the states as in the CPDs (not cast to str), as pgmpy's forward_sample"""
+        return self._codes_to_pandas(self.sample_codes(n, rng))
+
+    def _codes_to_pandas(self, codes: Dict[str, np.ndarray]) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                node: np.asarray(self.states[node], dtype=object)[codes[node]]
+                for node in self.nodes
+            }
+        )
+
+    def sample_to_dir(
+        self,
+        n: int,
+        out_dir: Union[str, Path],
+        chunk_size: int = 1_000_000,
+        rng: Union[None, np.random.Generator] = None,
+        decode: bool = False,
+    ) -> List[Path]:
+        """Stream the records to out_dir, one parquet per chunk (read back with scan_parquet)"""
+        out_dir = Path(out_dir)
+        return [
+            save_frame(chunk, out_dir / f"part-{i:05d}.parquet")
+            for i, chunk in enumerate(self.iter_chunks(n, chunk_size, rng, decode))
+        ]
+
+    def top_up(
+        self,
+        pool: pd.DataFrame,
+        required: List[Dict[str, Any]],
+        n_per_missing: int = 1,
+        rng: Union[None, np.random.Generator] = None,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Add n_per_missing records for each required comb (e.g. {"hhinc": "Negative income"})
+        not in the pool, instead of sampling the whole pool again
+
+        Output the pool and the report: the n of records added (0 if the BN never gives the
+        comb) and drawn for each missing comb
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        ls_added, ls_report = [pool], []
+        for comb in missing_combinations(pool, required):
+            if all(str(s) in self.categories.states[att] for att, s in comb.items()):
+                codes, n_drawn = self.sample_given(comb, n_per_missing, rng)
+            else:
+                # a state the BN does not know, cannot be sampled
+                codes, n_drawn = self._no_codes(), 0
+            added = self._codes_to_pandas(codes)
+            ls_added.append(added)
+            ls_report.append(
+                {"combination": comb, "n_added": len(added), "n_drawn": n_drawn}
+            )
+        report = pd.DataFrame(ls_report, columns=["combination", "n_added", "n_drawn"])
+        return pd.concat(ls_added, ignore_index=True), report
+
+    def sample_covering(
+        self,
+        n: int,
+        required: List[Dict[str, Any]],
+        n_per_missing: int = 1,
+        rng: Union[None, np.random.Generator] = None,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """n records (as sample_pandas) topped up to have all the required combs, see top_up"""
+        rng = np.random.default_rng() if rng is None else rng
+        return self.top_up(self.sample_pandas(n, rng), required, n_per_missing, rng)
+
+    def __repr__(self) -> str:
+        return f"CompiledBN({len(self.nodes)} nodes: {self.nodes})"
+
+
+def missing_combinations(
+    pool: pd.DataFrame, required: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """The required combs (att: state) with no record in the pool, states compared as str"""
+    missing = []
+    for comb in required:
+        has_comb = np.ones(len(pool), dtype=bool)
+        for att, state in comb.items():
+            has_comb &= (pool[att].astype(str) == str(state)).to_numpy()
+        if not has_comb.any():
+            missing.append(comb)
+    return missing
+
+
+def census_required_states(
+    census: pd.DataFrame, atts: Union[None, List[str]] = None
+) -> List[Dict[str, str]]:
+    """Each (att, state) with a count > 0 in the census (IPU layout, zones as index)"""
+    long_marg = wide_to_long_marg(census)
+    if atts is not None:
+        long_marg = long_marg.filter(pl.col(att_col).is_in(atts))
+    required = (
+        long_marg.filter(pl.col(count_field) > 0)
+        .select(att_col, state_col)
+        .unique(maintain_order=True)
+    )
+    return [{att: state} for att, state in required.iter_rows()]
@@ -0,0 +1,155 @@
+"""
+Integer codes for the states of each att, shared by the pool, the syn pop and the census
+
+The states are long strings (e.g. hhinc "$1,000-$1,249 ($52,000-$64,999)"), every group_by,
+join and pivot on them hashes and compares the strings. Encoding them once to small
+unsigned ints (UInt8 up to 256 states, else UInt16) keeps the frames several times smaller,
+the records are decoded back to the state names only at output.
+The code of a state is its position in the list of states of the att, so the same
+dictionary (e.g. from the state names pickles) always gives the same codes.
+In the wide census (states as columns) the states are renamed to str(code), which is
+also what a pivot of the encoded syn pop gives as column names.
+
+The IPSF loop (ipsf_full_loop / ipsf_chunked_loop given categories) encodes the syn hh, the
+pools, the paired pools (with_suffixes for the cols as age_Main) and the census once, SAA,
+CSP and the census checks then run on the codes, the outputs are decoded.
+"""
+
+import pickle
+from pathlib import Path
+
+import pandas as pd
+import polars as pl
+
+from typing import Dict, List, Union, Any
+
+
+class CategoricalDictionary:
+    def __init__(self, states: Dict[str, List[Any]]) -> None:
+        # NOTE: states are compared as str, the census header and the csv pools do not agree on types
+        self.states = {}
+        for att, att_states in states.items():
+            str_states = [str(s) for s in att_states]
+            assert len(set(str_states)) == len(str_states), f"Duplicated states in {att}"
+            self.states[att] = str_states
+
+    @classmethod
+    def from_pickles(cls, *paths: Union[str, Path]) -> "CategoricalDictionary":
+        """From the state names pickles ({att: [states]}, see one_off/01_create_att_states_dict)"""
+        states = {}
+        for path in paths:
+            with open(path, "rb") as handle:
+                states |= pickle.load(handle)
+        return cls(states)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: Union[pl.DataFrame, pd.DataFrame],
+        atts: Union[None, List[str]] = None,
+    ) -> "CategoricalDictionary":
+        """The states as they appear in the data, atts default to all the cols"""
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df)
+        atts = df.columns if atts is None else atts
+        return cls(
+            {
+                att: df[att].cast(pl.String).unique(maintain_order=True).to_list()
+                for att in atts
+            }
+        )
+
+    def with_suffixes(self, suffixes: List[str]) -> "CategoricalDictionary":
+        """Also the atts as {att}_{suffix} (e.g. age_Main in the paired pools), same codes"""
+        states = dict(self.states)
+        for att, att_states in self.states.items():
+            for suffix in suffixes:
+                states[f"{att}_{suffix}"] = att_states
+        return CategoricalDictionary(states)
+
+    def atts(self) -> List[str]:
+        return list(self.states.keys())
+
+    def code_dtype(self, att: str) -> pl.DataType:
+        n_states = len(self.states[att])
+        if n_states <= 2**8:
+            return pl.UInt8
+        elif n_states <= 2**16:
+            return pl.UInt16
+        return pl.UInt32
+
+    def state_code_names(self, att: str) -> Dict[str, str]:
+        """State name to its code as a col name (str), for the wide census"""
+        return {s: str(code) for code, s in enumerate(self.states[att])}
+
+    def encode(self, df: Union[pl.DataFrame, pd.DataFrame]) -> pl.DataFrame:
+        """Replace the states of all the known atts by their codes, other cols are kept"""
+        if isinstance(df, pd.DataFrame):
+            df = pl.from_pandas(df)
+        atts = [att for att in self.states if att in df.columns]
+        # replace_strict raises if a state is not in the dictionary
+        return df.with_columns(
+            pl.col(att)
+            .cast(pl.String)
+            .replace_strict(
+                self.states[att],
+                list(range(len(self.states[att]))),
+                return_dtype=self.code_dtype(att),
+            )
+            for att in atts
+        )
+
+    def decode(self, df: pl.DataFrame) -> pl.DataFrame:
+        """Replace the codes of all the known atts by the state names (str)"""
+        atts = [att for att in self.states if att in df.columns]
+        return df.with_columns(
+            pl.col(att)
+            .cast(pl.Int64)
+            .replace_strict(
+                list(range(len(self.states[att]))),
+                self.states[att],
+                return_dtype=pl.String,
+            )
+            for att in atts
+        )
+
+    def encode_pandas(self, df: pd.DataFrame) -> pd.DataFrame:
+        """encode for the pandas paths (CSP), only the known atts are converted"""
+        atts = [att for att in self.states if att in df.columns]
+        encoded = self.encode(df[atts])
+        return df.assign(**{att: encoded[att].to_numpy() for att in atts})
+
+    def decode_pandas(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Reverse of encode_pandas"""
+        atts = [att for att in self.states if att in df.columns]
+        decoded = self.decode(pl.from_pandas(df[atts]))
+        return df.assign(**{att: decoded[att].to_numpy() for att in atts})
+
+    def encode_marginal(self, marg: pd.DataFrame) -> pd.DataFrame:
+        """Rename the (att, state) cols of the census to (att, str(code)) for the known atts"""
+        new_cols = []
+        for att, state in marg.columns:
+            if att in self.states:
+                code_names = self.state_code_names(att)
+                if str(state) not in code_names:
+                    raise KeyError(f"State {state} of {att} is not in the dictionary")
+                state = code_names[str(state)]
+            new_cols.append((att, state))
+        encoded = marg.copy()
+        encoded.columns = pd.MultiIndex.from_tuples(new_cols, names=marg.columns.names)
+        return encoded
+
+    def decode_marginal(self, marg: pd.DataFrame) -> pd.DataFrame:
+        """Reverse of encode_marginal"""
+        new_cols = []
+        for att, code in marg.columns:
+            if att in self.states:
+                code = self.states[att][int(code)]
+            new_cols.append((att, code))
+        decoded = marg.copy()
+        decoded.columns = pd.MultiIndex.from_tuples(new_cols, names=marg.columns.names)
+        return decoded
+
+    def __repr__(self) -> str:
+        sizes = {att: len(s) for att, s in self.states.items()}
+        return f"CategoricalDictionary({sizes})"
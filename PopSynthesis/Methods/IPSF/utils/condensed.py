@@ -17,7 +17,8 @@ def condense_df(df: Union[pl.DataFrame, pd.DataFrame], id_col: Union[None, str]=
         assert id_col in df.columns
         expr = pl.exclude(id_col)
         to_agg.append(pl.col(id_col))
-    return df.group_by(expr).agg(*to_agg)
+    # keep order so the condensed rows are deterministic (needed for seeded runs)
+    return df.group_by(expr, maintain_order=True).agg(*to_agg)
 
 
 def explode_df(df: pl.DataFrame, id_col: Union[str, None]=None, weight_col: Union[str, None] = None) -> pl.DataFrame:
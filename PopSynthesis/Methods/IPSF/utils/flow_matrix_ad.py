@@ -0,0 +1,188 @@
+"""
+Min-cost flow form of the matrix adjustment (engine="flow" in update_count_tables)
+
+Moving counts between states inside a row keeps the row sums, so the adjustment is a
+transshipment problem: source -> negative state -> row -> ... -> positive state -> sink.
+- source -> negative state j: one arc per unit of -diff_j
+- state j -> row i: remove from the cell, capacity X_ij (cannot remove more than there is)
+- row i -> state j: add to the cell, no capacity, only if the cell (i, j) is possible
+- positive state k -> sink: one arc per unit of diff_k
+- source -> sink: what is not moved
+A unit can go through other states (removed in a row, added in another), as in the ILP.
+The r-th unit arc of a state has a negative cost of (2r - 1), the drop of its squared
+remaining diff, so the min cost flow minimises the remaining err (the sum of squares) first,
+then the cost of the cells moved from/to: the same for all with absolute deviation,
+1 / X_ij with relative deviation.
+The node-arc matrix is totally unimodular, so the LP (HiGHS simplex) solution is integral,
+no binary variables needed. networkx network simplex is used if the LP fails.
+There is no spread penalty here.
+"""
+
+import networkx as nx
+import numpy as np
+import polars as pl
+from scipy import sparse
+from scipy.optimize import linprog
+from typing import Dict, List, Tuple, Union
+
+COST_SCALE = 1000  # network simplex needs integer costs
+MAX_COST = 10**6  # cost of moving into/out of a zero cell (relative deviation)
+
+
+def cell_costs(values: np.ndarray, deviation_type: str) -> np.ndarray:
+    """Integer cost of moving 1 unit into or out of each cell"""
+    if deviation_type == "absolute":
+        return np.ones(values.shape, dtype=np.int64)
+    elif deviation_type == "relative":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            costs = np.where(values > 0, np.rint(COST_SCALE / values), MAX_COST)
+        return np.nan_to_num(costs, nan=MAX_COST).astype(np.int64)
+    else:
+        raise ValueError(f"Unknown deviation type: {deviation_type}")
+
+
+def build_flow_arcs(
+    values: np.ndarray, diffs: np.ndarray, costs: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, int]:
+    """Output (tails, heads, capacities, costs) of the arcs and the total to move
+
+    Nodes are 0 source, 1 sink, then the columns, then the rows.
+    The first arcs are the removals then the additions, one per non-null cell
+    """
+    n_rows, n_cols = values.shape
+    col_node = np.arange(n_cols) + 2
+    row_node = np.arange(n_rows) + 2 + n_cols
+    total_move = int(diffs[diffs > 0].sum())
+    # any drop of err is worth more than the cost of the cells on the way,
+    # a path goes through each state at most once
+    err_weight = 2 * n_cols * int(costs.max()) + 1
+
+    cell_rows, cell_cols = np.nonzero(~np.isnan(values))
+    cell_vals = values[cell_rows, cell_cols].astype(np.int64)
+    cell_arc_costs = costs[cell_rows, cell_cols]
+
+    # the r-th unit of each state
+    n_units = np.abs(diffs)
+    unit_cols = np.repeat(np.arange(n_cols), n_units)
+    unit_start = np.repeat(np.cumsum(n_units) - n_units, n_units)
+    unit_r = np.arange(len(unit_cols)) - unit_start + 1
+    unit_neg = diffs[unit_cols] < 0
+
+    tails = np.concatenate(
+        [
+            col_node[cell_cols],
+            row_node[cell_rows],
+            np.where(unit_neg, 0, col_node[unit_cols]),
+            [0],
+        ]
+    )
+    heads = np.concatenate(
+        [
+            row_node[cell_rows],
+            col_node[cell_cols],
+            np.where(unit_neg, col_node[unit_cols], 1),
+            [1],
+        ]
+    )
+    capacities = np.concatenate(
+        [
+            cell_vals,
+            np.full(len(cell_rows), total_move),
+            np.ones(len(unit_cols)),
+            [total_move],
+        ]
+    ).astype(np.int64)
+    arc_costs = np.concatenate(
+        [cell_arc_costs, cell_arc_costs, -(2 * unit_r - 1) * err_weight, [0]]
+    ).astype(np.int64)
+    return tails, heads, capacities, arc_costs, total_move
+
+
+def _min_cost_flow_lp(
+    tails: np.ndarray,
+    heads: np.ndarray,
+    capacities: np.ndarray,
+    arc_costs: np.ndarray,
+    demands: np.ndarray,
+) -> Union[None, np.ndarray]:
+    """Flow of each arc, None if the solve failed or is not integral"""
+    n_arcs = len(tails)
+    incidence = sparse.csr_matrix(
+        (
+            np.concatenate([np.ones(n_arcs), -np.ones(n_arcs)]),
+            (np.concatenate([heads, tails]), np.tile(np.arange(n_arcs), 2)),
+        ),
+        shape=(len(demands), n_arcs),
+    )
+    result = linprog(
+        arc_costs,
+        A_eq=incidence,
+        b_eq=demands,
+        bounds=np.column_stack([np.zeros(n_arcs), capacities]),
+        method="highs-ds",
+    )
+    if result.status != 0:
+        return None
+    flows = np.rint(result.x)
+    if not np.allclose(flows, result.x, atol=1e-6):
+        return None
+    return flows.astype(np.int64)
+
+
+def _min_cost_flow_networkx(
+    tails: np.ndarray,
+    heads: np.ndarray,
+    capacities: np.ndarray,
+    arc_costs: np.ndarray,
+    demands: np.ndarray,
+) -> np.ndarray:
+    graph = nx.MultiDiGraph()
+    for node, demand in enumerate(demands):
+        graph.add_node(node, demand=int(demand))
+    for a, (tail, head, capacity, cost) in enumerate(
+        zip(tails.tolist(), heads.tolist(), capacities.tolist(), arc_costs.tolist())
+    ):
+        graph.add_edge(tail, head, key=a, capacity=capacity, weight=cost)
+    flow = nx.min_cost_flow(graph)
+    return np.array(
+        [flow[tail][head][a] for a, (tail, head) in enumerate(zip(tails, heads))],
+        dtype=np.int64,
+    )
+
+
+def solve_flow(
+    count_table: pl.DataFrame,
+    states_diff: Dict[str, int],
+    id_col: str,
+    zero_val_states: List[str],
+    deviation_type: str = "relative",
+    spread_penalty: float = 0,
+) -> np.ndarray:
+    """Output the (rows x columns) adjustments from the min cost flow"""
+    if spread_penalty != 0:
+        raise ValueError("The flow engine does not support spread_penalty")
+    columns = [col for col in count_table.columns if col != id_col]
+    values = count_table.select(columns).cast(pl.Float64).fill_null(np.nan).to_numpy()
+    diffs = np.array(
+        [0 if j in zero_val_states else states_diff[j] for j in columns], dtype=np.int64
+    )
+    adjustments = np.zeros(values.shape, dtype=np.int64)
+    if not (diffs > 0).any():
+        return adjustments
+
+    tails, heads, capacities, arc_costs, total_move = build_flow_arcs(
+        values, diffs, cell_costs(values, deviation_type)
+    )
+    demands = np.zeros(2 + values.shape[0] + values.shape[1], dtype=np.int64)
+    demands[0], demands[1] = -total_move, total_move
+    arcs = (tails, heads, capacities, arc_costs, demands)
+    flows = _min_cost_flow_lp(*arcs)
+    if flows is None:
+        print("WARNING: the flow LP did not give an integral solution, use networkx")
+        flows = _min_cost_flow_networkx(*arcs)
+
+    # removals then additions, one arc per non-null cell for each
+    cell_rows, cell_cols = np.nonzero(~np.isnan(values))
+    n_cells = len(cell_rows)
+    adjustments[cell_rows, cell_cols] = flows[n_cells : 2 * n_cells] - flows[:n_cells]
+    return adjustments
@@ -0,0 +1,171 @@
+"""
+Keep the (zone x att x state) counts of a syn pop up to date with deltas
+
+The counts are computed once from the full pop, then each operation only applies what it
+changed: the zones replaced by an att adjustment (old records out, new records in),
+the records deleted to match the census. The diff with the census for a cell is then a
+lookup, no need to group the whole pop again after each att / each loop.
+Zones and states are str (as in the long format marginals), one dense (zones x states)
+array per att, new zones/states are added when first seen.
+With debug=True, check() recounts the pop and compares (slow, for debugging only).
+"""
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field, count_field
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    full_to_long_marg,
+    diff_long_marg,
+    att_col,
+    state_col,
+    MARG_KEYS,
+)
+from PopSynthesis.Methods.IPSF.utils.zone_partition import ZonePartitionedPop
+from typing import Dict, List, Union, Iterable
+
+PopLike = Union[pl.DataFrame, pd.DataFrame, ZonePartitionedPop]
+
+
+def _to_frame(syn_pop: PopLike) -> Union[pl.DataFrame, pd.DataFrame]:
+    if isinstance(syn_pop, ZonePartitionedPop):
+        return syn_pop.to_frame(rechunk=False)
+    return syn_pop
+
+
+class MarginalTracker:
+    def __init__(self, atts: List[str], debug: bool = False) -> None:
+        self.atts = list(atts)
+        self.debug = debug
+        self.zone_index: Dict[str, int] = {}
+        self.state_index: Dict[str, Dict[str, int]] = {att: {} for att in self.atts}
+        self.counts: Dict[str, np.ndarray] = {
+            att: np.zeros((0, 0), dtype=np.int64) for att in self.atts
+        }
+
+    @classmethod
+    def from_pop(
+        cls, syn_pop: PopLike, atts: List[str], debug: bool = False
+    ) -> "MarginalTracker":
+        tracker = cls(atts, debug=debug)
+        tracker.add_records(syn_pop)
+        return tracker
+
+    def _grow(self, att: str, zones: Iterable[str], states: Iterable[str]) -> None:
+        for zone in zones:
+            if zone not in self.zone_index:
+                self.zone_index[zone] = len(self.zone_index)
+        for state in states:
+            if state not in self.state_index[att]:
+                self.state_index[att][state] = len(self.state_index[att])
+        n_zones = len(self.zone_index)
+        for a in self.atts:
+            n_states = len(self.state_index[a])
+            old = self.counts[a]
+            if old.shape != (n_zones, n_states):
+                grown = np.zeros((n_zones, n_states), dtype=np.int64)
+                grown[: old.shape[0], : old.shape[1]] = old
+                self.counts[a] = grown
+
+    def apply_long_delta(self, long_marg: pl.DataFrame, sign: int = 1) -> None:
+        """Add (sign=1) or remove (sign=-1) the counts of a long format marginal"""
+        long_marg = long_marg.filter(pl.col(att_col).is_in(self.atts))
+        for (att,), sub_marg in long_marg.partition_by(att_col, as_dict=True).items():
+            zones = sub_marg[zone_field].to_list()
+            states = sub_marg[state_col].to_list()
+            self._grow(att, set(zones), set(states))
+            rows = np.array([self.zone_index[z] for z in zones], dtype=np.int64)
+            cols = np.array([self.state_index[att][s] for s in states], dtype=np.int64)
+            np.add.at(
+                self.counts[att], (rows, cols), sign * sub_marg[count_field].to_numpy()
+            )
+        if self.debug:
+            assert all((c >= 0).all() for c in self.counts.values())
+
+    def add_records(self, records: PopLike, sign: int = 1) -> None:
+        records = _to_frame(records)
+        if len(records) == 0:
+            return
+        self.apply_long_delta(full_to_long_marg(records, self.atts), sign)
+
+    def replace_zones(
+        self,
+        old_zones: Dict[object, pl.DataFrame],
+        new_zones: Dict[object, pl.DataFrame],
+    ) -> None:
+        """The records of the old zones are replaced by the new ones (e.g. after adjusting an att)"""
+        if len(old_zones) > 0:
+            self.add_records(pl.concat(list(old_zones.values()), rechunk=False), -1)
+        if len(new_zones) > 0:
+            self.add_records(pl.concat(list(new_zones.values()), rechunk=False), 1)
+
+    def cell(self, zone: object, att: str, state: object) -> int:
+        row = self.zone_index.get(str(zone))
+        col = self.state_index[att].get(str(state))
+        if row is None or col is None:
+            return 0
+        return int(self.counts[att][row, col])
+
+    def states_diff(self, att: str, sub_census: pl.DataFrame) -> pl.DataFrame:
+        """census - syn for the zones and states of sub_census, as calculate_states_diff"""
+        states = [x for x in sub_census.columns if x != zone_field]
+        rows = np.array(
+            [self.zone_index.get(z, -1) for z in sub_census[zone_field].cast(pl.String)],
+            dtype=np.int64,
+        )
+        cols = np.array(
+            [self.state_index[att].get(s, -1) for s in states], dtype=np.int64
+        )
+        syn_counts = np.zeros((len(rows), len(cols)))
+        known_rows, known_cols = np.flatnonzero(rows >= 0), np.flatnonzero(cols >= 0)
+        syn_counts[np.ix_(known_rows, known_cols)] = self.counts[att][
+            np.ix_(rows[known_rows], cols[known_cols])
+        ]
+        census_counts = (
+            sub_census.select(pl.col(states).cast(pl.Float64).fill_null(0).fill_nan(0))
+            .to_numpy()
+            .reshape(len(rows), len(cols))
+        )
+        diff = census_counts - syn_counts
+        return sub_census.select(zone_field).with_columns(
+            pl.Series(s, diff[:, j]) for j, s in enumerate(states)
+        )
+
+    def to_long(self) -> pl.DataFrame:
+        """The non zero cells in long format"""
+        zones = np.array(list(self.zone_index.keys()), dtype=object)
+        ls_long = []
+        for att in self.atts:
+            states = np.array(list(self.state_index[att].keys()), dtype=object)
+            rows, cols = np.nonzero(self.counts[att])
+            ls_long.append(
+                pl.DataFrame(
+                    {
+                        zone_field: pl.Series(zones[rows], dtype=pl.String),
+                        att_col: pl.Series([att] * len(rows), dtype=pl.String),
+                        state_col: pl.Series(states[cols], dtype=pl.String),
+                        count_field: pl.Series(self.counts[att][rows, cols], dtype=pl.Int64),
+                    }
+                )
+            )
+        return pl.concat(ls_long)
+
+    def diff_long(self, census_long: pl.DataFrame) -> pl.DataFrame:
+        """census - syn in long format (see diff_long_marg), atts not tracked are 0 in syn"""
+        return diff_long_marg(census_long, self.to_long())
+
+    def check(self, syn_pop: PopLike) -> None:
+        """Compare with a full recount of syn_pop, raise if they differ"""
+        recount = full_to_long_marg(_to_frame(syn_pop), self.atts)
+        mismatch = diff_long_marg(recount, self.to_long()).filter(
+            pl.col(count_field) != 0
+        )
+        if len(mismatch) > 0:
+            raise AssertionError(
+                f"Tracked marginals differ from the recount in {len(mismatch)} cells, "
+                f"e.g. {mismatch.sort(MARG_KEYS).head(5).to_dicts()}"
+            )
+
+    def __repr__(self) -> str:
+        return f"MarginalTracker({len(self.zone_index)} zones, atts {self.atts})"
@@ -0,0 +1,120 @@
+"""
+Marginals in long format: one row per (zone, att, state) with its count
+
+The census (IPU layout: zones as rows, (att, state) as cols) and the marginals of a syn pop
+are converted once to this format, all the atts are counted in a single lazy query and
+the diff is one full join, missing zones/states are simply 0.
+The wide IPU layout is only rebuilt at the boundaries (SAA and the census checking take it).
+Zones and states are str, as in the census header.
+"""
+
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field, count_field
+from typing import List, Union
+
+att_col = "att"
+state_col = "state"
+MARG_KEYS = [zone_field, att_col, state_col]
+
+
+def full_to_long_marg(
+    full_pop: Union[pl.DataFrame, pd.DataFrame], atts: Union[None, List[str]] = None
+) -> pl.DataFrame:
+    """Count the records of each (zone, att, state), atts default to all the other cols"""
+    if isinstance(full_pop, pd.DataFrame):
+        full_pop = pl.from_pandas(full_pop)
+    assert zone_field in full_pop.columns
+    if atts is None:
+        atts = [x for x in full_pop.columns if x != zone_field]
+    # group on the original types (cheaper than str, e.g. the state codes), cast after
+    lazy_pop = full_pop.lazy()
+    return pl.concat(
+        [
+            lazy_pop.group_by(zone_field, att)
+            .len(name=count_field)
+            .select(
+                pl.col(zone_field).cast(pl.String),
+                pl.lit(att).alias(att_col),
+                pl.col(att).cast(pl.String).alias(state_col),
+                pl.col(count_field).cast(pl.Int64),
+            )
+            for att in atts
+        ]
+    ).collect()
+
+
+def wide_to_long_marg(marg: pd.DataFrame) -> pl.DataFrame:
+    """From the IPU layout (zone as index, (att, state) cols), missing values are 0"""
+    assert marg.columns.nlevels == 2
+    wide = pd.DataFrame(
+        marg.to_numpy(),
+        columns=[f"{i}" for i in range(marg.shape[1])],
+    )
+    wide.insert(0, zone_field, marg.index.astype(str))
+    col_keys = pl.DataFrame(
+        {
+            "_col": wide.columns[1:].tolist(),
+            att_col: [str(att) for att, _ in marg.columns],
+            state_col: [str(state) for _, state in marg.columns],
+        }
+    )
+    long_marg = (
+        pl.from_pandas(wide)
+        .unpivot(index=zone_field, variable_name="_col", value_name=count_field)
+        .join(col_keys, on="_col")
+        .select(MARG_KEYS + [count_field])
+    )
+    if long_marg.schema[count_field].is_float():
+        long_marg = long_marg.with_columns(pl.col(count_field).fill_nan(0))
+    return long_marg.with_columns(pl.col(count_field).fill_null(0))
+
+
+def long_to_wide_marg(long_marg: pl.DataFrame) -> pd.DataFrame:
+    """To the IPU layout, zones and (att, state) cols are sorted, missing cells are 0
+
+    The zones (str) are sorted as numbers when they are, e.g. "9" before "10"
+    """
+    col_keys = (
+        long_marg.select(att_col, state_col)
+        .unique()
+        .sort([att_col, state_col])
+        .with_row_index("_col")
+        .with_columns(pl.col("_col").cast(pl.String))
+    )
+    wide = (
+        long_marg.join(col_keys, on=[att_col, state_col])
+        .pivot("_col", index=zone_field, values=count_field)
+        .sort(
+            pl.col(zone_field).cast(pl.Int64, strict=False),
+            pl.col(zone_field),
+            nulls_last=True,
+        )
+    )
+    result = wide.select(col_keys["_col"].to_list()).fill_null(0).to_pandas()
+    result.columns = pd.MultiIndex.from_tuples(
+        list(col_keys.select(att_col, state_col).iter_rows())
+    )
+    result.index = pd.Index(wide[zone_field].to_list(), name=zone_field)
+    return result
+
+
+def diff_long_marg(census_long: pl.DataFrame, syn_long: pl.DataFrame) -> pl.DataFrame:
+    """census - syn for every (zone, att, state) in either of them"""
+    syn_suffix = "_syn"
+    return (
+        census_long.join(
+            syn_long, on=MARG_KEYS, how="full", coalesce=True, suffix=syn_suffix
+        )
+        .select(
+            MARG_KEYS
+            + [
+                (
+                    pl.col(count_field).fill_null(0)
+                    - pl.col(f"{count_field}{syn_suffix}").fill_null(0)
+                ).alias(count_field)
+            ]
+        )
+        .sort(MARG_KEYS)
+    )
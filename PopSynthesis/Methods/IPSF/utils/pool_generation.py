@@ -0,0 +1,129 @@
+"""
+Generating the BN pools (HH and the relationship pools) by shards across worker processes
+
+The pool_size of each pool is split into n_workers shards, each shard has its own generator
+from np.random.SeedSequence(seed).spawn (first by pool, then by shard), so a pool depends
+only on (seed, n_workers, chunk_size) and not on which worker ran which shard or when.
+A shard samples its records by chunks with CompiledBN.iter_chunks (as state codes), condenses
+them to (comb, count) as it goes and writes a single parquet part, so neither a worker nor
+the main process ever holds the full pool. The parts of a pool are then merged into the
+condensed pool (the combs sorted by codes, deterministic), decoded to the state names.
+All the shards of all the pools go to the same process pool.
+"""
+
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame, scan_frame
+from typing import Dict, List, Tuple, Union
+
+# (sampler, n records, seed of the shard, path of the part, chunk size)
+ShardTask = Tuple[CompiledBN, int, np.random.SeedSequence, Path, int]
+
+
+def shard_sizes(n: int, n_shards: int) -> List[int]:
+    """n split as evenly as possible, the first shards get the remainder"""
+    assert n_shards > 0
+    return [n // n_shards + (1 if i < n % n_shards else 0) for i in range(n_shards)]
+
+
+def sample_shard(task: ShardTask) -> Path:
+    """Sample a shard by chunks and write it condensed (codes + count)"""
+    sampler, n, seed_seq, part_path, chunk_size = task
+    rng = np.random.default_rng(seed_seq)
+    part = None
+    for chunk in sampler.iter_chunks(n, chunk_size, rng):
+        counts = condense_df(chunk).with_columns(pl.col(count_field).cast(pl.Int64))
+        part = counts if part is None else merge_counts([part, counts], sampler.nodes)
+    if part is None:
+        part = sampler.sample(0, decode=False).with_columns(
+            pl.lit(0, dtype=pl.Int64).alias(count_field)
+        )
+    return save_frame(part, part_path)
+
+
+def merge_counts(counts: List[pl.DataFrame], nodes: List[str]) -> pl.DataFrame:
+    return (
+        pl.concat(counts)
+        .group_by(nodes, maintain_order=True)
+        .agg(pl.col(count_field).sum())
+    )
+
+
+def merge_parts(
+    part_paths: List[Path], sampler: CompiledBN, decode: bool = True
+) -> pl.DataFrame:
+    """The condensed pool from the parts of its shards"""
+    pool = (
+        pl.concat([scan_frame(path) for path in part_paths])
+        .group_by(sampler.nodes)
+        .agg(pl.col(count_field).sum())
+        .filter(pl.col(count_field) > 0)
+        .sort(sampler.nodes)
+        .collect()
+    )
+    return sampler.categories.decode(pool) if decode else pool
+
+
+def generate_pools(
+    samplers: Dict[str, CompiledBN],
+    pool_size: int,
+    out_dir: Union[str, Path],
+    seed: Union[None, int] = None,
+    n_workers: int = 1,
+    chunk_size: int = 1_000_000,
+    decode: bool = True,
+) -> Dict[str, pl.DataFrame]:
+    """The condensed pools (comb + count), each of pool_size records, parts in out_dir/name
+
+    The same seed, n_workers and chunk_size give the same pools, seed None is not reproducible
+    """
+    out_dir = Path(out_dir)
+    tasks: List[ShardTask] = []
+    part_paths: Dict[str, List[Path]] = {}
+    pool_seeds = np.random.SeedSequence(seed).spawn(len(samplers))
+    for (name, sampler), pool_seed in zip(samplers.items(), pool_seeds):
+        part_paths[name] = []
+        for i, (shard_seed, n) in enumerate(
+            zip(pool_seed.spawn(n_workers), shard_sizes(int(pool_size), n_workers))
+        ):
+            part_path = out_dir / name / f"part-{i:05d}.parquet"
+            part_paths[name].append(part_path)
+            tasks.append((sampler, n, shard_seed, part_path, chunk_size))
+
+    if n_workers > 1:
+        # spawn so the workers do not inherit the polars thread pool
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=mp.get_context("spawn")
+        ) as executor:
+            list(executor.map(sample_shard, tasks))
+    else:
+        for task in tasks:
+            sample_shard(task)
+
+    return {
+        name: merge_parts(paths, samplers[name], decode)
+        for name, paths in part_paths.items()
+    }
+
+
+def generate_pool(
+    sampler: CompiledBN,
+    pool_size: int,
+    out_dir: Union[str, Path],
+    seed: Union[None, int] = None,
+    n_workers: int = 1,
+    chunk_size: int = 1_000_000,
+    decode: bool = True,
+) -> pl.DataFrame:
+    """A single condensed pool, see generate_pools"""
+    return generate_pools(
+        {"pool": sampler}, pool_size, out_dir, seed, n_workers, chunk_size, decode
+    )["pool"]
@@ -0,0 +1,86 @@
+"""
+Sampling the full records from counts of the considered atts, in one batch
+
+The pool is grouped once by the considered atts: the other atts are stored sorted by group
+(flat arrays with group offsets) with the cumulative weights normalised within each group,
+the same cdf as np.random.choice with p. The cdf of group g is shifted by g, so a single
+searchsorted of (g + uniform) finds the draws of all groups at once, then one gather.
+"""
+
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from typing import List, Union
+
+
+class PoolSamplingIndex:
+    """The pool grouped by considered_atts, to sample the other atts for any syn counts"""
+
+    group_col = "_group"
+
+    def __init__(
+        self, pool: pl.DataFrame, considered_atts: List[str], weight_col: str = count_field
+    ) -> None:
+        assert weight_col in pool.columns
+        self.considered_atts = considered_atts
+        self.other_atts = [
+            x for x in pool.columns if x not in considered_atts + [weight_col]
+        ]
+        order_col = "_order"
+        keys = (
+            pool.select(considered_atts)
+            .unique(maintain_order=True)
+            .with_row_index(self.group_col)
+        )
+        grouped = (
+            pool.with_row_index(order_col)
+            .join(keys, on=considered_atts, how="left")
+            .sort([self.group_col, order_col])
+        )
+        group_ids = grouped[self.group_col].to_numpy().astype(np.int64)
+        sizes = np.bincount(group_ids, minlength=len(keys))
+        starts = np.cumsum(sizes) - sizes
+
+        weights = grouped[weight_col].to_numpy().astype(float)
+        cum_weights = np.cumsum(weights)
+        before_group = (cum_weights - weights)[starts]
+        group_totals = cum_weights[starts + sizes - 1] - before_group
+        cdf = (cum_weights - np.repeat(before_group, sizes)) / np.repeat(
+            group_totals, sizes
+        )
+        self.shifted_cdf = cdf + group_ids
+        self.starts = starts
+        self.sizes = sizes
+        self.keys = keys
+        self.records = grouped.select(self.other_atts)
+
+    def sample(
+        self,
+        syn_count: pl.DataFrame,
+        count_col: str = count_field,
+        rng: Union[None, np.random.Generator] = None,
+    ) -> pl.DataFrame:
+        """Draw count_col records of the other atts for each row of syn_count"""
+        assert set(syn_count.columns) == set(self.considered_atts + [count_col])
+        joined = syn_count.join(self.keys, on=self.considered_atts)
+        assert len(joined) == len(syn_count)
+        # join does not keep the order, sort so the draws are reproducible
+        joined = joined.sort(self.considered_atts)
+
+        counts = joined[count_col].to_numpy().astype(np.int64)
+        row_of_draw = np.repeat(np.arange(len(joined)), counts)
+        syn_records = joined.select(self.considered_atts)[row_of_draw]
+        if len(self.other_atts) == 0:
+            return syn_records
+
+        # fall back to the global numpy state when no generator is given
+        uniform = np.random.random if rng is None else rng.random
+        group_of_draw = joined[self.group_col].to_numpy().astype(np.int64)[row_of_draw]
+        draws = np.searchsorted(
+            self.shifted_cdf, group_of_draw + uniform(len(row_of_draw)), side="right"
+        )
+        # float edge case, stay inside the group
+        starts = self.starts[group_of_draw]
+        draws = np.clip(draws, starts, starts + self.sizes[group_of_draw] - 1)
+        return syn_records.hstack(self.records[draws])
@@ -3,12 +3,13 @@ Tools for creating the pool
 
 BN we may need to move the code else where later
 """
+import numpy as np
 import pandas as pd
 
 from PopSynthesis.Methods.BN.utils.learn_BN import learn_struct_BN_score, learn_para_BN
-from pgmpy.sampling import BayesianModelSampling
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
 
-from typing import Dict, List, Union
+from typing import Any, Dict, List, Union
 
 
 def create_pool(
@@ -16,18 +17,23 @@ def create_pool(
     state_names: Union[None, Dict[str, List[str]]],
     pool_sz: int,
     special: bool = True,
+    rng: Union[None, np.random.Generator] = None,
+    required: Union[None, List[Dict[str, Any]]] = None,
+    n_per_missing: int = 1,
 ):
+    """required: combs (att: state) the pool must have, e.g. from census_required_states"""
     print("Learn BN")
     model = learn_struct_BN_score(seed, show_struct=False, state_names=state_names)
     model = learn_para_BN(model, seed, state_names=state_names)
     print("Doing the sampling")
-    inference = BayesianModelSampling(model)
-    pool = inference.forward_sample(size=pool_sz, show_progress=True)
-
-    # Special case, I will fix this to be dynamic later
-    if special and "hhinc" in pool.columns:
-        while "Negative income" not in list(pool["hhinc"].unique()):
-            print(list(pool["hhinc"].unique()))
-            print("Not yet have it, gotta sample negative inc again")
-            pool = inference.forward_sample(size=pool_sz, show_progress=True)
+    sampler = CompiledBN.from_pgmpy(model)
+    rng = np.random.default_rng() if rng is None else rng
+    required = [] if required is None else list(required)
+    # Special case, the negative income is rare but always in the census
+    if special and "hhinc" in sampler.nodes:
+        required.append({"hhinc": "Negative income"})
+    pool, report = sampler.sample_covering(pool_sz, required, n_per_missing, rng)
+    if len(report) > 0:
+        print(f"Topped up the pool with {report['n_added'].sum()} records")
+        print(report)
     return pool
@@ -0,0 +1,115 @@
+"""
+Read-only pools shared by the worker processes through memory mapped Arrow IPC files
+
+A pool is published once in the store (one uncompressed Arrow file per version), the
+workers get a small PoolHandle (picklable, only the path) and attach to the file with
+memory mapping: the numeric cols (e.g. the state codes from CategoricalDictionary and the
+count/weight col) are not copied, all the workers on a machine share the same pages.
+Each publish of the same name is a new version (e.g. the SAA pool of each run), the
+workers attached to an older version are not affected. Files are never modified after
+being written.
+"""
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.utils.storage import save_frame, IPC_SUFFIX
+from typing import Dict, List, NamedTuple, Union
+
+
+class PoolHandle(NamedTuple):
+    """What is sent to the workers instead of the pool"""
+
+    root: str
+    name: str
+    version: int
+
+    @property
+    def path(self) -> Path:
+        return Path(self.root) / self.name / f"v{self.version:05d}{IPC_SUFFIX}"
+
+    def attach(self) -> pl.DataFrame:
+        return pl.read_ipc(self.path, memory_map=True)
+
+    def attach_pandas(self) -> pd.DataFrame:
+        # pandas needs its own copy, for the funcs still working on pandas
+        return self.attach().to_pandas()
+
+
+class SharedPoolStore:
+    def __init__(self, root: Union[None, str, Path] = None) -> None:
+        # no root means a temporary store, removed by close()
+        self.is_temp = root is None
+        if root is None:
+            root = tempfile.mkdtemp(prefix="pool_store_")
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def versions(self, name: str) -> List[int]:
+        pool_dir = self.root / name
+        if not pool_dir.is_dir():
+            return []
+        return sorted(
+            int(p.name[1:6])
+            for p in pool_dir.iterdir()
+            if p.name.startswith("v") and p.name.endswith(IPC_SUFFIX)
+        )
+
+    def latest(self, name: str) -> PoolHandle:
+        versions = self.versions(name)
+        if len(versions) == 0:
+            raise KeyError(f"No pool {name} in the store {self.root}")
+        return PoolHandle(str(self.root), name, versions[-1])
+
+    def publish(self, name: str, pool: Union[pl.DataFrame, pd.DataFrame]) -> PoolHandle:
+        """Write the pool as a new version of name"""
+        versions = self.versions(name)
+        handle = PoolHandle(
+            str(self.root), name, versions[-1] + 1 if len(versions) > 0 else 0
+        )
+        if isinstance(pool, pd.DataFrame):
+            pool = pl.from_pandas(
+                pool.astype(
+                    {col: str for col in pool.columns if pool[col].dtype == object}
+                )
+            )
+        self._write(pool, handle.path)
+        return handle
+
+    def publish_all(
+        self, pools: Dict[str, Union[pl.DataFrame, pd.DataFrame]]
+    ) -> Dict[str, PoolHandle]:
+        return {name: self.publish(name, pool) for name, pool in pools.items()}
+
+    @staticmethod
+    def _write(df: pl.DataFrame, path: Path) -> None:
+        # write then rename, a worker never sees a partial file
+        tmp_path = path.parent / ".tmp" / path.name
+        save_frame(df, tmp_path, categorical=False)
+        os.replace(tmp_path, path)
+
+    def release(self, name: str, keep_last: int = 1) -> None:
+        """Remove the old versions of name, the workers must not be attached to them anymore"""
+        versions = self.versions(name)
+        to_remove = versions[:-keep_last] if keep_last > 0 else versions
+        for version in to_remove:
+            handle = PoolHandle(str(self.root), name, version)
+            handle.path.unlink()
+
+    def close(self) -> None:
+        if self.is_temp:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self) -> "SharedPoolStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"SharedPoolStore({self.root})"
@@ -0,0 +1,246 @@
+"""
+Typed columnar storage for the pools, paired pools, marginals and outputs
+
+- .parquet: compressed, the strings are dictionary encoded in the file, lazy scans only
+  read the needed cols/row groups. Used for everything by default.
+- .arrow (Arrow IPC, uncompressed): the strings are stored as categoricals (dictionary)
+  and read with memory mapping, for the big pools read many times (e.g. the BN pools).
+Marginals are stored in long format (see utils/marginals), the wide IPU layout with the
+2 level header is only rebuilt when loading.
+Paired pools are a folder with one file per pair (e.g. HH-Main.parquet) instead of one pickle,
+so a single pair can be loaded (or scanned) without the others.
+CSV is only an export format (export_csv), the old CSV/pickle files can be converted with
+the migrate_* funcs, the loaders fall back to them if not migrated yet.
+"""
+
+import pickle
+from pathlib import Path
+
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    wide_to_long_marg,
+    long_to_wide_marg,
+)
+from typing import Any, Dict, List, Union
+
+PARQUET_SUFFIX = ".parquet"
+IPC_SUFFIX = ".arrow"
+FrameLike = Union[pl.DataFrame, pd.DataFrame]
+
+
+def _to_polars(df: FrameLike) -> pl.DataFrame:
+    if isinstance(df, pd.DataFrame):
+        # mixed object cols (e.g. ids as int and str) cannot be typed
+        df = df.astype({col: str for col in df.columns if df[col].dtype == object})
+        return pl.from_pandas(df)
+    return df
+
+
+def save_frame(
+    df: FrameLike, path: Union[str, Path], categorical: bool = True
+) -> Path:
+    """Write to parquet or Arrow IPC (by the suffix of path)
+
+    categorical=False keeps the str cols as str in Arrow IPC (read back without any cast)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df = _to_polars(df)
+    if path.suffix == PARQUET_SUFFIX:
+        df.write_parquet(path)
+    elif path.suffix == IPC_SUFFIX:
+        # no compression so the reads can be memory mapped
+        if categorical:
+            df = df.with_columns(pl.col(pl.String).cast(pl.Categorical))
+        df.write_ipc(path, compression="uncompressed")
+    else:
+        raise ValueError(f"Unknown storage format: {path.suffix}")
+    return path
+
+
+def scan_frame(path: Union[str, Path]) -> pl.LazyFrame:
+    """Lazy scan, only what is selected/filtered after is read"""
+    path = Path(path)
+    if path.suffix == PARQUET_SUFFIX:
+        return pl.scan_parquet(path)
+    elif path.suffix == IPC_SUFFIX:
+        return pl.scan_ipc(path, memory_map=True).with_columns(
+            pl.col(pl.Categorical).cast(pl.String)
+        )
+    raise ValueError(f"Unknown storage format: {path.suffix}")
+
+
+def load_frame(
+    path: Union[str, Path],
+    columns: Union[None, List[str]] = None,
+    keep_categorical: bool = False,
+) -> pl.DataFrame:
+    """Read a stored frame, the categoricals of Arrow IPC are back to str unless keep_categorical"""
+    path = Path(path)
+    if path.suffix == PARQUET_SUFFIX:
+        return pl.read_parquet(path, columns=columns)
+    elif path.suffix == IPC_SUFFIX:
+        df = pl.read_ipc(path, columns=columns, memory_map=True)
+        if keep_categorical:
+            return df
+        return df.with_columns(pl.col(pl.Categorical).cast(pl.String))
+    raise ValueError(f"Unknown storage format: {path.suffix}")
+
+
+def save_paired_pools(
+    pools: Dict[str, FrameLike], pools_dir: Union[str, Path], suffix: str = PARQUET_SUFFIX
+) -> Path:
+    pools_dir = Path(pools_dir)
+    for name, pool in pools.items():
+        save_frame(pool, pools_dir / f"{name}{suffix}")
+    return pools_dir
+
+
+def load_paired_pools(
+    pools_dir: Union[str, Path], names: Union[None, List[str]] = None
+) -> Dict[str, pd.DataFrame]:
+    """The paired pools as pandas (as from the pickle), names default to all in the folder"""
+    pools_dir = Path(pools_dir)
+    paths = {
+        p.stem: p
+        for p in sorted(pools_dir.iterdir())
+        if p.suffix in [PARQUET_SUFFIX, IPC_SUFFIX]
+    }
+    if names is not None:
+        paths = {name: paths[name] for name in names}
+    return {name: load_frame(path).to_pandas() for name, path in paths.items()}
+
+
+def save_marginal(marg: pd.DataFrame, path: Union[str, Path]) -> Path:
+    """Store the census (IPU layout, zone as index or as a col) in long format"""
+    zone_cols = marg.columns[marg.columns.get_level_values(0) == zone_field]
+    if len(zone_cols) > 0:
+        marg = marg.set_index(zone_cols[0])
+    return save_frame(wide_to_long_marg(marg), path)
+
+
+def load_marginal(path: Union[str, Path], zone_type: type = int) -> pd.DataFrame:
+    """The census in the IPU layout, zones as index (cast to zone_type)"""
+    marg = long_to_wide_marg(load_frame(path))
+    marg.index = marg.index.astype(zone_type)
+    marg.index.name = zone_field
+    return marg.sort_index()
+
+
+def export_csv(df: FrameLike, path: Union[str, Path]) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _to_polars(df).write_csv(path)
+    return path
+
+
+def migrate_pickle_pools(
+    pickle_path: Union[str, Path], pools_dir: Union[None, str, Path] = None
+) -> Path:
+    """dict_pool_pairs_*.pickle to a folder of the same name (one file per pair)"""
+    pickle_path = Path(pickle_path)
+    with open(pickle_path, "rb") as handle:
+        pools = pickle.load(handle)
+    if pools_dir is None:
+        pools_dir = pickle_path.with_suffix("")
+    return save_paired_pools(pools, pools_dir)
+
+
+def migrate_marginal_csv(
+    csv_path: Union[str, Path],
+    out_path: Union[None, str, Path] = None,
+    drop_atts: List[str] = ["sample_geog"],
+) -> Path:
+    """2 level header census CSV to long format parquet"""
+    csv_path = Path(csv_path)
+    marg = pd.read_csv(csv_path, header=[0, 1])
+    marg = marg.drop(
+        columns=marg.columns[marg.columns.get_level_values(0).isin(drop_atts)]
+    )
+    if out_path is None:
+        out_path = csv_path.with_suffix(PARQUET_SUFFIX)
+    return save_marginal(marg, out_path)
+
+
+def migrate_csv(
+    csv_path: Union[str, Path], out_path: Union[None, str, Path] = None
+) -> Path:
+    """Plain CSV (pools, syn pop outputs) to parquet, the pandas index col is dropped"""
+    csv_path = Path(csv_path)
+    if out_path is None:
+        out_path = csv_path.with_suffix(PARQUET_SUFFIX)
+    df = pl.read_csv(csv_path, infer_schema_length=10000)
+    if "" in df.columns:
+        df = df.drop("")
+    return save_frame(df, out_path)
+
+
+def find_stored(path: Union[str, Path]) -> Path:
+    """The parquet/arrow version of path if migrated, else path itself"""
+    path = Path(path)
+    for suffix in [PARQUET_SUFFIX, IPC_SUFFIX]:
+        stored = path.with_suffix(suffix)
+        if stored.exists():
+            return stored
+    stored_dir = path.with_suffix("")
+    if path.suffix == ".pickle" and stored_dir.is_dir():
+        return stored_dir
+    return path
+
+
+def read_frame(path: Union[str, Path], **read_csv_kwargs: Any) -> pd.DataFrame:
+    """Loader for the runs: the stored version of path if migrated, else the CSV
+
+    read_csv_kwargs are for the CSV, only dtype is also applied to the stored version
+    """
+    stored = find_stored(path)
+    if stored.suffix in [PARQUET_SUFFIX, IPC_SUFFIX]:
+        df = load_frame(stored).to_pandas()
+        dtype = read_csv_kwargs.get("dtype", {})
+        return df.astype({col: t for col, t in dtype.items() if col in df.columns})
+    return pd.read_csv(stored, **read_csv_kwargs)
+
+
+def read_marginal(
+    path: Union[str, Path], drop_atts: List[str] = ["sample_geog"]
+) -> pd.DataFrame:
+    """The census in the IPU layout with zones as index, from the stored version if migrated"""
+    stored = find_stored(path)
+    if stored.suffix in [PARQUET_SUFFIX, IPC_SUFFIX]:
+        return load_marginal(stored)
+    marg = pd.read_csv(stored, header=[0, 1])
+    marg = marg.drop(
+        columns=marg.columns[marg.columns.get_level_values(0).isin(drop_atts)]
+    )
+    return marg.set_index(
+        marg.columns[marg.columns.get_level_values(0) == zone_field][0]
+    )
+
+
+def read_paired_pools(path: Union[str, Path]) -> Dict[str, pd.DataFrame]:
+    """The paired pools from the folder if migrated, else the pickle"""
+    stored = find_stored(path)
+    if stored.is_dir():
+        return load_paired_pools(stored)
+    with open(stored, "rb") as handle:
+        return pickle.load(handle)
+
+
+def migrate_data_dirs(data_dirs: List[Union[str, Path]]) -> List[Path]:
+    """Convert all the CSV/pickle inputs found in data_dirs, the old files are kept"""
+    migrated = []
+    for data_dir in data_dirs:
+        data_dir = Path(data_dir)
+        if not data_dir.is_dir():
+            continue
+        for path in sorted(data_dir.iterdir()):
+            if path.name.startswith("dict_pool_pairs_") and path.suffix == ".pickle":
+                migrated.append(migrate_pickle_pools(path))
+            elif path.suffix == ".csv" and "marginals" in path.stem:
+                migrated.append(migrate_marginal_csv(path))
+            elif path.suffix == ".csv":
+                migrated.append(migrate_csv(path))
+    return migrated
@@ -8,12 +8,17 @@ Then func to detect which part we can remove
 Output will be part of synthetic we keep and part we want to remove
 """
 
-import pandas as pd
 import pandas as pd
 import numpy as np
-from itertools import combinations, product
+from itertools import combinations
 from PopSynthesis.Methods.IPSF.const import count_field, zone_field
-from typing import List, Literal, Tuple, Dict
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    full_to_long_marg,
+    wide_to_long_marg,
+    long_to_wide_marg,
+    diff_long_marg,
+)
+from typing import List, Tuple, Dict, Iterator, Union
 import sys
 
 
@@ -41,68 +46,23 @@ def convert_count_to_full(
 def convert_full_to_marg_count(
     full_pop: pd.DataFrame, filter_ls: list[str] = []
 ) -> pd.DataFrame:
+    """Census like (IPU layout) marginals of the full pop, zones are str"""
     assert zone_field in full_pop.columns
     cols = [x for x in full_pop.columns if x not in filter_ls + [zone_field]]
-    ls_temp_hold = []
-    for att in cols:
-        full_pop[att] = full_pop[att].astype(str)
-        temp_hold = full_pop.groupby(zone_field)[att].value_counts().unstack().fillna(0)
-        temp_hold.columns = [(temp_hold.columns.name, x) for x in temp_hold.columns]
-        temp_hold = temp_hold.astype(int)
-        ls_temp_hold.append(temp_hold)
-    marg_new_raw = pd.concat(ls_temp_hold, axis=1)
-    convert_marg_dict = {
-        com_col: marg_new_raw[com_col] for com_col in marg_new_raw.columns
-    }
-    convert_marg_dict[(zone_field, None)] = marg_new_raw.index
-    new_marg_hh = pd.DataFrame(convert_marg_dict)
-    ls_drop_m = list(
-        new_marg_hh.columns[new_marg_hh.columns.get_level_values(0).isin([zone_field])]
-    )
-    new_marg_hh = new_marg_hh.drop(columns=ls_drop_m)
-    return new_marg_hh
-
-
-def add_0_to_missing(
-    df: pd.DataFrame, ls_missing: List[str], axis: Literal[0, 1]
-) -> pd.DataFrame:
-    for missing in ls_missing:
-        if axis == 1:  # by row
-            df.loc[missing] = 0
-        elif axis == 0:  # by col
-            df[missing] = 0
-    return df
+    return long_to_wide_marg(full_to_long_marg(full_pop, cols))
 
 
 def get_diff_marg(
     converted_census_marg: pd.DataFrame, converted_new_hh_marg: pd.DataFrame
 ) -> pd.DataFrame:
+    """census - new for the union of the zones and (att, state) of both, missing are 0"""
     print("getting the diff marg df")
-    converted_census_marg.index = converted_census_marg.index.astype(str)
-    converted_new_hh_marg.index = converted_new_hh_marg.index.astype(str)
-    # make sure they both have the same rows and cols, if not it means 0
-    missing_cols_ori = set(converted_new_hh_marg.columns) - set(
-        converted_census_marg.columns
-    )
-    missing_cols_kept = set(converted_census_marg.columns) - set(
-        converted_new_hh_marg.columns
-    )
-    missing_rows_ori = set(converted_new_hh_marg.index) - set(
-        converted_census_marg.index
-    )
-    missing_rows_kept = set(converted_census_marg.index) - set(
-        converted_new_hh_marg.index
-    )
-
-    converted_new_hh_marg = add_0_to_missing(
-        converted_new_hh_marg, missing_cols_kept, 0
-    )
-    converted_new_hh_marg = add_0_to_missing(
-        converted_new_hh_marg, missing_rows_kept, 1
+    return long_to_wide_marg(
+        diff_long_marg(
+            wide_to_long_marg(converted_census_marg),
+            wide_to_long_marg(converted_new_hh_marg),
+        )
     )
-    converted_census_marg = add_0_to_missing(converted_census_marg, missing_cols_ori, 0)
-    converted_census_marg = add_0_to_missing(converted_census_marg, missing_rows_ori, 1)
-    return converted_census_marg - converted_new_hh_marg
 
 
 def convert_to_dict_ls(tup: Tuple[Tuple[str, str]]) -> Dict[str, str]:
@@ -112,81 +72,111 @@ def convert_to_dict_ls(tup: Tuple[Tuple[str, str]]) -> Dict[str, str]:
     return di
 
 
+def _sort_desc_order(values: np.ndarray) -> np.ndarray:
+    # the same order as pd.Series.sort_values(ascending=False), ties included
+    idx = np.arange(len(values))[::-1]
+    return idx[values[::-1].argsort(kind="quicksort")][::-1]
+
+
+def _iter_neg_combs(
+    att_groups: List[List[Tuple[str, str]]],
+    zone_codes: Dict[str, np.ndarray],
+    zone_counts: np.ndarray,
+    state_codes: Dict[str, Dict[str, int]],
+    neg: Dict[Tuple[str, str], float],
+) -> Iterator[Tuple[List[Tuple[str, str]], np.ndarray]]:
+    """Same combs and order as product(*att_groups), with the rows matching each comb
+
+    A prefix is skipped if one of its states has nothing left to delete or no records kept
+    match it, all the combs starting with it would be skipped anyway.
+    Deleting only makes both true for more prefixes, so checking when reaching it is enough
+    """
+
+    def _extend(prefix, mask, k):
+        if k == len(att_groups):
+            yield prefix, mask
+            return
+        for att, state in att_groups[k]:
+            if att != zone_field and neg[(att, state)] == 0:
+                continue
+            code = state_codes[att].get(str(state))
+            if code is None:
+                continue
+            sub_mask = mask & (zone_codes[att] == code)
+            if not (zone_counts[sub_mask] > 0).any():
+                continue
+            yield from _extend(prefix + [(att, state)], sub_mask, k + 1)
+
+    yield from _extend([], np.ones(len(zone_counts), dtype=bool), 0)
+
+
 def adjust_kept_rec_match_census(
-    syn_records: pd.DataFrame, diff_census: pd.DataFrame
-) -> pd.DataFrame:
-    # The point is to remove the chosen in
-    syn_records = syn_records.astype(str)
-    count_kept = syn_records.value_counts()
-    # diff_census = diff_census.head(10) # sample to check smaller
-    # diff_census = diff_census.set_index(diff_census.columns[diff_census.columns.get_level_values(0)==zone_field])
+    syn_records: pd.DataFrame, diff_census: pd.DataFrame, return_deleted: bool = False
+) -> Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """Delete records so no state is above the census (the negative values of diff_census)
+
+    For each zone, combs of the negative states of as many atts as possible first,
+    the records matching a comb are deleted in proportion to their counts.
+    The counts of each zone are kept as arrays with the states as integer codes
+    instead of a MultiIndex Series.
+    With return_deleted, also output the deleted records (to update the marginals by delta)
+    The records keep their types (e.g. the state codes of CategoricalDictionary), only the
+    states of the levels are matched as str with the census cols (and zones)
+    """
+    count_kept = syn_records.value_counts(dropna=False)
+    index = count_kept.index
+    counts = count_kept.to_numpy().astype(float)
+    level_codes = {name: index.codes[i] for i, name in enumerate(index.names)}
+    state_codes = {
+        name: {str(state): code for code, state in enumerate(index.levels[i])}
+        for i, name in enumerate(index.names)
+    }
+
     for zone, r in diff_census.iterrows():
         sys.stdout.write(f"\rDOING deleting to match cencus diff for {zone}")
         sys.stdout.flush()
-        sub_count_kept = count_kept.loc[
-            count_kept.index.get_level_values(zone_field) == zone
-        ]
-        # before_sum = sub_count_kept.sum()
-        prev_indexs = sub_count_kept.index
+        zone_code = state_codes[zone_field].get(str(zone), -1)
+        zone_rows = np.flatnonzero(level_codes[zone_field] == zone_code)
+        zone_counts = counts[zone_rows]
+        zone_codes = {att: codes[zone_rows] for att, codes in level_codes.items()}
+
         neg_cols = r[r < 0]
-        # re check with neg val
-        dict_neg_v = convert_to_dict_ls(neg_cols.index)
-        for i in range(len(dict_neg_v)):
-            raws_before_comb = combinations(dict_neg_v.values(), len(dict_neg_v) - i)
-            for raw in raws_before_comb:
-                if neg_cols.sum() == 0:
+        neg = dict(zip(neg_cols.index, neg_cols.to_numpy().astype(float)))
+        att_groups = list(convert_to_dict_ls(neg_cols.index).values())
+        for n_atts in range(len(att_groups), 0, -1):
+            for groups in combinations(att_groups, n_atts):
+                if all(v == 0 for v in neg.values()):
                     break
-                ls_pos_neg_comb = list(product(*raw))
-                for comb in ls_pos_neg_comb:
-                    # loop through each neg combs all
-                    condi_check = True
-                    to_del_n = np.inf
-                    # search for sub df with combs and also dfind the
-                    for att, state in comb:
-                        condi_check &= (
-                            sub_count_kept.index.get_level_values(att) == state
-                        )
-                        if att != zone_field:
-                            check_v = neg_cols.loc[(att, state)] * -1
-                            if check_v < to_del_n:
-                                to_del_n = check_v
-                    filtered_combs_from_kept = sub_count_kept.loc[condi_check]
-
-                    if len(filtered_combs_from_kept) == 0 or to_del_n == 0:
+                for comb, mask in _iter_neg_combs(
+                    list(groups), zone_codes, zone_counts, state_codes, neg
+                ):
+                    rows = np.flatnonzero(mask & (zone_counts > 0))
+                    to_del_n = min(
+                        [-neg[(att, state)] for att, state in comb if att != zone_field],
+                        default=np.inf,
+                    )
+                    if len(rows) == 0 or to_del_n == 0:
                         continue
+                    kept = zone_counts[rows]
+                    sum_val = kept.sum()
+                    to_del_n = min(to_del_n, sum_val)
 
-                    sum_val = filtered_combs_from_kept.sum()
-                    if sum_val < to_del_n:
-                        to_del_n = sum_val
-
-                    # we need to spread the del_n by the dist
-                    temp_hold_combs = filtered_combs_from_kept / sum_val
-                    temp_hold_combs = temp_hold_combs * to_del_n
-
-                    # First del by just normal rounding
-                    to_del_first = np.floor(temp_hold_combs)
-                    filtered_combs_from_kept = filtered_combs_from_kept - to_del_first
+                    # spread to_del_n by the dist, floor first then 1 more for the top
+                    to_del_first = np.floor(kept / sum_val * to_del_n)
+                    kept = kept - to_del_first
                     remaining_to_del = to_del_n - to_del_first.sum()
-                    # we will spread the remaing to del for the top
-                    filtered_combs_from_kept.sort_values(ascending=False, inplace=True)
-                    filtered_combs_from_kept.iloc[: int(remaining_to_del)] -= 1
-                    # Make sure there are no neg
-                    assert not any(filtered_combs_from_kept < 0)
-
-                    # Update the count kept
-                    sub_count_kept.loc[
-                        filtered_combs_from_kept.index
-                    ] = filtered_combs_from_kept
-                    neg_cols.loc[list(comb)] += to_del_n
-                    sub_count_kept = sub_count_kept[sub_count_kept > 0]
-        zero_indexes = set(prev_indexs) - set(sub_count_kept.index)
-        count_kept.loc[sub_count_kept.index] = sub_count_kept
-        count_kept.loc[list(zero_indexes)] = 0
-        assert neg_cols.sum() == 0
-        # after_sum = count_kept.loc[
-        #     count_kept.index.get_level_values(zone_field) == zone
-        # ].sum()
-        # sys.stdout.write(f"\rFINISHED deleting {before_sum - after_sum} records to match cencus diff for {zone}")
-        # sys.stdout.flush()
+                    kept[_sort_desc_order(kept)[: int(remaining_to_del)]] -= 1
+                    assert not (kept < 0).any()
+
+                    zone_counts[rows] = kept
+                    for key in comb:
+                        neg[key] += to_del_n
+        counts[zone_rows] = zone_counts
+        assert sum(neg.values()) == 0
     print()
-    return convert_count_to_full(count_kept.reset_index())
+    kept_counts = pd.Series(counts.astype(int), index=index, name=count_kept.name)
+    kept_records = convert_count_to_full(kept_counts.reset_index())
+    if not return_deleted:
+        return kept_records
+    deleted_counts = count_kept - kept_counts
+    return kept_records, convert_count_to_full(deleted_counts.reset_index())
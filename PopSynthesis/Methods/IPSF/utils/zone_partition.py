@@ -0,0 +1,65 @@
+"""
+Store the synthetic population partitioned by zone
+
+SAA works zone by zone, filtering the whole population for each zone is O(zones x rows).
+Here we split the population once (O(rows)) and read/write each zone directly.
+"""
+
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+
+class ZonePartitionedPop:
+    def __init__(
+        self, partitions: Dict[Any, pl.DataFrame], zone_col: str = zone_field
+    ) -> None:
+        # NOTE: the order of the zones is kept (dict insertion order)
+        self.zone_col = zone_col
+        self.partitions = {
+            zid: df for zid, df in partitions.items() if not df.is_empty()
+        }
+
+    @classmethod
+    def from_frame(
+        cls, df: pl.DataFrame, zone_col: str = zone_field
+    ) -> "ZonePartitionedPop":
+        assert zone_col in df.columns
+        partitions = df.partition_by(zone_col, as_dict=True, maintain_order=True)
+        # keys are tuples of the partitioned cols
+        return cls({key[0]: sub_df for key, sub_df in partitions.items()}, zone_col)
+
+    def zones(self) -> List[Any]:
+        return list(self.partitions.keys())
+
+    def get(self, zid: Any) -> Union[None, pl.DataFrame]:
+        return self.partitions.get(zid)
+
+    def set(self, zid: Any, df: pl.DataFrame) -> None:
+        if df.is_empty():
+            self.partitions.pop(zid, None)
+        else:
+            self.partitions[zid] = df
+
+    def items(self) -> Iterator[Tuple[Any, pl.DataFrame]]:
+        return iter(self.partitions.items())
+
+    @property
+    def height(self) -> int:
+        return sum(df.height for df in self.partitions.values())
+
+    def __len__(self) -> int:
+        return self.height
+
+    def __contains__(self, zid: Any) -> bool:
+        return zid in self.partitions
+
+    def to_frame(self, rechunk: bool = True) -> pl.DataFrame:
+        """Combine back to one frame, rechunk=False is cheap for one-off group_by"""
+        if len(self.partitions) == 0:
+            return pl.DataFrame()
+        return pl.concat(list(self.partitions.values()), rechunk=rechunk)
+
+    def __repr__(self) -> str:
+        return f"ZonePartitionedPop({len(self.partitions)} zones, {self.height} rows)"
@@ -2,7 +2,7 @@ import pandas as pd
 import os
 
 from PopSynthesis.Methods.BN.utils.learn_BN import learn_struct_BN_score, learn_para_BN
-from pgmpy.sampling import BayesianModelSampling
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
 from PopSynthesis.Methods.connect_HH_PP.paras_dir import processed_data
 
 
@@ -17,8 +17,8 @@ def main():
     model = learn_para_BN(model, df_seed)
     print("Doing the sampling")
     # census_df = pd.read_csv(os.path.join(data_dir, "census_sa1.csv"))
-    inference = BayesianModelSampling(model)
-    final_syn_pop = inference.forward_sample(size=2000000, show_progress=True)
+    inference = CompiledBN.from_pgmpy(model)
+    final_syn_pop = inference.sample_pandas(2000000)
     final_syn_pop.to_csv(
         os.path.join(processed_data, "SynPop_hh_check_foward_sa1.csv"), index=False
     )
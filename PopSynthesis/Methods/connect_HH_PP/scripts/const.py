@@ -56,3 +56,6 @@ PP_ATTS = [
     "anywork",
 ]
 NOT_INCLUDED_IN_BN_LEARN = ["hhid", "persid", "relationship"]
+
+SEED = 42  # of the pools (and the HH-Main pool in process_all_hh_pp)
+N_WORKERS = 4  # processes sampling the shards of the pools
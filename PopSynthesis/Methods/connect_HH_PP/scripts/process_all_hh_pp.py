@@ -13,7 +13,7 @@ import pickle
 import os
 
 from PopSynthesis.Methods.BN.utils.learn_BN import learn_struct_BN_score
-from pgmpy.sampling import BayesianModelSampling
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
 
 from PopSynthesis.Methods.connect_HH_PP.paras_dir import (
     processed_data,
@@ -23,7 +23,7 @@ from PopSynthesis.Methods.connect_HH_PP.paras_dir import (
 from PopSynthesis.DataProcessor.utils.seed.pp.process_relationships import (
     AVAILABLE_RELATIONSHIPS,
 )
-from PopSynthesis.Methods.connect_HH_PP.scripts.const import PP_ATTS
+from PopSynthesis.Methods.connect_HH_PP.scripts.const import PP_ATTS, SEED, N_WORKERS
 from PopSynthesis.Methods.connect_HH_PP.paras_dir import data_dir
 from PopSynthesis.Methods.connect_HH_PP.scripts.sample_hh_main import (
     samp_from_pool_1layer,
@@ -58,22 +58,26 @@ def get_hh_main_df(pool, chosen_att, marg_hh=None):
     return final_syn_hh_main
 
 
-def get_pool(df_seed, state_names, pool_sz, special=True):
+def get_pool(df_seed, state_names, pool_sz, special=True, rng=None):
     print("Learn BN")
     model = learn_struct_BN_score(df_seed, show_struct=False, state_names=state_names)
     model = learn_para_BN(model, df_seed, state_names=state_names)
     print("Doing the sampling")
-    inference = BayesianModelSampling(model)
-    pool = inference.forward_sample(size=pool_sz, show_progress=True)
-    pool = filter_pool(pool)
+    inference = CompiledBN.from_pgmpy(model)
+    rng = np.random.default_rng() if rng is None else rng
+    pool = inference.sample_pandas(pool_sz, rng)
 
-    # Special case, I will fix this to be dynamic later
+    # Special case, negative income is rare: top up only the missing, some may be filtered
     if special:
-        while "Negative income" not in list(pool["hhinc"].unique()):
-            print(list(pool["hhinc"].unique()))
-            print("Not yet have it, gotta sample negative inc again")
-            pool = inference.forward_sample(size=pool_sz, show_progress=True)
-            pool = filter_pool(pool)
+        pool, report = inference.top_up(
+            pool, [{"hhinc": "Negative income"}], n_per_missing=100, rng=rng
+        )
+        if len(report) > 0:
+            print(f"Topped up the pool with {report['n_added'].sum()} records")
+            print(report)
+    pool = filter_pool(pool)
+    if special and "Negative income" not in list(pool["hhinc"].unique()):
+        print("The pool still has no negative income after filtering")
     return pool
 
 
@@ -91,12 +95,16 @@ def main():
     # drop all the ids as they are not needed for in BN learning
     id_cols = [x for x in df_seed.columns if "hhid" in x or "persid" in x]
     df_seed = df_seed.drop(columns=id_cols)
-    pool_hh_main = get_pool(df_seed, state_names, pool_sz=POOL_SZ)
+    pool_hh_main = get_pool(
+        df_seed, state_names, pool_sz=POOL_SZ, rng=np.random.default_rng(SEED)
+    )
 
     all_rela_exist = AVAILABLE_RELATIONSHIPS.copy()
     all_rela_exist.remove("Main")
     dict_model_inference = inference_model_get(all_rela_exist, pp_state_names)
-    dict_pool_sample = pools_get(all_rela_exist, dict_model_inference, POOL_SZ)
+    dict_pool_sample = pools_get(
+        all_rela_exist, dict_model_inference, POOL_SZ, seed=SEED, n_workers=N_WORKERS
+    )
 
     ls_final_hh = []
     ls_final_pp = []
@@ -9,6 +9,7 @@ from PopSynthesis.Methods.connect_HH_PP.scripts.sample_hh_main import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.process_all_hh_pp import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.get_hh_main_combine import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.utils import *
+from PopSynthesis.Methods.connect_HH_PP.scripts.const import SEED, N_WORKERS
 import logging
 
 logger = logging.getLogger("connect_hh_pp")
@@ -72,7 +73,9 @@ def main():
     logger.info("GETTING the pool HH and Main")
     pool_hh_main = get_pool(df_seed_hh_main, state_names, int(1e5), special=False)
     dict_model_inference = inference_model_get(all_rela_exist, pp_state_names)
-    dict_pool_sample = pools_get(all_rela_exist, dict_model_inference, int(1e4))
+    dict_pool_sample = pools_get(
+        all_rela_exist, dict_model_inference, int(1e4), seed=SEED, n_workers=N_WORKERS
+    )
     dict_pool_sample["Main"] = pool_hh_main
 
     # chosen_poa = ["3000", "3002"]
@@ -4,6 +4,7 @@ import os
 from PopSynthesis.Methods.BN.utils.learn_BN import learn_struct_BN_score, learn_para_BN
 from pgmpy.sampling import BayesianModelSampling
 from pgmpy.factors.discrete import State
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
 
 from PopSynthesis.Methods.connect_HH_PP.paras_dir import (
     data_dir,
@@ -187,8 +188,7 @@ def new_run():
     model = learn_struct_BN_score(df_seed, show_struct=False, state_names=state_names)
     model = learn_para_BN(model, df_seed)
     print("Doing the sampling")
-    inference = BayesianModelSampling(model)
-    pool = inference.forward_sample(size=pool_sz, show_progress=True)
+    pool = CompiledBN.from_pgmpy(model).sample_pandas(pool_sz)
 
     pool = filter_pool(pool)
 
@@ -5,16 +5,23 @@ Sample alot (like 10 mil) and select the needed sample from it, we can combine w
 import pandas as pd
 import pickle
 import os
+import tempfile
 
 from PopSynthesis.Methods.BN.utils.learn_BN import learn_struct_BN_score
-from pgmpy.sampling import BayesianModelSampling
 from pgmpy.estimators import BayesianEstimator
 
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
+from PopSynthesis.Methods.IPSF.utils.pool_generation import generate_pools
 from PopSynthesis.Methods.connect_HH_PP.paras_dir import processed_data, geo_lev
 from PopSynthesis.DataProcessor.utils.seed.pp.process_relationships import (
     AVAILABLE_RELATIONSHIPS,
 )
-from PopSynthesis.Methods.connect_HH_PP.scripts.const import PP_ATTS, HH_ATTS
+from PopSynthesis.Methods.connect_HH_PP.scripts.const import (
+    PP_ATTS,
+    HH_ATTS,
+    SEED,
+    N_WORKERS,
+)
 
 
 init_n_pool = int(1e7)  # 10 Mils
@@ -65,17 +72,37 @@ def inference_model_get(ls_rela, state_names_base):
             df, show_struct=False, state_names=rela_state_names
         )
         model = learn_para_BN_diric(model, df, state_names=rela_state_names)
-        re_dict[rela] = BayesianModelSampling(model)
+        re_dict[rela] = CompiledBN.from_pgmpy(model)
     return re_dict
 
 
-def pools_get(ls_rela, dict_model_inference, pool_size):
-    re_dict = {}
-    for rela in ls_rela:
-        infer_model = dict_model_inference[rela]
-        pool = infer_model.forward_sample(size=int(pool_size), show_progress=True)
-        re_dict[rela] = pool
-    return re_dict
+def pools_get(
+    ls_rela, dict_model_inference, pool_size, pools_dir=None, seed=None, n_workers=1
+):
+    # the condensed pools of pools_count_get, process_rela_fast samples by the count
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        return pools_count_get(
+            ls_rela,
+            dict_model_inference,
+            pool_size,
+            tmp_dir if pools_dir is None else pools_dir,
+            seed=seed,
+            n_workers=n_workers,
+        )
+
+
+def pools_count_get(
+    ls_rela, dict_model_inference, pool_size, pools_dir, seed=None, n_workers=1
+):
+    # condensed pools (comb + count), the shards are sampled by n_workers processes
+    pools = generate_pools(
+        {rela: dict_model_inference[rela] for rela in ls_rela},
+        int(pool_size),
+        pools_dir,
+        seed=seed,
+        n_workers=n_workers,
+    )
+    return {rela: pool.to_pandas() for rela, pool in pools.items()}
 
 
 def process_rela_using_count(main_pp_df, rela, pool_count, geo_lev):
@@ -147,6 +174,8 @@ def process_rela_using_count(main_pp_df, rela, pool_count, geo_lev):
 
 
 def process_rela_fast(main_pp_df, rela, pool):
+    # the pool is condensed (comb + count, see pools_get) or one row per record
+    weights = "count" if "count" in pool.columns else None
     all_cols = [
         x
         for x in main_pp_df.columns
@@ -211,13 +240,13 @@ def process_rela_fast(main_pp_df, rela, pool):
             hold_id = [hhid] * n
             hold_ids += hold_id
             tot += n
-        re_df = to_sample_df.sample(n=tot, replace=True)
+        re_df = to_sample_df.sample(n=tot, replace=True, weights=weights)
         ls_to_com_df.append(re_df)
     if len(ls_to_com_df) == 0:
         print("Weird this has nothing")
         final_rela_df = []
     else:
-        final_rela_df = pd.concat(ls_to_com_df)
+        final_rela_df = pd.concat(ls_to_com_df).drop(columns=["count"], errors="ignore")
         final_rela_df["hhid"] = hold_ids
         final_rela_df["relationship"] = rela
 
@@ -243,7 +272,9 @@ def main():
     all_rela_exist.remove("Main")
 
     dict_model_inference = inference_model_get(all_rela_exist, state_names_pp)
-    dict_pool_sample = pools_get(all_rela_exist, dict_model_inference, 1e6)
+    dict_pool_sample = pools_get(
+        all_rela_exist, dict_model_inference, 1e6, seed=SEED, n_workers=N_WORKERS
+    )
 
     for rela in all_rela_exist:
         to_del_df, pop_rela = process_rela_fast(
@@ -11,6 +11,7 @@ from PopSynthesis.Methods.connect_HH_PP.scripts.adjust_atts import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.sample_hh_main import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.process_all_hh_pp import *
 from PopSynthesis.Methods.connect_HH_PP.scripts.get_hh_main_combine import *
+from PopSynthesis.Methods.connect_HH_PP.scripts.const import SEED, N_WORKERS
 
 
 POOL_SZ = int(1e7)
@@ -47,7 +48,9 @@ def main():
     all_rela_exist = AVAILABLE_RELATIONSHIPS.copy()
     all_rela_exist.remove("Main")
     dict_model_inference = inference_model_get(all_rela_exist, pp_state_names)
-    dict_pool_sample = pools_get(all_rela_exist, dict_model_inference, POOL_SZ)
+    dict_pool_sample = pools_get(
+        all_rela_exist, dict_model_inference, POOL_SZ, seed=SEED, n_workers=N_WORKERS
+    )
 
     ls_final_hh = []
     ls_final_pp = []
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.CSP.CSP import HHID
+from PopSynthesis.Methods.IPSF.CSP.common_run_funcs import (
+    encode_ipsf_inputs,
+    ipsf_chunked_loop,
+    ipsf_full_loop,
+    n_hh_in_marg,
+    read_chunked_output,
+    segment_zones,
+    update_CSP_combined_syn_hhmarg_pools,
+)
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+
+hh_states = {"hhsize": ["1", "2", "3"], "totalvehs": ["0", "1"]}
+pp_states = {
+    "age": ["20-29", "30-39"],
+    "sex": ["M", "F"],
+    "persinc": ["low", "high"],
+    "nolicence": ["yes", "no"],
+    "anywork": ["Y", "N"],
+}
+relas = ["Main", "Spouse", "Child", "Parent", "Sibling", "Others", "Grandchild", "Grandparent"]
+
+
+def census_of(syn_hh: pd.DataFrame) -> pd.DataFrame:
+    marg = {(zone_field, ""): np.sort(syn_hh[zone_field].unique())}
+    for att in hh_states:
+        counts = syn_hh.groupby(zone_field)[att].value_counts().unstack()
+        for state in counts.columns:
+            marg[(att, state)] = counts[state].fillna(0).astype(int).to_numpy()
+    return pd.DataFrame(marg)
+
+
+def make_inputs(n_zones: int = 5, n_hh: int = 15):
+    rng = np.random.default_rng(0)
+    # only hh with a Main
+    hh_main = pd.DataFrame({att: rng.choice(s, 300) for att, s in hh_states.items()})
+    for att, s in pp_states.items():
+        hh_main[f"{att}_Main"] = rng.choice(s, 300)
+    for rela in relas:
+        hh_main[rela] = 1 if rela == "Main" else 0
+    pools_ref = {"HH-Main": hh_main}
+    for root, rela in [
+        ("Main", "Spouse"),
+        ("Main", "Child"),
+        ("Main", "Parent"),
+        ("Main", "Sibling"),
+        ("Main", "Others"),
+        ("Child", "Grandchild"),
+        ("Parent", "Grandparent"),
+    ]:
+        pools_ref[f"{root}-{rela}"] = pd.DataFrame(
+            columns=[f"{att}_{r}" for r in [root, rela] for att in pp_states]
+        )
+    hh_pool = hh_main[list(hh_states)]
+
+    syn_hh = hh_pool.sample(n_zones * n_hh, replace=True, random_state=1)
+    syn_hh = syn_hh.reset_index(drop=True)
+    syn_hh[zone_field] = np.repeat(np.arange(n_zones), n_hh)
+    syn_hh[HHID] = syn_hh.index
+    census_src = hh_pool.sample(n_zones * n_hh, replace=True, random_state=2)
+    census_src[zone_field] = np.repeat(np.arange(n_zones), n_hh)
+    return syn_hh, hh_pool, census_of(census_src), pools_ref
+
+
+def test_segment_zones():
+    assert segment_zones([3, 1, 2, 1, 5], 2) == [[1, 2], [3, 5]]
+
+
+def test_chunked_loop_writes_all_zones(tmp_path):
+    syn_hh, hh_pool, hh_marg, pools_ref = make_inputs()
+    err_rm, final_pools = ipsf_chunked_loop(
+        list(hh_states),
+        syn_hh,
+        hh_pool,
+        hh_marg,
+        pools_ref,
+        tmp_path,
+        chunk_size=2,
+        max_run_time=2,
+        rng=np.random.default_rng(0),
+        n_csp_workers=2,
+    )
+    assert len(err_rm) == 3
+    assert set(final_pools) == set(pools_ref)
+
+    out_hh = read_chunked_output(tmp_path, "HH").collect()
+    out_pp = read_chunked_output(tmp_path, "PP").collect()
+    assert sorted(out_hh["chunk"].unique()) == [0, 1, 2]
+    assert set(out_hh[zone_field].cast(int)) <= set(range(5))
+    # ids are unique across the chunks, each hh has its Main
+    assert out_hh[HHID].n_unique() == len(out_hh)
+    assert set(out_pp[HHID]) == set(out_hh[HHID])
+    remaining = read_chunked_output(tmp_path, "remaining_marg").collect()
+    assert (remaining["count"] >= 0).all()
+
+
+def test_chunk_without_syn_hh_is_skipped(tmp_path):
+    syn_hh, hh_pool, hh_marg, pools_ref = make_inputs(n_zones=2)
+    # a zone with no hh in the census, so none in the syn either
+    empty_zone = hh_marg.iloc[[0]].copy()
+    empty_zone.iloc[0] = 0
+    empty_zone[(zone_field, "")] = 7
+    hh_marg = pd.concat([hh_marg, empty_zone], ignore_index=True)
+    err_rm, _ = ipsf_chunked_loop(
+        list(hh_states), syn_hh, hh_pool, hh_marg, pools_ref, tmp_path,
+        chunk_size=1, max_run_time=1,
+    )
+    assert len(err_rm) == 3
+    assert err_rm[2] == [0]
+    out_hh = read_chunked_output(tmp_path, "HH").collect()
+    assert sorted(out_hh["chunk"].unique()) == [0, 1]
+
+
+def test_target_n_hh_does_not_count_zone_ids(tmp_path):
+    marg = pd.DataFrame(
+        {(zone_field, ""): [100, 200], ("hhsize", "1"): [2, 3], ("totalvehs", "0"): [2, 3]}
+    )
+    assert n_hh_in_marg(marg, ["hhsize", "totalvehs"]) == 5
+    # the syn already matches the census: nothing to add
+    syn_hh, hh_pool, _, pools_ref = make_inputs(n_zones=3)
+    syn_hh[zone_field] += 100
+    err_rm, _ = ipsf_chunked_loop(
+        list(hh_states), syn_hh, hh_pool, census_of(syn_hh), pools_ref, tmp_path,
+        chunk_size=3, max_run_time=2,
+    )
+    assert err_rm == [[0]]
+
+
+def test_pools_without_error_recs_are_kept():
+    syn_hh, _, _, pools_ref = make_inputs(n_zones=2)
+    # no hhsize 3 in the HH-Main pool, these hh cannot get their Main
+    pools_ref["HH-Main"] = pools_ref["HH-Main"][pools_ref["HH-Main"]["hhsize"] != "3"]
+    pools_ref["Main-Spouse"] = pd.DataFrame(
+        [["20-29", "M", "low", "yes", "Y"] * 2], columns=pools_ref["Main-Spouse"].columns
+    )
+    hh_atts = list(hh_states)
+    updated_hh, _, _, updated_pools = update_CSP_combined_syn_hhmarg_pools(
+        syn_hh, census_of(syn_hh), pools_ref, list(pp_states), hh_atts, relas
+    )
+    assert len(updated_hh) < len(syn_hh)
+    # every pool is still there, only the ones related to the error recs (HH) changed
+    assert set(updated_pools) == set(pools_ref)
+    pd.testing.assert_frame_equal(updated_pools["Main-Spouse"], pools_ref["Main-Spouse"])
+    assert "3" not in set(updated_pools["HH-Main"]["hhsize"])
+
+
+def test_loops_on_state_codes(tmp_path):
+    syn_hh, hh_pool, hh_marg, pools_ref = make_inputs(n_zones=3)
+    categories = CategoricalDictionary(hh_states | pp_states)
+    (enc_hh, _, enc_marg, enc_pools), run_categories = encode_ipsf_inputs(
+        categories, syn_hh, hh_pool, hh_marg, pools_ref
+    )
+    assert enc_hh["hhsize"].dtype == np.uint8
+    assert enc_pools["HH-Main"]["age_Main"].dtype == np.uint8
+    assert ("hhsize", "0") in enc_marg.columns
+    pd.testing.assert_frame_equal(run_categories.decode_pandas(enc_hh), syn_hh)
+
+    _, _, str_err_rm, _ = ipsf_full_loop(
+        list(hh_states), syn_hh, hh_pool, hh_marg, pools_ref, max_run_time=1
+    )
+    final_hh, final_pp, err_rm, _ = ipsf_full_loop(
+        list(hh_states), syn_hh, hh_pool, hh_marg, pools_ref,
+        max_run_time=1, rng=np.random.default_rng(0), categories=categories,
+    )
+    # decoded at output, each hh has its pp
+    for att, states in (hh_states | pp_states).items():
+        df = final_hh if att in hh_states else final_pp
+        assert set(df[att]) <= set(states)
+    assert set(final_pp[HHID]) == set(final_hh[HHID])
+    # the same n of hh above the census as on the state names
+    assert err_rm[0] == str_err_rm[0]
+
+    err_rm, final_pools = ipsf_chunked_loop(
+        list(hh_states), syn_hh, hh_pool, hh_marg, pools_ref, tmp_path,
+        chunk_size=2, max_run_time=2, categories=categories,
+    )
+    assert set(final_pools["HH-Main"]["age_Main"]) <= set(pp_states["age"])
+    out_hh = read_chunked_output(tmp_path, "HH").collect()
+    assert set(out_hh["hhsize"]) <= set(hh_states["hhsize"])
+    remaining = read_chunked_output(tmp_path, "remaining_marg").collect()
+    assert set(remaining.filter(pl.col("att") == "hhsize")["state"]) <= {"1", "2", "3"}
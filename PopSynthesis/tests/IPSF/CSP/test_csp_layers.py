@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+from PopSynthesis.Methods.IPSF.const import HH_TAG
+from PopSynthesis.Methods.IPSF.CSP.CSP import (
+    CSP_run,
+    _sample_pair,
+    pair_layers,
+    ordered_pairs,
+    HHID,
+)
+
+hh_atts = ["hhsize", "totalvehs"]
+pp_atts = ["age", "sex"]
+relas = ["Main", "Spouse", "Child", "Parent", "Sibling", "Others", "Grandchild", "Grandparent"]
+
+
+def pp_cols(rela):
+    return [f"{x}_{rela}" for x in pp_atts]
+
+
+def make_inputs(n_hh: int = 120):
+    rng = np.random.default_rng(0)
+    ages = ["20-29", "30-39", "40-49"]
+    hh_main = pd.DataFrame(
+        {
+            "hhsize": rng.choice(["1", "2", "3"], 400),
+            "totalvehs": rng.choice(["0", "1"], 400),
+            "age_Main": rng.choice(ages, 400),
+            "sex_Main": rng.choice(["M", "F"], 400),
+        }
+    )
+    for rela in relas:
+        hh_main[rela] = rng.integers(0, 2, 400) if rela in ["Spouse", "Child"] else 0
+    hh_main["Main"] = 1
+    pools = {"HH-Main": hh_main}
+    for rela in relas[1:]:
+        root = {"Grandchild": "Child", "Grandparent": "Parent"}.get(rela, "Main")
+        n = 300 if rela in ["Spouse", "Child"] else 0
+        # no 40-49 Main in the Child pool, these hh cannot get their Child
+        pools[f"{root}-{rela}"] = pd.DataFrame(
+            {
+                f"age_{root}": rng.choice(ages if rela != "Child" else ages[:2], n),
+                f"sex_{root}": rng.choice(["M", "F"], n),
+                f"age_{rela}": rng.choice(ages, n),
+                f"sex_{rela}": rng.choice(["M", "F"], n),
+            }
+        )
+    syn_hh = pd.DataFrame(
+        {"hhsize": rng.choice(["1", "2", "3"], n_hh), "totalvehs": rng.choice(["0", "1"], n_hh)}
+    )
+    syn_hh[HHID] = np.arange(n_hh)
+    return syn_hh, pools
+
+
+def test_pair_layers():
+    pairs = [pair for layer in ordered_pairs for pair in layer]
+    assert pair_layers(pairs) == ordered_pairs
+
+
+def test_same_results_any_n_workers():
+    syn_hh, pools = make_inputs()
+    results = [
+        CSP_run(
+            syn_hh, pools, pp_atts, hh_atts, relas,
+            rng=np.random.default_rng(5), n_workers=n_workers,
+        )
+        for n_workers in [1, 3]
+    ]
+    for serial, parallel in zip(results[0][:2], results[1][:2]):
+        pd.testing.assert_frame_equal(serial, parallel)
+    for rela in results[0][2]:
+        pd.testing.assert_frame_equal(results[0][2][rela], results[1][2][rela])
+
+
+def test_removals_merged_into_root_and_layer():
+    syn_hh, pools = make_inputs()
+    final_hh, final_pp, removed = CSP_run(
+        syn_hh, pools, pp_atts, hh_atts, relas, rng=np.random.default_rng(1), n_workers=2
+    )
+    assert len(removed["Main"]) > 0
+    removed_hh = set(removed["Main"][HHID].astype(str))
+    # no pp left for the hh removed by any pair, each kept hh has its Main
+    assert not set(final_pp[HHID]) & removed_hh
+    mains = final_pp[final_pp["relationship"] == "Main"]
+    assert set(final_hh[HHID]) == set(mains[HHID])
+    assert not mains[HHID].duplicated().any()
+
+
+def test_failed_pair_does_not_affect_other_roots():
+    rng = np.random.default_rng(2)
+    ages = ["20-29", "30-39", "40-49"]
+    n = 300
+    hh_main = pd.DataFrame(
+        {
+            "hhsize": rng.choice(["1", "2"], n),
+            "totalvehs": rng.choice(["0", "1"], n),
+            "age_Main": rng.choice(ages, n),
+            "sex_Main": rng.choice(["M", "F"], n),
+        }
+    )
+    for rela in relas:
+        hh_main[rela] = 1 if rela in ["Main", "Child", "Parent", "Grandchild", "Grandparent"] else 0
+    pools = {"HH-Main": hh_main}
+    for root, rela in [("Main", "Child"), ("Main", "Parent"), ("Child", "Grandchild"), ("Parent", "Grandparent")]:
+        # no 40-49 Child in the Child-Grandchild pool, these hh cannot get their Grandchild
+        root_ages = ages[:2] if rela == "Grandchild" else ages
+        pools[f"{root}-{rela}"] = pd.DataFrame(
+            {
+                f"age_{root}": rng.choice(root_ages, n),
+                f"sex_{root}": rng.choice(["M", "F"], n),
+                f"age_{rela}": rng.choice(ages, n),
+                f"sex_{rela}": rng.choice(["M", "F"], n),
+            }
+        )
+    syn_hh = pd.DataFrame(
+        {"hhsize": rng.choice(["1", "2"], 100), "totalvehs": rng.choice(["0", "1"], 100)}
+    )
+    syn_hh[HHID] = np.arange(100)
+    _, final_pp, removed = CSP_run(
+        syn_hh, pools, pp_atts, hh_atts, relas, rng=np.random.default_rng(3), n_workers=2
+    )
+    failed_hh = set(removed["Child"][HHID].astype(str))
+    assert len(failed_hh) > 0
+    pp_by_rela = {
+        rela: set(final_pp[final_pp["relationship"] == rela][HHID].astype(str))
+        for rela in ["Child", "Grandchild", "Parent", "Grandparent"]
+    }
+    # the Child of a failed Child-Grandchild pair is removed (with its Grandchild)...
+    assert not failed_hh & (pp_by_rela["Child"] | pp_by_rela["Grandchild"])
+    # ...but the Parent-Grandparent pair of the same hh keeps its records
+    assert failed_hh <= pp_by_rela["Parent"]
+    assert failed_hh <= pp_by_rela["Grandparent"]
+
+
+def sequential_reference(syn_hh, pools):
+    """The pairs one after the other, each pair prunes its root before the next one"""
+    syn_results = {HH_TAG: syn_hh}
+    removed = {}
+    for root_rela, sample_rela in [pair for layer in ordered_pairs for pair in layer]:
+        if root_rela not in syn_results:
+            root_rela = "Main"
+        result = _sample_pair(
+            syn_results[root_rela], root_rela, sample_rela,
+            pools.get(f"{root_rela}-{sample_rela}"), pp_atts, hh_atts, relas,
+        )
+        if result is None:
+            continue
+        rela_pp, removed_syn = result
+        removed.setdefault(root_rela, []).append(removed_syn)
+        syn_results[sample_rela] = rela_pp
+        root_syn = syn_results[root_rela]
+        syn_results[root_rela] = root_syn[~root_syn[HHID].isin(removed_syn[HHID])]
+    return syn_results, {root: pd.concat(x, ignore_index=True) for root, x in removed.items()}
+
+
+def test_same_removals_as_sequential():
+    # one record per comb in the pools, the sampling does not depend on the draws
+    hh_combs = [(size, vehs) for size in ["1", "2", "3"] for vehs in ["0", "1"]]
+    main_combs = [(age, sex) for age in ["20-29", "30-39", "40-49"] for sex in ["M", "F"]]
+    hh_main = pd.DataFrame(
+        [[*hh, *main] for hh, main in zip(hh_combs, main_combs)],
+        columns=["hhsize", "totalvehs", "age_Main", "sex_Main"],
+    )
+    for rela in relas:
+        hh_main[rela] = 1 if rela in ["Main", "Spouse", "Child"] else 0
+    pools = {"HH-Main": hh_main}
+    # the 40-49 Main cannot get their Spouse, the F Main cannot get their Child
+    for rela, kept in [
+        ("Spouse", lambda age, sex: age != "40-49"),
+        ("Child", lambda age, sex: sex != "F"),
+    ]:
+        pools[f"Main-{rela}"] = pd.DataFrame(
+            [[age, sex, "20-29", "M"] for age, sex in main_combs if kept(age, sex)],
+            columns=["age_Main", "sex_Main", f"age_{rela}", f"sex_{rela}"],
+        )
+    rng = np.random.default_rng(4)
+    syn_hh = pd.DataFrame(
+        [hh_combs[i] for i in rng.integers(0, len(hh_combs), 60)],
+        columns=["hhsize", "totalvehs"],
+    )
+    syn_hh[HHID] = np.arange(60)
+
+    seq_results, seq_removed = sequential_reference(syn_hh, pools)
+    _, final_pp, removed = CSP_run(
+        syn_hh, pools, pp_atts, hh_atts, relas, rng=np.random.default_rng(5), n_workers=1
+    )
+    removed_hh = set(seq_removed["Main"][HHID].astype(str))
+    spouse_hh = set(seq_results["Spouse"][HHID].astype(str))
+    # the Spouse pair removes the 40-49 Main, the Child pair the other F Main after
+    # their Spouse were sampled
+    assert removed_hh - spouse_hh and removed_hh & spouse_hh
+
+    # each hh removed once, by the first pair failing it, as in the sequential run
+    pd.testing.assert_frame_equal(removed["Main"], seq_removed["Main"])
+    # the records of the removed hh are removed from all the pairs of the root
+    for rela in ["Main", "Spouse", "Child"]:
+        seq_pp = seq_results[rela]
+        seq_pp = seq_pp[~seq_pp[HHID].astype(str).isin(removed_hh)]
+        expected = sorted(
+            zip(seq_pp[HHID].astype(str), seq_pp[f"age_{rela}"], seq_pp[f"sex_{rela}"])
+        )
+        rela_pp = final_pp[final_pp["relationship"] == rela]
+        assert sorted(zip(rela_pp[HHID], rela_pp["age"], rela_pp["sex"])) == expected
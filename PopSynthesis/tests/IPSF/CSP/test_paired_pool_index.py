@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from PopSynthesis.Methods.IPSF.CSP.operations.paired_pool_index import (
+    PairedPoolIndex,
+    pool_evidence_cols,
+)
+from PopSynthesis.Methods.IPSF.CSP.operations.sample_from_pairs import (
+    update_by_rm_for_pool,
+)
+from typing import Dict, List
+
+rng = np.random.default_rng(0)
+pool = pd.DataFrame(
+    {
+        "age_Main": rng.choice(["10-19", "20-29", "30-39"], 300),
+        "sex_Main": rng.choice(["M", "F"], 300),
+        "age_Spouse": rng.choice(["10-19", "20-29", "30-39", "40-49"], 300),
+        "weight": rng.integers(0, 5, 300),
+    }
+)
+evidence_cols = ["age_Main", "sex_Main"]
+
+
+def update_by_rm_for_all_pools(
+    rm_df: pd.DataFrame, pools: Dict[str, pd.DataFrame], check_cols: List[str]
+) -> Dict[str, pd.DataFrame]:
+    """The former removal from each pool, as reference"""
+    results = {}
+    for names, pool in pools.items():
+        results[names] = update_by_rm_for_pool(rm_df, pool, check_cols)
+    return results
+
+
+def test_ranges_and_lookup():
+    index = PairedPoolIndex(pool, evidence_cols)
+    for comb, sub_pool in pool.groupby(evidence_cols):
+        offset, length = index.lookup(comb)
+        assert length == len(sub_pool)
+        rows = index.pool.iloc[offset : offset + length]
+        assert (rows[evidence_cols].to_numpy() == np.array(comb)).all()
+    assert index.lookup(("40-49", "M")) is None
+    syn = pd.DataFrame({"age_Main": ["20-29", "40-49"], "sex_Main": ["F", "F"]})
+    codes = index.codes_for(syn)
+    assert codes[1] == -1
+    assert tuple(index.combs.iloc[codes[0]][evidence_cols]) == ("20-29", "F")
+
+
+def test_remove_same_as_update_by_rm():
+    pools = {"all": pool, "half": pool.sample(frac=0.5, random_state=2)}
+    indexes = {name: PairedPoolIndex(x, evidence_cols) for name, x in pools.items()}
+    rm_df = pool.sample(10, random_state=1)
+    expected = pools
+    # by the evidence cols (whole combs) then by other cols
+    for check_cols in [evidence_cols, ["age_Spouse", "sex_Main"]]:
+        assert indexes["all"].remove(rm_df, check_cols) > 0
+        indexes["half"].remove(rm_df, check_cols)
+        expected = update_by_rm_for_all_pools(rm_df, expected, check_cols)
+    cols = list(pool.columns)
+    for name, index in indexes.items():
+        assert len(index) == len(expected[name])
+        pd.testing.assert_frame_equal(
+            index.to_frame().sort_values(cols).reset_index(drop=True),
+            expected[name][cols].sort_values(cols).reset_index(drop=True),
+        )
+        # the removed combs are not found anymore
+        assert (index.codes_for(rm_df) == -1).all()
+
+
+def test_sample_by_weight_never_removed():
+    index = PairedPoolIndex(pool, evidence_cols, weight_col="weight")
+    index.remove(pool[pool["age_Spouse"] == "40-49"], ["age_Spouse"])
+    syn = pd.DataFrame({"age_Main": ["30-39"] * 5000, "sex_Main": ["M"] * 5000})
+    rows = index.sample(index.codes_for(syn), np.random.default_rng(3))
+    sampled = index.pool.iloc[rows]
+    assert (sampled["age_Main"] == "30-39").all()
+    assert (sampled["sex_Main"] == "M").all()
+    assert (sampled["weight"] > 0).all()
+    assert not (sampled["age_Spouse"] == "40-49").any()
+    # frequencies follow the weights
+    sub_pool = index.to_frame()
+    sub_pool = sub_pool[(sub_pool["age_Main"] == "30-39") & (sub_pool["sex_Main"] == "M")]
+    expected = sub_pool.groupby("age_Spouse")["weight"].sum() / sub_pool["weight"].sum()
+    freq = sampled["age_Spouse"].value_counts(normalize=True)
+    assert np.allclose(freq[expected.index], expected, atol=0.03)
+
+
+def test_pool_evidence_cols():
+    assert pool_evidence_cols("HH-Main", ["age"], ["hhsize"]) == ["hhsize"]
+    assert pool_evidence_cols("Main-Spouse", ["age", "sex"], ["hhsize"]) == [
+        "age_Main",
+        "sex_Main",
+    ]
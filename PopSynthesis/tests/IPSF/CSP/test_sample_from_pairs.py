@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+
+from PopSynthesis.Methods.IPSF.CSP.operations.sample_from_pairs import (
+    sample_matching_from_pairs,
+    COUNT_COL,
+)
+from typing import List, Tuple
+
+evidence_cols = ["age_Main", "sex_Main"]
+sample_cols = ["age_Child", "sex_Child", "pid"]
+
+# the former condensed syn and pool, for the reference below
+SUM_COUNT_COL = "sum_count"  # for condensed syn
+ID_COUNT_COL = "id_n_count"  # for condensed syn
+TO_SAMPLE_COL = "to_sample"  # for condensed pool
+
+
+def convert_condensed_syn_back(
+    condensed_syn: pd.DataFrame, syn_id: str
+) -> pd.DataFrame:
+    condensed_syn = condensed_syn.drop(columns=[SUM_COUNT_COL])
+    # 1 col only now: ID_COUNT_COLc
+    condensed_syn = condensed_syn.explode(ID_COUNT_COL)
+    condensed_syn[syn_id] = condensed_syn[ID_COUNT_COL].apply(lambda x: x[0])
+    return condensed_syn.reset_index().drop(columns=[ID_COUNT_COL])
+
+
+def condense_evidence_syn(
+    given_syn: pd.DataFrame, syn_id: str, evidence_cols: List[str]
+) -> pd.DataFrame:
+    """condense the given df to have comb as """
+    assert COUNT_COL in given_syn.columns
+    given_syn[COUNT_COL] = given_syn[COUNT_COL].astype(int)
+    check_syn = given_syn[evidence_cols + [COUNT_COL, syn_id]]
+    syn_gb_ids = (
+        check_syn.groupby(evidence_cols)[[syn_id, COUNT_COL]]
+        .apply(lambda x: list(x.to_numpy()))
+        .rename(ID_COUNT_COL)
+    )
+    syn_gb_sum = check_syn.groupby(evidence_cols)[COUNT_COL].sum().rename(SUM_COUNT_COL)
+    return pd.concat([syn_gb_ids, syn_gb_sum], axis=1)
+
+
+def decoupling_paired_pool(
+    paired_pool: pd.DataFrame, evidence_cols: List[str], sample_cols: List[str]
+) -> pd.DataFrame:
+    """Output special df that seperate the evidence and to sample as index and values"""
+    target_pool = paired_pool.copy(deep=True).reset_index(drop=True)
+    # Note the order is important here
+    target_pool.loc[:, TO_SAMPLE_COL] = pd.Series(
+        list(target_pool[sample_cols].to_numpy())
+    )
+    assert not target_pool[TO_SAMPLE_COL].isna().any()
+    pool_gb_evidences = target_pool.groupby(evidence_cols)[TO_SAMPLE_COL].apply(
+        lambda x: np.array(x)
+    )
+    return pd.DataFrame(pool_gb_evidences)  # 1 col only
+
+
+def legacy_sample_matching_from_pairs(
+    given_syn: pd.DataFrame,
+    syn_id: str,
+    paired_pool: pd.DataFrame,
+    evidence_cols: List[str],
+    sample_cols: List[str],
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """The former sample_matching_from_pairs (condensing into lists), as reference"""
+    # NOTE: make sure the id is correct, including the removed
+    assert set(evidence_cols) <= set(paired_pool.columns)
+    assert set(sample_cols) <= set(paired_pool.columns)
+    assert set(evidence_cols) <= set(given_syn.columns)
+    assert not given_syn[syn_id].duplicated().any()
+    check_syn = given_syn.copy(deep=True)
+    check_pool = paired_pool.copy(deep=True)
+    if COUNT_COL not in given_syn.columns:
+        # the case use directly to have 1 for each only
+        check_syn[COUNT_COL] = 1
+
+    # Condense both syn and pool, they will now have similar indexes
+    condensed_syn = condense_evidence_syn(check_syn, syn_id, evidence_cols)
+    condensed_pool = decoupling_paired_pool(check_pool, evidence_cols, sample_cols)
+
+    # NOTE: the sample_cols order is for pool
+    # NOTE: the order for syn is, [id, count]
+    comb_in_syn = set(condensed_syn.index)
+    comb_in_pool = set(condensed_pool.index)
+    to_rm_comb_syn = comb_in_syn - comb_in_pool
+    common_comb = comb_in_syn & comb_in_pool
+
+    rm_condensed = condensed_syn.loc[condensed_syn.index.isin(to_rm_comb_syn)]
+    rm_syn_rec = convert_condensed_syn_back(rm_condensed, syn_id)
+
+    if len(common_comb) == 0:
+        # Means no matching comb for syn and pool
+        assert len(rm_syn_rec) == len(check_syn)
+        return pd.DataFrame(), rm_syn_rec, pd.DataFrame()
+
+    remained_condensed_syn = condensed_syn.loc[condensed_syn.index.isin(common_comb)]
+    kept_syn_rec = convert_condensed_syn_back(remained_condensed_syn, syn_id)
+
+    filtered_condensed_pool = condensed_pool.loc[condensed_pool.index.isin(common_comb)]
+    assert len(remained_condensed_syn) == len(filtered_condensed_pool)
+    combined_condense = pd.merge(
+        remained_condensed_syn,
+        filtered_condensed_pool,
+        left_index=True,
+        right_index=True,
+    )
+
+    # func to sample for each case
+    def sample_rec(r):
+        results = []
+        possible_recs = r[TO_SAMPLE_COL]
+        segment_by_id = r[ID_COUNT_COL]
+        tot_samples = r[SUM_COUNT_COL]
+        chosen_recs = np.random.choice(possible_recs, tot_samples)
+        start = 0
+        for sid, val in segment_by_id:
+            rec_details = np.array(
+                [list(x) + [sid] for x in chosen_recs[start : start + val]]
+            )
+            results.append(rec_details)
+            start += val
+        assert start == tot_samples
+        return results
+
+    sample_result_col = "sample_results"
+    combined_condense[sample_result_col] = combined_condense.apply(sample_rec, axis=1)
+    combined_condense = combined_condense.drop(
+        columns=[TO_SAMPLE_COL, ID_COUNT_COL, SUM_COUNT_COL]
+    )
+    combined_condense_exploded = combined_condense.explode(sample_result_col)
+
+    combined_sampled_rec = np.vstack(
+        tuple(combined_condense_exploded[sample_result_col])
+    )
+    fin_samples = pd.DataFrame(combined_sampled_rec, columns=sample_cols + [syn_id])
+
+    return fin_samples, rm_syn_rec, kept_syn_rec
+
+
+def make_syn_and_pool(n_syn: int = 150, n_pool: int = 40, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    pool = pd.DataFrame(
+        {
+            "age_Main": rng.choice(["10-19", "20-29", "30-39"], n_pool),
+            "sex_Main": rng.choice(["M", "F"], n_pool),
+            "age_Child": rng.choice(["0-9", "10-19"], n_pool),
+            "sex_Child": rng.choice(["M", "F"], n_pool),
+            "pid": np.arange(n_pool),
+        }
+    )
+    # 40-49 is not in the pool
+    syn = pd.DataFrame(
+        {
+            "age_Main": rng.choice(["10-19", "20-29", "30-39", "40-49"], n_syn),
+            "sex_Main": rng.choice(["M", "F"], n_syn),
+            "hhid": np.arange(n_syn),
+            COUNT_COL: rng.integers(1, 4, n_syn),
+        }
+    )
+    return syn, pool
+
+
+def test_same_removed_and_kept_as_legacy():
+    syn, pool = make_syn_and_pool()
+    expected = legacy_sample_matching_from_pairs(
+        syn.copy(), "hhid", pool, evidence_cols, sample_cols
+    )
+    result = sample_matching_from_pairs(
+        syn, "hhid", pool, evidence_cols, sample_cols, rng=np.random.default_rng(1)
+    )
+    pd.testing.assert_frame_equal(result[1], expected[1])
+    pd.testing.assert_frame_equal(result[2], expected[2])
+    # same records sampled for, in the same order, all as str as before
+    assert list(result[0].columns) == list(expected[0].columns)
+    assert list(result[0]["hhid"]) == list(expected[0]["hhid"])
+    assert (result[0].dtypes == object).all()
+
+
+def test_sampled_match_the_evidence():
+    syn, pool = make_syn_and_pool(seed=3)
+    sampled, removed, kept = sample_matching_from_pairs(
+        syn, "hhid", pool, evidence_cols, sample_cols, rng=np.random.default_rng(2)
+    )
+    assert set(removed["age_Main"]) == {"40-49"}
+    assert len(removed) + len(kept) == len(syn)
+    assert len(sampled) == syn.set_index("hhid").loc[kept["hhid"], COUNT_COL].sum()
+    sampled_pool = pool.iloc[sampled["pid"].astype(int)]
+    syn_of_sampled = syn.set_index("hhid").loc[sampled["hhid"].astype(int)]
+    for col in evidence_cols:
+        assert (sampled_pool[col].to_numpy() == syn_of_sampled[col].to_numpy()).all()
+    # same rng, same sample
+    again, _, _ = sample_matching_from_pairs(
+        syn, "hhid", pool, evidence_cols, sample_cols, rng=np.random.default_rng(2)
+    )
+    pd.testing.assert_frame_equal(sampled, again)
+
+
+def test_no_matching_comb():
+    syn, pool = make_syn_and_pool()
+    syn["age_Main"] = "40-49"
+    sampled, removed, kept = sample_matching_from_pairs(
+        syn, "hhid", pool, evidence_cols, sample_cols
+    )
+    assert len(sampled) == 0 and len(kept) == 0
+    assert len(removed) == len(syn)
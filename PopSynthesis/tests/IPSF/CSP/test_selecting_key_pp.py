@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from PopSynthesis.Methods.IPSF.CSP.CSP import (
+    selecting_key_pp_to_sample,
+    HHID,
+)
+from typing import Literal
+
+def legacy_selecting_key_pp_to_sample(
+    pp: pd.DataFrame,
+    hhid: str,
+    age_col: str,
+    strategy: Literal["oldest", "youngest", "random"],
+) -> pd.DataFrame:
+    """The former selecting_key_pp_to_sample (sorting lists by hh), as reference"""
+    pp = pp.copy(deep=True).reset_index(drop=True)
+    pp["ppid"] = pp.index
+    pp["converted_age"] = pp[age_col].apply(
+        lambda x: int(x.split("-")[0].replace("+", ""))
+    )
+    gb_hhid = pp.groupby(hhid)[["ppid", "converted_age"]].apply(
+        lambda x: list(x.to_numpy())
+    )
+    gb_hhid = gb_hhid.apply(lambda x: sorted(x, key=lambda x: x[1]))
+    if strategy == "oldest":
+        gb_hhid = gb_hhid.apply(lambda x: x[-1][0])
+    elif strategy == "youngest":
+        gb_hhid = gb_hhid.apply(lambda x: x[0][0])
+    elif strategy == "random":
+        gb_hhid = gb_hhid.apply(lambda x: x[np.random.randint(0, len(x))][0])
+    else:
+        raise ValueError("Strategy not found")
+    return pp[pp["ppid"].isin(gb_hhid)].drop(columns=["ppid", "converted_age"])
+
+
+rng = np.random.default_rng(0)
+pp = pd.DataFrame(
+    {
+        HHID: rng.choice([f"{i}" for i in range(40)], 150),
+        "age_Child": rng.choice(["0-9", "10-19", "20-29", "85+"], 150),
+        "sex_Child": rng.choice(["M", "F"], 150),
+    },
+    index=rng.permutation(150),
+)
+
+
+def test_same_as_legacy():
+    for strategy in ["oldest", "youngest"]:
+        expected = legacy_selecting_key_pp_to_sample(pp, HHID, "age_Child", strategy)
+        result = selecting_key_pp_to_sample(pp, HHID, "age_Child", strategy)
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_random_one_per_hh():
+    result = selecting_key_pp_to_sample(
+        pp, HHID, "age_Child", "random", rng=np.random.default_rng(1)
+    )
+    assert not result[HHID].duplicated().any()
+    assert set(result[HHID]) == set(pp[HHID])
+    # each chosen is a pp of its hh
+    merged = result.merge(pp, on=list(pp.columns), how="left", indicator=True)
+    assert (merged["_merge"] == "both").all()
+    again = selecting_key_pp_to_sample(
+        pp, HHID, "age_Child", "random", rng=np.random.default_rng(1)
+    )
+    pd.testing.assert_frame_equal(result, again)
+    with pytest.raises(ValueError):
+        selecting_key_pp_to_sample(pp, HHID, "age_Child", "middle")
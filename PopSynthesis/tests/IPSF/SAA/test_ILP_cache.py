@@ -0,0 +1,71 @@
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from PopSynthesis.Methods.IPSF.utils.ILP_cache import (
+    ILPSolutionCache,
+    configure_ILP_cache,
+    disable_ILP_cache,
+)
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import update_count_tables
+
+test_df = pl.DataFrame(
+    {
+        "row_id": ["a", "b", "c", "d"],
+        "s1": [None, 1, 2, 33],
+        "s2": [4, 32, 12, 0],
+        "s3": [10, None, 30, 50],
+    }
+)
+test_diff = {"s1": -3, "s2": 5, "s3": -2}
+
+
+def test_repeated_solve_hits_cache(tmp_path):
+    cache = configure_ILP_cache(max_size=10, disk_dir=tmp_path)
+    try:
+        first = update_count_tables(test_df, test_diff, "row_id", backend="pulp")
+        second = update_count_tables(test_df, test_diff, "row_id", backend="pulp")
+        assert_frame_equal(first[0], second[0])
+        assert first[1] == second[1]
+        assert cache.n_hits == 1 and cache.n_misses == 1
+
+        # a fresh process level cache with the same folder reads from disk
+        cache = configure_ILP_cache(max_size=10, disk_dir=tmp_path)
+        third = update_count_tables(test_df, test_diff, "row_id", backend="pulp")
+        assert_frame_equal(first[0], third[0])
+        assert cache.n_disk_hits == 1
+
+        # another diff is another problem
+        update_count_tables(test_df, {"s1": -2, "s2": 4, "s3": -2}, "row_id", backend="pulp")
+        assert cache.n_misses == 1 and len(cache.solutions) == 2
+    finally:
+        disable_ILP_cache()
+
+
+def test_cache_keys_and_lru():
+    key = ILPSolutionCache.make_key(test_df, test_diff, "row_id")
+    assert ILPSolutionCache.make_key(test_df.clone(), test_diff, "row_id") == key
+    other_vals = test_df.with_columns(pl.col("s2") + 1)
+    assert ILPSolutionCache.make_key(other_vals, test_diff, "row_id") != key
+    other_nulls = test_df.with_columns(pl.lit(None, dtype=pl.Int64).alias("s2"))
+    assert ILPSolutionCache.make_key(other_nulls, test_diff, "row_id") != key
+    assert ILPSolutionCache.make_key(test_df, test_diff, "row_id", backend="pulp") != key
+
+    cache = ILPSolutionCache(max_size=2)
+    for key in ["k1", "k2"]:
+        cache.put(key, np.zeros((1, 1)))
+    cache.get("k1")  # k1 is now the most recent
+    cache.put("k3", np.zeros((1, 1)))
+    assert cache.get("k2") is None
+    assert cache.get("k1") is not None and cache.get("k3") is not None
+
+
+def test_disk_tier_written_whole_and_bad_file_is_a_miss(tmp_path):
+    cache = ILPSolutionCache(max_size=2, disk_dir=tmp_path)
+    cache.put("k1", np.arange(6).reshape(2, 3))
+    assert [x.name for x in tmp_path.iterdir()] == ["k1.npy"]
+    # e.g. a file cut short by another process
+    (tmp_path / "k2.npy").write_bytes(b"\x93NUMPY")
+    other = ILPSolutionCache(max_size=2, disk_dir=tmp_path)
+    assert other.get("k2") is None and other.n_misses == 1
+    np.testing.assert_array_equal(other.get("k1"), np.arange(6).reshape(2, 3))
@@ -0,0 +1,48 @@
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import (
+    update_count_tables,
+    get_ILP_path_counts,
+)
+
+test_df = pl.DataFrame(
+    {
+        "row_id": [0, 1, 2, 3],
+        "s1": [None, 1, 2, 33],
+        "s2": [4, 32, 12, 0],
+        "s3": [10, None, 3, 50],
+    }
+)
+
+
+def solve_both(diff):
+    fast = update_count_tables(test_df, diff, "row_id", deviation_type="absolute")
+    ilp = update_count_tables(
+        test_df, diff, "row_id", deviation_type="absolute", fast_path=False
+    )
+    return fast, ilp
+
+
+def test_single_pair_path():
+    counts_before = get_ILP_path_counts()
+    # more than s2 can give where s3 exists, leaves the same error as the ILP
+    (fast_table, fast_err), (_, ilp_err) = solve_both({"s1": 0, "s2": -50, "s3": 50})
+    assert np.isclose(fast_err, ilp_err)
+    assert fast_table["s2"].to_list() == [0, 32, 0, 0]
+    assert (get_ILP_path_counts() - counts_before)["single_pair"] == 1
+
+
+def test_single_row_path():
+    counts_before = get_ILP_path_counts()
+    (fast_table, fast_err), (_, ilp_err) = solve_both({"s1": -20, "s2": 25, "s3": -5})
+    assert fast_err == ilp_err == 0
+    assert fast_table.row(3) == (3, 13, 25, 45)
+    assert (get_ILP_path_counts() - counts_before)["single_row"] == 1
+
+
+def test_relative_goes_to_ILP():
+    counts_before = get_ILP_path_counts()
+    update_count_tables(test_df, {"s1": 0, "s2": -5, "s3": 5}, "row_id")
+    new_counts = get_ILP_path_counts() - counts_before
+    assert new_counts["single_pair"] == 0 and new_counts["highs"] == 1
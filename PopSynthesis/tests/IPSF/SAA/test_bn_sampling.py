@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import (
+    CompiledBN,
+    census_required_states,
+)
+from PopSynthesis.Methods.IPSF.utils.storage import scan_frame
+
+# hhsize -> totalvehs <- dwelltype, given in the child's CPD as (states, parent configs)
+parents = {"totalvehs": ["hhsize", "dwelltype"], "hhsize": [], "dwelltype": []}
+states = {
+    "hhsize": ["1", "2", "3"],
+    "dwelltype": ["House", "Flat"],
+    "totalvehs": [0, 1, 2],
+}
+cpd_values = {
+    "hhsize": np.array([[0.5], [0.3], [0.2]]),
+    "dwelltype": np.array([[0.7], [0.3]]),
+    # cols: (1, House), (1, Flat), (2, House), (2, Flat), (3, House), (3, Flat)
+    "totalvehs": np.array(
+        [
+            [0.6, 0.9, 0.2, 0.5, 0.1, 0.0],
+            [0.3, 0.1, 0.5, 0.5, 0.3, 0.0],
+            [0.1, 0.0, 0.3, 0.0, 0.6, 1.0],
+        ]
+    ),
+}
+bn = CompiledBN(parents, states, cpd_values)
+
+
+def test_topological_order():
+    assert bn.nodes.index("totalvehs") > bn.nodes.index("hhsize")
+    assert bn.nodes.index("totalvehs") > bn.nodes.index("dwelltype")
+
+
+def test_frequencies_follow_cpds():
+    n = 200_000
+    pool = bn.sample_pandas(n, np.random.default_rng(0))
+    freq = pool["hhsize"].value_counts(normalize=True)
+    assert np.allclose([freq["1"], freq["2"], freq["3"]], [0.5, 0.3, 0.2], atol=0.01)
+    for i, hhsize in enumerate(states["hhsize"]):
+        for j, dwell in enumerate(states["dwelltype"]):
+            sub = pool[(pool["hhsize"] == hhsize) & (pool["dwelltype"] == dwell)]
+            cond = sub["totalvehs"].value_counts(normalize=True)
+            expected = cpd_values["totalvehs"][:, i * 2 + j]
+            got = [cond.get(v, 0) for v in states["totalvehs"]]
+            assert np.allclose(got, expected, atol=0.02)
+            # zero prob states are never sampled
+            assert all(g == 0 for g, e in zip(got, expected) if e == 0)
+    # the states keep their type, as forward_sample
+    assert set(pool["totalvehs"].unique()) <= {0, 1, 2}
+
+
+def test_same_rng_same_pool_and_chunks(tmp_path):
+    full = bn.sample(1000, np.random.default_rng(1), chunk_size=300, decode=False)
+    again = bn.sample(1000, np.random.default_rng(1), chunk_size=300, decode=False)
+    assert full.equals(again)
+    assert full.schema["hhsize"] == pl.UInt8
+    chunks = list(bn.iter_chunks(1000, 300, np.random.default_rng(1)))
+    assert [len(x) for x in chunks] == [300, 300, 300, 100]
+    assert pl.concat(chunks).equals(full)
+    paths = bn.sample_to_dir(1000, tmp_path, 300, np.random.default_rng(1))
+    streamed = pl.concat([scan_frame(p).collect() for p in paths])
+    assert streamed.equals(full)
+    decoded = bn.sample(1000, np.random.default_rng(1), chunk_size=300)
+    assert decoded.equals(bn.categories.decode(full))
+    assert len(bn.sample(0)) == 0
+
+
+def test_sample_given_is_the_posterior():
+    codes, n_drawn = bn.sample_given({"totalvehs": 2}, 50_000, np.random.default_rng(2))
+    assert n_drawn >= 50_000
+    assert (codes["totalvehs"] == 2).all()
+    # P(hhsize | totalvehs = 2) by Bayes
+    joint = (
+        cpd_values["hhsize"][:, 0][:, None]
+        * cpd_values["dwelltype"][:, 0][None, :]
+        * cpd_values["totalvehs"][2].reshape(3, 2)
+    ).sum(axis=1)
+    freq = np.bincount(codes["hhsize"], minlength=3) / len(codes["hhsize"])
+    assert np.allclose(freq, joint / joint.sum(), atol=0.01)
+    # (hhsize 1, Flat) never has 2 vehs
+    codes, _ = bn.sample_given({"totalvehs": 2, "dwelltype": "Flat"}, 1000)
+    assert (codes["hhsize"] != 0).all()
+
+
+def test_top_up_only_the_missing():
+    rng = np.random.default_rng(3)
+    pool = bn.sample_pandas(500, rng)
+    pool = pool[pool["hhsize"] != "3"].reset_index(drop=True)
+    required = [{"hhsize": "3"}, {"hhsize": "1"}, {"hhsize": "2", "totalvehs": "0"}]
+    required += [{"totalvehs": 2, "dwelltype": "Flat", "hhsize": "1"}, {"hhsize": "9"}]
+    topped_up, report = bn.top_up(pool, required, n_per_missing=3, rng=rng)
+    pd.testing.assert_frame_equal(topped_up.iloc[: len(pool)], pool)
+    added = topped_up.iloc[len(pool) :]
+    assert (added["hhsize"] == "3").sum() == 3
+    # impossible comb and unknown state are reported with nothing added
+    assert report["n_added"].tolist() == [3, 0, 0]
+    assert report["combination"].tolist() == [required[0], required[3], required[4]]
+    assert report["n_drawn"].iloc[0] > 0 and report["n_drawn"].iloc[2] == 0
+
+
+def test_census_required_states():
+    census = pd.DataFrame(
+        [[1, 0, 4], [2, 0, 0]],
+        index=pd.Index([10, 11], name="zone_id"),
+        columns=pd.MultiIndex.from_tuples(
+            [("hhsize", "1"), ("hhsize", "2"), ("totalvehs", "0")]
+        ),
+    )
+    assert census_required_states(census) == [{"hhsize": "1"}, {"totalvehs": "0"}]
+    assert census_required_states(census, ["totalvehs"]) == [{"totalvehs": "0"}]
+
+
+def test_from_pgmpy():
+    pytest.importorskip("pgmpy")
+    from pgmpy.factors.discrete import TabularCPD
+    from pgmpy import models
+
+    # renamed in the recent pgmpy
+    network = getattr(models, "DiscreteBayesianNetwork", None) or models.BayesianNetwork
+    model = network([("hhsize", "totalvehs"), ("dwelltype", "totalvehs")])
+    model.add_cpds(
+        *[
+            TabularCPD(
+                node,
+                len(states[node]),
+                cpd_values[node],
+                evidence=parents[node] or None,
+                evidence_card=[len(states[p]) for p in parents[node]] or None,
+                state_names={x: states[x] for x in [node] + parents[node]},
+            )
+            for node in parents
+        ]
+    )
+    compiled = CompiledBN.from_pgmpy(model)
+    assert compiled.parents == {node: parents[node] for node in compiled.nodes}
+    for node in compiled.nodes:
+        assert np.allclose(compiled.flat_cum[node], bn.flat_cum[node])
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from PopSynthesis.Methods.IPSF.const import zone_field, LS_HH_INC
+from PopSynthesis.Methods.IPSF.SAA.operations.wrapper_saa_run import saa_run
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+
+states = {
+    "hhsize": ["1", "2", "3"],
+    "hhinc": LS_HH_INC[:4],
+}
+categories = CategoricalDictionary(states)
+
+
+def test_encode_decode_roundtrip():
+    rng = np.random.default_rng(0)
+    df = pl.DataFrame({att: rng.choice(s, size=50) for att, s in states.items()})
+    df = df.with_columns(pl.lit("z1").alias(zone_field))
+    encoded = categories.encode(df)
+    assert encoded.schema["hhsize"] == pl.UInt8
+    assert encoded.schema["hhinc"] == pl.UInt8
+    assert encoded[zone_field].to_list() == df[zone_field].to_list()
+    assert encoded["hhinc"].max() < 4
+    assert_frame_equal(categories.decode(encoded), df)
+
+
+def test_encode_marginal_uses_codes_as_cols():
+    marg = pd.DataFrame(
+        [[1, 2, 3]],
+        columns=pd.MultiIndex.from_tuples(
+            [("hhsize", "1"), ("hhsize", "3"), ("other", "x")]
+        ),
+    )
+    encoded = categories.encode_marginal(marg)
+    assert list(encoded.columns) == [("hhsize", "0"), ("hhsize", "2"), ("other", "x")]
+    assert list(categories.decode_marginal(encoded).columns) == list(marg.columns)
+
+
+def test_saa_run_on_codes():
+    rng = np.random.default_rng(3)
+    pool = condense_df(
+        pl.DataFrame({att: rng.choice(s, size=300) for att, s in states.items()})
+    )
+    # 2 zones, census made from records of the pool so it can be matched
+    syn = pool.sample(40, with_replacement=True, seed=1).drop("count")
+    syn = syn.with_columns(pl.Series(zone_field, ["1"] * 20 + ["2"] * 20))
+    marg = {}
+    for att in states:
+        counts = syn.to_pandas().groupby(zone_field)[att].value_counts().unstack()
+        for state in counts.columns:
+            marg[(att, state)] = counts[state].fillna(0).astype(int)
+    marg = pd.DataFrame(marg)
+    marg.index = marg.index.astype(int)
+    marg.index.name = zone_field
+
+    final_syn, _ = saa_run(
+        marg,
+        pool,
+        considered_atts=list(states),
+        ordered_to_adjust_atts=list(states),
+        max_run_time=3,
+        seed=0,
+        categories=categories,
+    )
+    assert final_syn.schema["hhinc"] == pl.String
+    assert len(final_syn) == 40
+    assert set(final_syn["hhinc"]) <= set(states["hhinc"])
+    assert set(final_syn["hhsize"]) <= set(states["hhsize"])
@@ -0,0 +1,36 @@
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.SAA.operations.ILP_zone_ad import (
+    build_feasibility_index,
+    convert_to_ILP_inputs,
+)
+
+pool = pl.DataFrame(
+    {
+        "hhsize": ["1", "1", "2", "2", "3"],
+        "totalvehs": ["0", "1", "1", "2", "2"],
+        count_field: [3, 1, 4, 2, 5],
+    }
+)
+
+
+def test_feasibility_index():
+    feasibility = build_feasibility_index(pool, "totalvehs", ["hhsize"])
+    assert feasibility.sort("hhsize").rows() == [
+        ("1", 0, 0, None),
+        ("2", None, 0, 0),
+        ("3", None, None, 0),
+    ]
+
+
+def test_convert_keeps_syn_rows_and_pool_cells():
+    syn = pl.DataFrame(
+        {"hhsize": ["3", "1", "1"], "totalvehs": ["2", "0", "0"], count_field: [2, 1, 1]}
+    )
+    feasibility = build_feasibility_index(pool, "totalvehs", ["hhsize"])
+    result = convert_to_ILP_inputs(syn, "totalvehs", ["hhsize"], pool, feasibility)
+    assert result.columns == ["hhsize", "0", "1", "2"]
+    # first seen order of the syn, not possible cells are null, possible ones 0 if empty
+    assert result.rows() == [("3", None, None, 2), ("1", 2, 0, None)]
+    assert result.equals(convert_to_ILP_inputs(syn, "totalvehs", ["hhsize"], pool))
@@ -0,0 +1,38 @@
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field, count_field
+from PopSynthesis.Methods.IPSF.SAA.operations.general import init_syn_pop_saa
+
+pool = pl.DataFrame(
+    {
+        "hhsize": ["1", "1", "2", "3", "3", "3"],
+        "dwelltype": ["house", "unit", "house", "house", "unit", "unit"],
+        count_field: [10, 30, 5, 1, 1, 8],
+    }
+)
+marg = pl.DataFrame(
+    {
+        zone_field: ["z1", "z2", "z3"],
+        "1": [4, 0, 12],
+        "2": [1, 7, 0],
+        "3": [0, 3, 5],
+    }
+)
+
+
+def test_init_matches_census():
+    syn_pop = init_syn_pop_saa("hhsize", marg, pool, rng=np.random.default_rng(0))
+    assert syn_pop.zones() == ["z1", "z2", "z3"]
+    for r in marg.iter_rows(named=True):
+        zid = r.pop(zone_field)
+        counts = dict(syn_pop.get(zid)["hhsize"].value_counts().iter_rows())
+        assert counts == {s: n for s, n in r.items() if n > 0}
+    assert count_field not in syn_pop.to_frame().columns
+
+
+def test_init_follows_pool_weights():
+    big_marg = pl.DataFrame({zone_field: ["z1"], "1": [40000], "2": [0], "3": [0]})
+    syn_pop = init_syn_pop_saa("hhsize", big_marg, pool, rng=np.random.default_rng(1))
+    share_unit = (syn_pop.get("z1")["dwelltype"] == "unit").mean()
+    assert abs(share_unit - 0.75) < 0.01
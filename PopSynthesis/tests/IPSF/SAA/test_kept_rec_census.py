@@ -0,0 +1,142 @@
+from itertools import combinations, product
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.utils.categorical import CategoricalDictionary
+from PopSynthesis.Methods.IPSF.utils.synthetic_checked_census import (
+    adjust_kept_rec_match_census,
+    convert_count_to_full,
+    convert_full_to_marg_count,
+    convert_to_dict_ls,
+    get_diff_marg,
+)
+
+
+def legacy_adjust_kept_rec_match_census(
+    syn_records: pd.DataFrame, diff_census: pd.DataFrame
+) -> pd.DataFrame:
+    # The former adjust_kept_rec_match_census (on the MultiIndex value counts), as reference
+    syn_records = syn_records.astype(str)
+    count_kept = syn_records.value_counts()
+    for zone, r in diff_census.iterrows():
+        sub_count_kept = count_kept.loc[
+            count_kept.index.get_level_values(zone_field) == zone
+        ]
+        prev_indexs = sub_count_kept.index
+        neg_cols = r[r < 0]
+        # re check with neg val
+        dict_neg_v = convert_to_dict_ls(neg_cols.index)
+        for i in range(len(dict_neg_v)):
+            raws_before_comb = combinations(dict_neg_v.values(), len(dict_neg_v) - i)
+            for raw in raws_before_comb:
+                if neg_cols.sum() == 0:
+                    break
+                ls_pos_neg_comb = list(product(*raw))
+                for comb in ls_pos_neg_comb:
+                    # loop through each neg combs all
+                    condi_check = True
+                    to_del_n = np.inf
+                    # search for sub df with combs and also dfind the
+                    for att, state in comb:
+                        condi_check &= (
+                            sub_count_kept.index.get_level_values(att) == state
+                        )
+                        if att != zone_field:
+                            check_v = neg_cols.loc[(att, state)] * -1
+                            if check_v < to_del_n:
+                                to_del_n = check_v
+                    filtered_combs_from_kept = sub_count_kept.loc[condi_check]
+
+                    if len(filtered_combs_from_kept) == 0 or to_del_n == 0:
+                        continue
+
+                    sum_val = filtered_combs_from_kept.sum()
+                    if sum_val < to_del_n:
+                        to_del_n = sum_val
+
+                    # we need to spread the del_n by the dist
+                    temp_hold_combs = filtered_combs_from_kept / sum_val
+                    temp_hold_combs = temp_hold_combs * to_del_n
+
+                    # First del by just normal rounding
+                    to_del_first = np.floor(temp_hold_combs)
+                    filtered_combs_from_kept = filtered_combs_from_kept - to_del_first
+                    remaining_to_del = to_del_n - to_del_first.sum()
+                    # we will spread the remaing to del for the top
+                    filtered_combs_from_kept.sort_values(ascending=False, inplace=True)
+                    filtered_combs_from_kept.iloc[: int(remaining_to_del)] -= 1
+                    # Make sure there are no neg
+                    assert not any(filtered_combs_from_kept < 0)
+
+                    # Update the count kept
+                    sub_count_kept.loc[
+                        filtered_combs_from_kept.index
+                    ] = filtered_combs_from_kept
+                    neg_cols.loc[list(comb)] += to_del_n
+                    sub_count_kept = sub_count_kept[sub_count_kept > 0]
+        zero_indexes = set(prev_indexs) - set(sub_count_kept.index)
+        count_kept.loc[sub_count_kept.index] = sub_count_kept
+        count_kept.loc[list(zero_indexes)] = 0
+        assert neg_cols.sum() == 0
+    return convert_count_to_full(count_kept.reset_index())
+
+
+def make_syn_and_diff(seed: int):
+    rng = np.random.default_rng(seed)
+    n_records = 4 * 60
+    syn = pd.DataFrame(
+        {
+            att: rng.choice(["a", "b", "c", "d"], size=n_records, p=[0.4, 0.3, 0.2, 0.1])
+            for att in ["hhsize", "totalvehs", "dwelltype"]
+        }
+    )
+    syn[zone_field] = np.repeat(np.arange(4), 60)
+    # census from part of the syn, with some atts shuffled so it is not a subset
+    census_src = syn.sample(frac=0.85, random_state=seed)
+    census_src["totalvehs"] = rng.permutation(census_src["totalvehs"].values)
+    census = convert_full_to_marg_count(census_src, [zone_field])
+    diff = get_diff_marg(census, convert_full_to_marg_count(syn.copy(), [zone_field]))
+    return syn, diff
+
+
+def test_same_as_legacy():
+    for seed in range(3):
+        syn, diff = make_syn_and_diff(seed)
+        expected = legacy_adjust_kept_rec_match_census(syn.copy(), diff.copy())
+        result = adjust_kept_rec_match_census(syn.copy(), diff.copy())
+        # the records keep their types, the former version gave all str
+        pd.testing.assert_frame_equal(result.astype(str), expected)
+
+
+def test_no_state_above_census():
+    syn, diff = make_syn_and_diff(5)
+    kept = adjust_kept_rec_match_census(syn.copy(), diff.copy())
+    assert len(kept) < len(syn)
+    new_diff = get_diff_marg(
+        diff + convert_full_to_marg_count(syn.copy().astype(str), [zone_field]),
+        convert_full_to_marg_count(kept, [zone_field]),
+    )
+    assert not (new_diff < 0).any(axis=None)
+
+
+def test_state_codes_same_as_states():
+    syn, diff = make_syn_and_diff(1)
+    # same order of the codes as the states, so the same ties
+    categories = CategoricalDictionary(
+        {att: ["a", "b", "c", "d"] for att in ["hhsize", "totalvehs", "dwelltype"]}
+    )
+    encoded_syn = categories.encode(syn).to_pandas()
+    kept_codes, deleted_codes = adjust_kept_rec_match_census(
+        encoded_syn, categories.encode_marginal(diff), return_deleted=True
+    )
+    assert kept_codes["hhsize"].dtype == np.uint8
+    kept, deleted = adjust_kept_rec_match_census(syn, diff, return_deleted=True)
+    pd.testing.assert_frame_equal(
+        categories.decode(pl.from_pandas(kept_codes)).to_pandas(), kept
+    )
+    pd.testing.assert_frame_equal(
+        categories.decode(pl.from_pandas(deleted_codes)).to_pandas(), deleted
+    )
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.SAA.SAA import SAA
+from PopSynthesis.Methods.IPSF.SAA.operations.compare_census import calculate_states_diff
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from PopSynthesis.Methods.IPSF.utils.marginal_tracker import MarginalTracker
+from PopSynthesis.Methods.IPSF.utils.zone_partition import ZonePartitionedPop
+
+states = {
+    "hhsize": ["1", "2", "3"],
+    "totalvehs": ["0", "1", "2"],
+    "dwelltype": ["house", "unit"],
+}
+rng = np.random.default_rng(0)
+syn_pop = pl.DataFrame(
+    {att: rng.choice(s, size=90) for att, s in states.items()}
+).with_columns(pl.Series(zone_field, np.repeat([1, 2, 3], 30)))
+
+
+def test_states_diff_same_as_recount():
+    tracker = MarginalTracker.from_pop(syn_pop, list(states))
+    # zone 4 and state 3 are not in the syn
+    sub_census = pl.DataFrame(
+        {zone_field: [1, 2, 3, 4], "0": [10, 5, 5, 2], "1": [10, 20, 5, 0], "2": [10, 5, 20, 0], "3": [0, 0, 0, 3]}
+    )
+    expected = calculate_states_diff("totalvehs", syn_pop, sub_census)
+    assert_frame_equal(
+        tracker.states_diff("totalvehs", sub_census), expected, check_dtypes=False
+    )
+    n_syn = syn_pop.filter((pl.col(zone_field) == 2) & (pl.col("hhsize") == "3")).height
+    assert tracker.cell(2, "hhsize", "3") == n_syn
+
+
+def test_replace_zones_and_check():
+    pop = ZonePartitionedPop.from_frame(syn_pop)
+    tracker = MarginalTracker.from_pop(pop, list(states), debug=True)
+    new_zone = syn_pop.filter(pl.col(zone_field) == 1).with_columns(
+        pl.lit("unit").alias("dwelltype")
+    )
+    tracker.replace_zones({1: pop.get(1)}, {1: new_zone})
+    pop.set(1, new_zone)
+    tracker.check(pop)
+    assert tracker.cell(1, "dwelltype", "house") == 0
+    # records removed without telling the tracker
+    pop.set(2, pop.get(2).head(10))
+    with pytest.raises(AssertionError):
+        tracker.check(pop)
+
+
+def test_saa_tracked_same_as_recount():
+    pool = condense_df(
+        pl.DataFrame({att: rng.choice(s, size=400) for att, s in states.items()})
+    )
+    marg = {}
+    for att, att_states in states.items():
+        for state in att_states:
+            marg[(att, state)] = rng.integers(0, 6, size=4)
+    marg = pd.DataFrame(marg)
+    # same number of hh for all atts in each zone
+    for att in ["totalvehs", "dwelltype"]:
+        marg[(att, states[att][0])] += marg["hhsize"].sum(axis=1) - marg[att].sum(axis=1)
+    marg = marg.clip(lower=0)
+    marg = marg[(marg.T.groupby(level=0).sum().T.nunique(axis=1) == 1)]
+    marg.index.name = zone_field
+
+    outputs = []
+    for track_marginals in [False, True]:
+        saa = SAA(
+            marg,
+            list(states),
+            list(states),
+            pool,
+            seed=3,
+            track_marginals=track_marginals,
+            debug_marginals=True,
+        )
+        outputs.append(saa.run())
+    assert_frame_equal(outputs[0], outputs[1])
+    saa.tracker.check(outputs[1])
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field, count_field
+from PopSynthesis.Methods.IPSF.utils.marginals import (
+    full_to_long_marg,
+    wide_to_long_marg,
+    long_to_wide_marg,
+    diff_long_marg,
+)
+
+rng = np.random.default_rng(0)
+syn = pd.DataFrame(
+    {
+        "hhsize": rng.choice(["1", "2", "3"], size=60),
+        "totalvehs": rng.choice([0, 1], size=60),
+        zone_field: rng.choice([1, 2, 3], size=60),
+    }
+)
+
+
+def test_full_to_marg_same_as_value_counts():
+    marg = long_to_wide_marg(full_to_long_marg(syn))
+    assert list(marg.index) == ["1", "2", "3"]
+    for att in ["hhsize", "totalvehs"]:
+        expected = (
+            syn.astype(str).groupby(zone_field)[att].value_counts().unstack().fillna(0)
+        )
+        np.testing.assert_array_equal(marg[att].to_numpy(), expected.to_numpy())
+        assert list(marg[att].columns) == list(expected.columns)
+
+
+def test_wide_long_roundtrip():
+    marg = long_to_wide_marg(full_to_long_marg(syn))
+    long_marg = wide_to_long_marg(marg)
+    assert long_marg.columns == [zone_field, "att", "state", count_field]
+    pd.testing.assert_frame_equal(long_to_wide_marg(long_marg), marg)
+
+
+def test_diff_with_missing_zones_and_states():
+    census = pd.DataFrame(
+        [[5, 1, 2], [0, 4, 4]],
+        index=pd.Index([1, 4], name=zone_field),
+        columns=pd.MultiIndex.from_tuples(
+            [("hhsize", "1"), ("hhsize", "4"), ("totalvehs", "0")]
+        ),
+    )
+    syn_long = full_to_long_marg(syn)
+    diff = diff_long_marg(wide_to_long_marg(census), syn_long)
+
+    def diff_of(zone, att, state):
+        return diff.filter(
+            (pl.col(zone_field) == zone)
+            & (pl.col("att") == att)
+            & (pl.col("state") == state)
+        )[count_field].item()
+
+    n_syn = ((syn[zone_field] == 1) & (syn["hhsize"] == "1")).sum()
+    assert diff_of("1", "hhsize", "1") == 5 - n_syn
+    # state only in census, zone only in census, zone only in syn
+    assert diff_of("1", "hhsize", "4") == 1
+    assert diff_of("4", "totalvehs", "0") == 4
+    assert diff_of("2", "hhsize", "2") == -((syn[zone_field] == 2) & (syn["hhsize"] == "2")).sum()
+    wide = long_to_wide_marg(diff)
+    assert list(wide.index) == ["1", "2", "3", "4"]
+    assert wide.loc["4", ("hhsize", "2")] == 0
+
+
+def test_zones_sorted_as_numbers():
+    long_marg = full_to_long_marg(
+        pd.DataFrame({"hhsize": ["1"] * 4, zone_field: ["10", "9", "3000", "A1"]})
+    )
+    marg = long_to_wide_marg(long_marg)
+    assert list(marg.index) == ["9", "10", "3000", "A1"]
@@ -0,0 +1,51 @@
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.utils.bn_sampling import CompiledBN
+from PopSynthesis.Methods.IPSF.utils.pool_generation import (
+    generate_pools,
+    generate_pool,
+    shard_sizes,
+)
+
+# hhsize -> totalvehs
+bn = CompiledBN(
+    {"hhsize": [], "totalvehs": ["hhsize"]},
+    {"hhsize": ["1", "2"], "totalvehs": ["0", "1", "2"]},
+    {
+        "hhsize": np.array([[0.6], [0.4]]),
+        "totalvehs": np.array([[0.7, 0.1], [0.3, 0.4], [0.0, 0.5]]),
+    },
+)
+
+
+def test_shard_sizes():
+    assert shard_sizes(10, 3) == [4, 3, 3]
+    assert shard_sizes(2, 4) == [1, 1, 0, 0]
+    assert sum(shard_sizes(1_000_003, 7)) == 1_000_003
+
+
+def test_reproducible_with_same_seed_and_workers(tmp_path):
+    kwargs = dict(pool_size=20_001, seed=7, n_workers=2, chunk_size=3000)
+    pools = generate_pools({"HH": bn, "Main-Child": bn}, out_dir=tmp_path / "a", **kwargs)
+    again = generate_pools({"HH": bn, "Main-Child": bn}, out_dir=tmp_path / "b", **kwargs)
+    for name in ["HH", "Main-Child"]:
+        assert pools[name].equals(again[name])
+        assert pools[name][count_field].sum() == 20_001
+        assert len(list((tmp_path / "a" / name).iterdir())) == 2
+    # each pool has its own streams
+    assert not pools["HH"].equals(pools["Main-Child"])
+    # impossible comb never sampled, the rest follows the CPDs
+    pool = pools["HH"]
+    assert len(pool.filter((pl.col("hhsize") == "1") & (pl.col("totalvehs") == "2"))) == 0
+    n_size_1 = pool.filter(pl.col("hhsize") == "1")[count_field].sum()
+    assert abs(n_size_1 / 20_001 - 0.6) < 0.02
+
+
+def test_single_worker_and_codes(tmp_path):
+    serial = generate_pool(bn, 5000, tmp_path / "a", seed=1, chunk_size=700)
+    assert serial.equals(generate_pool(bn, 5000, tmp_path / "b", seed=1, chunk_size=700))
+    codes = generate_pool(bn, 5000, tmp_path / "c", seed=1, chunk_size=700, decode=False)
+    assert codes.schema["hhsize"] == pl.UInt8
+    assert bn.categories.decode(codes).equals(serial)
@@ -0,0 +1,50 @@
+import numpy as np
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import count_field
+from PopSynthesis.Methods.IPSF.utils.pool_sampling import PoolSamplingIndex
+
+pool = pl.DataFrame(
+    {
+        "hhsize": ["1", "1", "2", "2", "2", "3"],
+        "totalvehs": [0, 1, 0, 1, 2, 2],
+        "dwelltype": ["house", "unit", "house", "unit", "unit", "house"],
+        count_field: [1, 3, 2, 2, 4, 5],
+    }
+)
+
+
+def test_sample_follows_weights_in_group():
+    index = PoolSamplingIndex(pool, ["hhsize"])
+    syn_count = pl.DataFrame({"hhsize": ["2", "1"], count_field: [80000, 40000]})
+    result = index.sample(syn_count, rng=np.random.default_rng(3))
+    assert result.columns == ["hhsize", "totalvehs", "dwelltype"]
+    assert result.schema == pool.drop(count_field).schema
+    assert result["hhsize"].value_counts().sort("hhsize").rows() == [
+        ("1", 40000),
+        ("2", 80000),
+    ]
+    share = (
+        result.group_by(["hhsize", "totalvehs"])
+        .len()
+        .join(syn_count, on="hhsize")
+        .with_columns(pl.col("len") / pl.col(count_field))
+    )
+    expected = {("1", 0): 0.25, ("1", 1): 0.75, ("2", 0): 0.25, ("2", 1): 0.25, ("2", 2): 0.5}
+    for hhsize, totalvehs, frac, _ in share.rows():
+        assert abs(frac - expected[(hhsize, totalvehs)]) < 0.01
+
+
+def test_sample_reproducible_and_no_other_atts():
+    index = PoolSamplingIndex(pool, ["hhsize", "totalvehs"])
+    syn_count = pl.DataFrame(
+        {"hhsize": ["2", "3"], "totalvehs": [1, 2], count_field: [5, 2]}
+    )
+    first = index.sample(syn_count, rng=np.random.default_rng(0))
+    assert first.equals(index.sample(syn_count, rng=np.random.default_rng(0)))
+    assert len(first) == 7 and first["dwelltype"].to_list()[-2:] == ["house", "house"]
+
+    all_atts = ["hhsize", "totalvehs", "dwelltype"]
+    only_counts = pool.head(2).with_columns(pl.lit(2).alias(count_field))
+    result = PoolSamplingIndex(pool, all_atts).sample(only_counts)
+    assert result.rows() == [("1", 0, "house")] * 2 + [("1", 1, "unit")] * 2
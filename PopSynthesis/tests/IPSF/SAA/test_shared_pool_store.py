@@ -0,0 +1,30 @@
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import SharedPoolStore
+
+rng = np.random.default_rng(1)
+pool = pl.DataFrame(
+    {
+        "hhsize": rng.integers(0, 4, size=200).astype(np.uint8),
+        "dwelltype": rng.choice(["house", "unit"], size=200),
+        "count": rng.integers(1, 10, size=200),
+    }
+)
+
+
+def test_publish_attach_and_versions():
+    with SharedPoolStore() as store:
+        handle = store.publish("HH-Main", pool)
+        assert_frame_equal(handle.attach(), pool)
+        smaller = store.publish("HH-Main", pool.head(50).to_pandas())
+        assert store.versions("HH-Main") == [0, 1]
+        assert store.latest("HH-Main") == smaller
+        # the older snapshot is still there until released
+        assert len(handle.attach()) == 200
+        store.release("HH-Main")
+        assert store.versions("HH-Main") == [1]
+        assert_frame_equal(smaller.attach(), pool.head(50))
+        assert_frame_equal(pl.from_pandas(smaller.attach_pandas()), pool.head(50))
+    assert not store.root.exists()
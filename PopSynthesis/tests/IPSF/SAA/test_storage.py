@@ -0,0 +1,66 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.utils.storage import (
+    save_frame,
+    load_frame,
+    scan_frame,
+    read_frame,
+    read_marginal,
+    read_paired_pools,
+    migrate_data_dirs,
+)
+
+rng = np.random.default_rng(0)
+pool = pd.DataFrame(
+    {
+        "hhsize": rng.choice(["1", "2", "8+"], size=50),
+        "totalvehs": rng.choice([0, 1, 2], size=50),
+        "id": np.arange(50),
+    }
+)
+
+
+def test_frame_roundtrip(tmp_path):
+    for suffix in [".parquet", ".arrow"]:
+        path = save_frame(pool, tmp_path / f"pool{suffix}")
+        pd.testing.assert_frame_equal(load_frame(path).to_pandas(), pool)
+        lazy_sub = scan_frame(path).filter(pl.col("hhsize") == "8+").collect()
+        assert len(lazy_sub) == (pool["hhsize"] == "8+").sum()
+    # the strings are dictionary encoded in the Arrow file
+    assert load_frame(path, keep_categorical=True).schema["hhsize"] == pl.Categorical
+
+
+def test_migrate_and_read_same_as_csv(tmp_path):
+    marg = pd.DataFrame(
+        [[1, 3, 5, 0], [2, 0, 7, 1]],
+        columns=pd.MultiIndex.from_tuples(
+            [(zone_field, ""), ("sample_geog", ""), ("hhsize", "1"), ("hhsize", "2")]
+        ),
+    )
+    marg.to_csv(tmp_path / "hh_marginals_small.csv", index=False)
+    pool.to_csv(tmp_path / "HH_pool.csv", index=False)
+    pools = {"HH-Main": pool, "Main-Child": pool.head(10)}
+    with open(tmp_path / "dict_pool_pairs_test.pickle", "wb") as handle:
+        pickle.dump(pools, handle)
+
+    from_csv = read_marginal(tmp_path / "hh_marginals_small.csv")
+    pools_from_pickle = read_paired_pools(tmp_path / "dict_pool_pairs_test.pickle")
+    assert len(migrate_data_dirs([tmp_path])) == 3
+
+    from_parquet = read_marginal(tmp_path / "hh_marginals_small.csv")
+    np.testing.assert_array_equal(from_parquet.to_numpy(), from_csv.to_numpy())
+    assert list(from_parquet.index) == [1, 2]
+    assert list(from_parquet.columns) == [("hhsize", "1"), ("hhsize", "2")]
+
+    pd.testing.assert_frame_equal(read_frame(tmp_path / "HH_pool.csv"), pool)
+    migrated_pools = read_paired_pools(tmp_path / "dict_pool_pairs_test.pickle")
+    assert migrated_pools.keys() == pools_from_pickle.keys()
+    for name in pools:
+        pd.testing.assert_frame_equal(
+            migrated_pools[name], pools_from_pickle[name].reset_index(drop=True)
+        )
@@ -1,5 +1,9 @@
 import polars as pl
-from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import update_count_tables
+from PopSynthesis.Methods.IPSF.utils.ILP_matrix_ad import (
+    update_count_tables,
+    get_ILP_model_sizes,
+    ILP_BACKENDS,
+)
 from pathlib import Path
 
 # Simple pass case with polars, including row labels as a new column 'row_id'
@@ -44,3 +48,55 @@ def test_update_states():
     print(b)
 
 test_update_states()
+
+
+def test_backends_same_err():
+    # the sparse HiGHS model is the same as the PuLP one, optimal errors must match
+    # (no fast path, both cases must go through the solvers)
+    for df, diff in [(test_df, test_diff), (noabs_test_df, noabs_test_diff)]:
+        for deviation_type in ["absolute", "relative"]:
+            errs = [
+                update_count_tables(
+                    df,
+                    diff,
+                    "row_id",
+                    deviation_type=deviation_type,
+                    backend=backend,
+                    fast_path=False,
+                    engine="ILP",
+                )[1]
+                for backend in ILP_BACKENDS
+            ]
+            assert errs[0] == errs[1]
+
+
+def test_flow_engine_not_worse():
+    # the flow engine minimises the remaining err directly, the ILP cannot do better
+    for df, diff in [(test_df, test_diff), (noabs_test_df, noabs_test_diff)]:
+        for deviation_type in ["absolute", "relative"]:
+            _, ilp_err = update_count_tables(df, diff, "row_id", deviation_type=deviation_type)
+            flow_table, flow_err = update_count_tables(
+                df, diff, "row_id", deviation_type=deviation_type, engine="flow"
+            )
+            assert flow_err <= ilp_err + 1e-9
+            assert flow_table.select(pl.exclude("row_id")).min().min_horizontal()[0] >= 0
+
+
+def test_model_size_linear():
+    # s3 has no diff so dropped: 2 rows x 2 cols, adjustment + deviation per cell,
+    # 2 slacks per column, activations (and big-M rows) only if penalised
+    for backend in ILP_BACKENDS:
+        for spread_penalty, n_cell_blocks in [(0, 2), (0.1, 3)]:
+            sizes_before = get_ILP_model_sizes()
+            update_count_tables(
+                noabs_test_df,
+                noabs_test_diff,
+                "row_id",
+                spread_penalty=spread_penalty,
+                backend=backend,
+                fast_path=False,
+            )
+            sizes = get_ILP_model_sizes() - sizes_before
+            assert sizes["models"] == 1
+            assert sizes["variables"] == n_cell_blocks * 4 + 2 * 2
+            assert sizes["constraints"] == 2 + 2 + n_cell_blocks * 4
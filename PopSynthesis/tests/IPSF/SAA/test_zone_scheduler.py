@@ -0,0 +1,94 @@
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from PopSynthesis.Methods.IPSF.const import zone_field
+from PopSynthesis.Methods.IPSF.SAA.operations import zone_scheduler
+from PopSynthesis.Methods.IPSF.SAA.operations.zone_scheduler import (
+    adjust_zones,
+    create_zone_executor,
+    run_seed,
+)
+from PopSynthesis.Methods.IPSF.utils.condensed import condense_df
+from PopSynthesis.Methods.IPSF.utils.shared_pool_store import SharedPoolStore
+
+states = {
+    "hhsize": ["1", "2", "3"],
+    "totalvehs": ["0", "1", "2"],
+    "dwelltype": ["house", "unit"],
+}
+rng = np.random.default_rng(42)
+pool = condense_df(
+    pl.DataFrame({att: rng.choice(s, size=500) for att, s in states.items()})
+)
+
+
+def make_zone_tasks(n_zones: int = 6, n_hh: int = 30):
+    tasks = []
+    for zid in range(n_zones):
+        sub_pop = pool.sample(n_hh, with_replacement=True, seed=zid).drop("count")
+        sub_pop = sub_pop.with_columns(pl.lit(str(zid)).alias(zone_field))
+        # move a few records from the most common to the least common state
+        counts = sub_pop["totalvehs"].value_counts().sort("count")
+        zone_marg = {s: 0 for s in states["totalvehs"]}
+        zone_marg[counts["totalvehs"][0]] += 3
+        zone_marg[counts["totalvehs"][-1]] -= 3
+        tasks.append((str(zid), sub_pop, zone_marg))
+    return tasks
+
+
+def test_parallel_matches_serial():
+    tasks = make_zone_tasks()
+    serial_pops, serial_err = adjust_zones(
+        "totalvehs", tasks, pool, ["hhsize"], n_workers=1, seed=7
+    )
+    parallel_pops, parallel_err = adjust_zones(
+        "totalvehs", tasks, pool, ["hhsize"], n_workers=2, chunk_size=2, seed=7
+    )
+    assert serial_err == parallel_err
+    assert list(serial_err.keys()) == [t[0] for t in tasks]
+    assert list(serial_pops.keys()) == list(parallel_pops.keys())
+    for zid, zone_pop in serial_pops.items():
+        assert_frame_equal(zone_pop, parallel_pops[zid])
+
+
+def test_workers_attached_to_store_match_serial():
+    tasks = make_zone_tasks(n_zones=4)
+    serial_pops, serial_err = adjust_zones(
+        "totalvehs", tasks, pool, ["hhsize"], n_workers=1, seed=3
+    )
+    with SharedPoolStore() as store:
+        executor = create_zone_executor(pool, 2, store)
+        try:
+            shared_pops, shared_err = adjust_zones(
+                "totalvehs",
+                tasks,
+                pool,
+                ["hhsize"],
+                n_workers=2,
+                chunk_size=1,
+                seed=3,
+                executor=executor,
+            )
+        finally:
+            executor.shutdown()
+        # each run publishes the pool, only the last version is kept
+        create_zone_executor(pool, 2, store).shutdown()
+        assert store.versions("SAA_pool") == [1]
+    assert serial_err == shared_err
+    for zid, zone_pop in serial_pops.items():
+        assert_frame_equal(zone_pop, shared_pops[zid])
+
+
+def test_no_seed_is_drawn_in_the_main_process(monkeypatch):
+    assert run_seed(5) == 5
+    assert isinstance(run_seed(None), int) and run_seed(None) != run_seed(None)
+    tasks = make_zone_tasks(n_zones=4)
+    serial_pops, _ = adjust_zones("totalvehs", tasks, pool, ["hhsize"], n_workers=1, seed=7)
+    # the (spawned) workers only see the seed drawn here
+    monkeypatch.setattr(zone_scheduler, "run_seed", lambda seed: 7 if seed is None else seed)
+    parallel_pops, _ = adjust_zones(
+        "totalvehs", tasks, pool, ["hhsize"], n_workers=2, chunk_size=1, seed=None
+    )
+    for zid, zone_pop in serial_pops.items():
+        assert_frame_equal(zone_pop, parallel_pops[zid])